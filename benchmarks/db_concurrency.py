@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+数据库并发基准测试
+
+模拟多个worker进程同时访问同一个SQLite数据库文件，混合执行
+上传（写入图片和日志）、短链接访问（读取并更新计数）和页面查询（统计和分页），
+统计吞吐量和 "database is locked" 错误数量。
+
+用法:
+    python benchmarks/db_concurrency.py --processes 8 --duration 10
+    python benchmarks/db_concurrency.py --legacy   # 使用旧的默认配置对比
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 旧的默认配置：回滚日志、完全同步、无忙等待
+LEGACY_PROFILE = {
+    "SQLITE_JOURNAL_MODE": "DELETE",
+    "SQLITE_SYNCHRONOUS": "FULL",
+    "SQLITE_MMAP_SIZE": "0",
+    "SQLITE_CACHE_SIZE": "-2000",
+    "SQLITE_BUSY_TIMEOUT": "0",
+    "SQLITE_TEMP_STORE": "DEFAULT",
+}
+
+# 各类操作的权重
+WORKLOAD = [("upload", 2), ("short_link", 6), ("page", 2)]
+
+
+def worker(db_url, duration, seed, result_queue):
+    """单个进程的负载循环"""
+    os.environ["DATABASE_URL"] = db_url
+    sys.path.insert(0, ROOT)
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.sql import func
+    from src.database import SessionLocal, Image, UploadLog, ShortLink
+
+    rng = random.Random(seed)
+    ops = [name for name, weight in WORKLOAD for _ in range(weight)]
+    stats = {"ops": 0, "lock_errors": 0, "other_errors": 0}
+    stats.update({name: 0 for name, _ in WORKLOAD})
+    latencies = []
+
+    db = SessionLocal()
+    codes = [code for (code,) in db.query(ShortLink.code).limit(1000).all()]
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        op = rng.choice(ops)
+        start = time.perf_counter()
+        try:
+            if op == "upload":
+                filename = f"{uuid.uuid4().hex}.jpg"
+                user_id = f"user-{rng.randint(1, 50)}"
+                db.add(Image(filename=filename, original_filename="bench.jpg",
+                             file_size=rng.uniform(10, 2000), upload_ip="127.0.0.1", user_id=user_id))
+                db.add(UploadLog(original_filename="bench.jpg", saved_filename=filename, status="success",
+                                 ip_address="127.0.0.1", user_id=user_id))
+                db.commit()
+                code = ShortLink.generate_code()
+                db.add(ShortLink(code=code, target_file=filename, user_id=user_id))
+                db.commit()
+                codes.append(code)
+            elif op == "short_link" and codes:
+                link = db.query(ShortLink).filter(ShortLink.code == rng.choice(codes)).first()
+                if link:
+                    link.increase_access_count()
+                    db.commit()
+                    db.query(Image).filter(Image.filename == link.target_file).first()
+            else:
+                user_id = f"user-{rng.randint(1, 50)}"
+                db.query(func.count(UploadLog.id)).scalar()
+                db.query(func.count(UploadLog.id)).filter(UploadLog.user_id == user_id).scalar()
+                db.query(UploadLog).filter(UploadLog.user_id == user_id) \
+                    .order_by(UploadLog.upload_time.desc()).limit(20).all()
+                db.rollback()
+            stats[op] += 1
+            stats["ops"] += 1
+            latencies.append(time.perf_counter() - start)
+        except OperationalError as e:
+            db.rollback()
+            if "locked" in str(e).lower() or "busy" in str(e).lower():
+                stats["lock_errors"] += 1
+            else:
+                stats["other_errors"] += 1
+        except Exception:
+            db.rollback()
+            stats["other_errors"] += 1
+    db.close()
+    result_queue.put((stats, latencies))
+
+
+def percentile(values, p):
+    """计算百分位数"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def seed_database(db_url, links):
+    """初始化表结构并写入一些短链接"""
+    os.environ["DATABASE_URL"] = db_url
+    sys.path.insert(0, ROOT)
+    from src.database import SessionLocal, Image, ShortLink, create_tables
+    create_tables()
+    db = SessionLocal()
+    for i in range(links):
+        filename = f"{uuid.uuid4().hex}.jpg"
+        db.add(Image(filename=filename, original_filename=f"seed{i}.jpg", user_id=f"user-{i % 50}"))
+        db.add(ShortLink(code=ShortLink.generate_code(8), target_file=filename, user_id=f"user-{i % 50}"))
+    db.commit()
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite并发基准测试")
+    parser.add_argument("--processes", type=int, default=8, help="并发进程数")
+    parser.add_argument("--duration", type=float, default=10.0, help="每个进程运行时长（秒）")
+    parser.add_argument("--seed-links", type=int, default=500, help="预先写入的短链接数量")
+    parser.add_argument("--legacy", action="store_true", help="使用旧的默认SQLite配置作为对比")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    args = parser.parse_args()
+
+    if args.legacy:
+        os.environ.update(LEGACY_PROFILE)
+
+    workdir = tempfile.mkdtemp(prefix="picui-bench-")
+    os.chdir(workdir)
+    db_url = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    ctx = multiprocessing.get_context("spawn")
+    init = ctx.Process(target=seed_database, args=(db_url, args.seed_links))
+    init.start()
+    init.join()
+
+    queue = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(db_url, args.duration, i, queue)) for i in range(args.processes)]
+    started = time.time()
+    for p in procs:
+        p.start()
+    results = [queue.get() for _ in procs]
+    for p in procs:
+        p.join()
+    elapsed = time.time() - started
+
+    totals = {}
+    latencies = []
+    for stats, lat in results:
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+        latencies.extend(lat)
+
+    report = {
+        "profile": "legacy" if args.legacy else "default",
+        "processes": args.processes,
+        "duration": round(elapsed, 2),
+        "throughput": round(totals["ops"] / elapsed, 1),
+        "ops": totals,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+        },
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"配置: {report['profile']}  进程数: {args.processes}  时长: {report['duration']}s")
+        print(f"吞吐量: {report['throughput']} ops/s  总操作: {totals['ops']}")
+        print(f"锁错误: {totals['lock_errors']}  其他错误: {totals['other_errors']}")
+        print(f"延迟: p50={report['latency_ms']['p50']}ms p95={report['latency_ms']['p95']}ms "
+              f"p99={report['latency_ms']['p99']}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+端到端HTTP压力测试
+
+在临时目录中用独立的上传目录和数据库启动服务（python main.py），生成不同尺寸和格式的
+测试图片，预先上传一批图片后按比例混合请求以下接口：
+    upload     POST /upload
+    short      GET  /s/{code}
+    image      GET  /images/{filename}
+    watermark  GET  /images/{filename}/watermark
+    admin      GET  /logs/ 和 /admin/short-links
+
+输出每类请求的吞吐量和p50/p95/p99延迟（JSON），以及当前提交和运行参数，
+便于比较不同提交、worker数和线程池配置。服务相关的环境变量（如THREAD_POOL_SIZE、
+DB_EXECUTOR_SIZE）会原样传给服务进程。
+
+用法:
+    python benchmarks/http_load.py --workers 4 --concurrency 64 --duration 30 > result.json
+    python benchmarks/http_load.py --workers 8 --baseline result.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = "upload=10,short=35,image=35,watermark=10,admin=10"
+
+# 测试图片的尺寸分布: (最短边范围, 权重)
+SIZE_CLASSES = (((64, 256), 5), ((640, 1280), 4), ((1920, 3000), 1))
+FORMATS = (("JPEG", ".jpg", "image/jpeg"), ("PNG", ".png", "image/png"),
+           ("WEBP", ".webp", "image/webp"), ("GIF", ".gif", "image/gif"))
+
+
+def percentile(values, p):
+    """计算百分位数"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_corpus(count, seed):
+    """生成测试图片：渐变加噪声，压缩率接近照片；返回 [(文件名, 内容, MIME类型)]"""
+    import numpy as np
+    from PIL import Image as PILImage
+
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    corpus = []
+    for i in range(count):
+        (low, high), = rng.choices([c for c, _ in SIZE_CLASSES], weights=[w for _, w in SIZE_CLASSES])
+        short_side = rng.randint(low, high)
+        width, height = (short_side, int(short_side * rng.uniform(1.0, 1.6)))
+        if rng.random() < 0.5:
+            width, height = height, width
+        fmt, ext, mime = FORMATS[i % len(FORMATS)]
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+        base = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+        noise = np_rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+        img = PILImage.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8), "RGB")
+        buf = io.BytesIO()
+        img.save(buf, fmt, **({"quality": 85} if fmt in ("JPEG", "WEBP") else {}))
+        corpus.append((f"bench{i}{ext}", buf.getvalue(), mime))
+    return corpus
+
+
+def start_server(workdir, port, workers):
+    """在临时目录中启动服务，返回子进程"""
+    for name in ("templates", "static"):
+        os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "HOST": "127.0.0.1",
+        "WORKERS": str(workers),
+        "RELOAD": "false",
+        "LOGLEVEL": "warning",
+        "UPLOAD_DIR": os.path.join(workdir, "uploads"),
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'picui.db')}",
+        "PROMETHEUS_MULTIPROC_DIR": os.path.join(workdir, "metrics"),
+        "PYTHONPATH": ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+    })
+    log = open(os.path.join(workdir, "server.log"), "w")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(base_url, proc, timeout=60):
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.time() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError("服务进程启动失败，请查看server.log")
+            try:
+                if (await client.get(f"{base_url}/")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.3)
+    raise RuntimeError("等待服务启动超时")
+
+
+async def upload(client, item):
+    name, content, mime = item
+    return await client.post("/upload", files={"file": (name, content, mime)})
+
+
+async def seed_images(base_url, corpus, count):
+    """预先上传图片，返回 (文件名列表, 短链接代码列表)"""
+    filenames, codes = [], []
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        for i in range(count):
+            response = await upload(client, corpus[i % len(corpus)])
+            response.raise_for_status()
+            data = response.json()
+            filenames.append(data["filename"])
+            if data.get("short_url"):
+                codes.append(data["short_url"].rsplit("/", 1)[1])
+    return filenames, codes
+
+
+async def run_load(base_url, corpus, filenames, codes, mix, concurrency, duration, warmup):
+    """按比例混合请求，返回每类请求的延迟和错误记录"""
+    ops = list(mix)
+    weights = [mix[op] for op in ops]
+    results = {op: {"latencies": [], "errors": 0, "status": {}} for op in ops}
+    rng = random.Random(1)
+    started = time.perf_counter()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+
+    async def request(client, op):
+        if op == "upload":
+            return await upload(client, rng.choice(corpus))
+        if op == "short":
+            return await client.get(f"/s/{rng.choice(codes)}")
+        if op == "image":
+            return await client.get(f"/images/{rng.choice(filenames)}")
+        if op == "watermark":
+            return await client.get(f"/images/{rng.choice(filenames)}/watermark")
+        return await client.get(rng.choice(("/logs/", "/admin/short-links")))
+
+    async def user():
+        # 每个虚拟用户使用独立的客户端和会话cookie
+        async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+            while time.perf_counter() < stop_at:
+                op = rng.choices(ops, weights=weights)[0]
+                t0 = time.perf_counter()
+                try:
+                    response = await request(client, op)
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = "error"
+                t1 = time.perf_counter()
+                if t0 < measure_from:
+                    continue
+                entry = results[op]
+                entry["status"][str(status)] = entry["status"].get(str(status), 0) + 1
+                if status == "error" or status >= 500:
+                    entry["errors"] += 1
+                else:
+                    entry["latencies"].append((t1 - t0) * 1000)
+
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - measure_from
+    return results, elapsed
+
+
+def summarize(results, elapsed):
+    summary = {}
+    all_latencies = []
+    for op, entry in results.items():
+        latencies = entry["latencies"]
+        all_latencies.extend(latencies)
+        summary[op] = {
+            "requests": len(latencies) + entry["errors"],
+            "errors": entry["errors"],
+            "throughput_rps": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "status": entry["status"],
+        }
+    summary["total"] = {
+        "requests": sum(s["requests"] for s in summary.values()),
+        "errors": sum(s["errors"] for s in summary.values()),
+        "throughput_rps": round(len(all_latencies) / elapsed, 2),
+        "p50_ms": round(percentile(all_latencies, 50), 2),
+        "p95_ms": round(percentile(all_latencies, 95), 2),
+        "p99_ms": round(percentile(all_latencies, 99), 2),
+    }
+    return summary
+
+
+def compare(current, baseline):
+    """输出与基准结果的相对变化（正数表示变慢或吞吐下降）"""
+    diff = {}
+    for op, stats in current.items():
+        base = baseline.get(op)
+        if not base:
+            continue
+        diff[op] = {}
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if base.get(key):
+                diff[op][key] = f"{(stats[key] - base[key]) / base[key] * 100:+.1f}%"
+        if base.get("throughput_rps"):
+            diff[op]["throughput_rps"] = \
+                f"{(stats['throughput_rps'] - base['throughput_rps']) / base['throughput_rps'] * 100:+.1f}%"
+    return diff
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        op = op.strip()
+        if op not in ("upload", "short", "image", "watermark", "admin"):
+            raise SystemExit(f"未知的请求类型: {op}")
+        if float(weight) > 0:
+            mix[op] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端HTTP压力测试")
+    parser.add_argument("--workers", type=int, default=2, help="服务worker进程数")
+    parser.add_argument("--concurrency", type=int, default=32, help="并发虚拟用户数")
+    parser.add_argument("--duration", type=float, default=30, help="测量时长(秒)")
+    parser.add_argument("--warmup", type=float, default=5, help="预热时长(秒)，不计入结果")
+    parser.add_argument("--corpus", type=int, default=40, help="生成的测试图片数量")
+    parser.add_argument("--seed-images", type=int, default=100, help="压测前预先上传的图片数量")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"请求比例，默认 {DEFAULT_MIX}")
+    parser.add_argument("--baseline", help="与之前输出的JSON结果比较")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录（包含server.log）")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    workdir = tempfile.mkdtemp(prefix="picui-load-")
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+
+    started = time.time()
+    corpus = build_corpus(args.corpus, seed=42)
+    print(f"已生成 {len(corpus)} 张测试图片，共 {sum(len(c) for _, c, _ in corpus) / 1024 / 1024:.1f}MB，"
+          f"用时 {time.time() - started:.1f}s", file=sys.stderr)
+
+    proc = start_server(workdir, port, args.workers)
+    try:
+        asyncio.run(wait_ready(base_url, proc))
+        filenames, codes = asyncio.run(seed_images(base_url, corpus, args.seed_images))
+        print(f"已预先上传 {len(filenames)} 张图片，开始压测 {args.duration}s", file=sys.stderr)
+        results, elapsed = asyncio.run(run_load(
+            base_url, corpus, filenames, codes, mix, args.concurrency, args.duration, args.warmup
+        ))
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = summarize(results, elapsed)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "workers": args.workers,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "mix": mix,
+            "env": {k: os.environ[k] for k in ("THREAD_POOL_SIZE", "DB_EXECUTOR_SIZE", "STORAGE_IO_THREADS",
+                                               "MAX_CONCURRENT_UPLOADS", "DB_POOL_SIZE") if k in os.environ},
+        },
+        "results": summary,
+    }
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["vs_baseline"] = compare(summary, json.load(f)["results"])
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+src/utils 图片函数的微基准测试和回归检查
+
+使用固定的测试图片（小PNG、4K JPEG、5000万像素JPEG、RGBA PNG、GIF动画、调色板图片），
+测量 optimize_image、add_watermark、offline_image_check 和 allowed_file 的耗时、
+峰值内存增量和输出字节数。每项测量在独立的子进程中运行，峰值内存互不影响。
+
+基准结果与机器相关，应在同一台机器（或同一CI环境）上生成和比较：
+    python benchmarks/image_functions.py --save-baseline benchmarks/baseline.json
+    python benchmarks/image_functions.py --check benchmarks/baseline.json --threshold 0.25
+超过阈值时以非零状态退出。仓库中的 benchmarks/baseline.json 记录了生成时的机器和依赖版本，
+在其他环境中比较时耗时只能作为参考。
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 测试图片版本，修改生成逻辑时递增，避免复用旧的缓存
+CORPUS_VERSION = 1
+
+# 测试图片: 名称 -> 文件名
+CORPUS = {
+    "tiny_png": "tiny.png",
+    "jpeg_4k": "4k.jpg",
+    "jpeg_50mp": "50mp.jpg",
+    "rgba_png": "rgba.png",
+    "animated_gif": "animated.gif",
+    "palette_png": "palette.png",
+}
+
+FUNCTIONS = ("optimize_image", "add_watermark", "offline_image_check", "allowed_file")
+
+
+def _photo_like(width, height, seed):
+    """渐变加噪声，压缩后的大小接近真实照片"""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    base += rng.normal(0, 10, (height, width, 3)).astype(np.float32)
+    return np.clip(base, 0, 255).astype(np.uint8)
+
+
+def build_corpus(corpus_dir):
+    """生成测试图片，已存在的文件不重复生成"""
+    from PIL import Image
+    os.makedirs(corpus_dir, exist_ok=True)
+
+    def path(name):
+        return os.path.join(corpus_dir, CORPUS[name])
+
+    if not os.path.exists(path("tiny_png")):
+        Image.fromarray(_photo_like(32, 32, 1)).save(path("tiny_png"))
+    if not os.path.exists(path("jpeg_4k")):
+        Image.fromarray(_photo_like(3840, 2160, 2)).save(path("jpeg_4k"), quality=90)
+    if not os.path.exists(path("jpeg_50mp")):
+        Image.fromarray(_photo_like(8660, 5774, 3)).save(path("jpeg_50mp"), quality=90)
+    if not os.path.exists(path("rgba_png")):
+        rgb = _photo_like(2048, 2048, 4)
+        img = Image.fromarray(rgb).convert("RGBA")
+        img.putalpha(Image.linear_gradient("L").resize((2048, 2048)))
+        img.save(path("rgba_png"))
+    if not os.path.exists(path("animated_gif")):
+        frames = [Image.fromarray(_photo_like(2560, 1440, 10 + i)).convert("P", palette=Image.Palette.ADAPTIVE)
+                  for i in range(8)]
+        frames[0].save(path("animated_gif"), save_all=True, append_images=frames[1:], duration=100, loop=0)
+    if not os.path.exists(path("palette_png")):
+        Image.fromarray(_photo_like(2400, 1600, 5)).convert("P", palette=Image.Palette.ADAPTIVE, colors=64) \
+            .save(path("palette_png"))
+    return {name: path(name) for name in CORPUS}
+
+
+def _max_rss_kb():
+    # Linux上优先读取VmHWM：ru_maxrss会在fork时继承父进程的峰值，生成大图后启动的子进程读数不准确
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS返回字节，Linux返回KB
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run_child(function, image_path, repeat):
+    """在子进程中执行单项测量，输出JSON"""
+    sys.path.insert(0, ROOT)
+    import logging
+    logging.disable(logging.CRITICAL)
+    from src import utils
+
+    workdir = tempfile.mkdtemp(prefix="picui-imgbench-")
+    samples = []
+    output_bytes = None
+    rss_before = _max_rss_kb()
+    try:
+        for _ in range(repeat):
+            if function == "optimize_image":
+                # optimize_image会覆盖原文件，每次使用新的副本
+                target = os.path.join(workdir, os.path.basename(image_path))
+                shutil.copyfile(image_path, target)
+                start = time.perf_counter()
+                utils.optimize_image(target)
+                samples.append(time.perf_counter() - start)
+                output_bytes = os.path.getsize(target)
+            elif function == "add_watermark":
+                # 与水印路由一致：添加水印后编码为原格式
+                start = time.perf_counter()
+                img = utils.add_watermark(image_path, "PicUI图床", "bottom-right", 0.5)
+                buf = io.BytesIO()
+                img.save(buf, format=img.format or "JPEG", quality=95)
+                samples.append(time.perf_counter() - start)
+                output_bytes = buf.tell()
+            elif function == "offline_image_check":
+                start = time.perf_counter()
+                utils.offline_image_check(image_path, 0.5)
+                samples.append(time.perf_counter() - start)
+            elif function == "allowed_file":
+                names = ["photo.JPG", "a.b.c.png", "noext", "archive.tar.gz", "image.webp", "x.svg"] * 10000
+                start = time.perf_counter()
+                for name in names:
+                    utils.allowed_file(name)
+                # 记录每次调用的平均耗时
+                samples.append((time.perf_counter() - start) / len(names))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({
+        "time_ms": round(statistics.median(samples) * 1000, 4),
+        "peak_rss_delta_mb": round(max(0, _max_rss_kb() - rss_before) / 1024, 1),
+        "output_bytes": output_bytes,
+    }))
+
+
+def measure(function, case, image_path, repeat):
+    """启动子进程执行一项测量"""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", function, image_path or "", str(repeat)],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{function}/{case} 测量失败:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+# 绝对变化小于该值时不视为回归，毫秒级的小图测量受调度抖动影响，相对变化很容易超过阈值
+MIN_DELTA = {"time_ms": 5.0, "peak_rss_delta_mb": 4.0, "output_bytes": 0}
+
+
+def check_regressions(results, baseline, thresholds):
+    """与基准比较，返回超过阈值的项目列表"""
+    failures = []
+    for key, current in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        for metric, threshold in thresholds.items():
+            old, new = base.get(metric), current.get(metric)
+            if not old or new is None or new - old <= MIN_DELTA.get(metric, 0):
+                continue
+            change = (new - old) / old
+            if change > threshold:
+                failures.append(f"{key} {metric}: {old} -> {new} ({change * 100:+.1f}%，阈值 {threshold * 100:.0f}%)")
+    return failures
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        run_child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        return
+
+    parser = argparse.ArgumentParser(description="src/utils 图片函数的微基准测试")
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), f"picui-image-corpus-v{CORPUS_VERSION}"),
+                        help="测试图片缓存目录")
+    parser.add_argument("--repeat", type=int, default=3, help="每项测量重复次数，取中位数")
+    parser.add_argument("--only", help="只运行指定函数，多个用逗号分隔")
+    parser.add_argument("--save-baseline", help="将结果保存为基准文件")
+    parser.add_argument("--check", help="与基准文件比较，超过阈值时失败")
+    parser.add_argument("--threshold", type=float, default=0.25, help="允许的相对增长，默认0.25（25%%）")
+    parser.add_argument("--time-threshold", type=float, help="耗时的阈值，默认使用--threshold")
+    parser.add_argument("--rss-threshold", type=float, help="峰值内存的阈值，默认使用--threshold")
+    parser.add_argument("--bytes-threshold", type=float, help="输出字节数的阈值，默认使用--threshold")
+    args = parser.parse_args()
+
+    functions = args.only.split(",") if args.only else FUNCTIONS
+    started = time.time()
+    corpus = build_corpus(args.corpus_dir)
+    print(f"测试图片已就绪 ({time.time() - started:.1f}s): {args.corpus_dir}", file=sys.stderr)
+
+    results = {}
+    for function in functions:
+        cases = [("filenames", None)] if function == "allowed_file" else list(corpus.items())
+        for case, image_path in cases:
+            key = f"{function}/{case}"
+            results[key] = measure(function, case, image_path, args.repeat)
+            print(f"{key}: {results[key]}", file=sys.stderr)
+
+    import numpy
+    import PIL
+    report = {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "numpy": numpy.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"已保存基准: {args.save_baseline}", file=sys.stderr)
+
+    exit_code = 0
+    if args.check:
+        with open(args.check, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        thresholds = {
+            "time_ms": args.time_threshold if args.time_threshold is not None else args.threshold,
+            "peak_rss_delta_mb": args.rss_threshold if args.rss_threshold is not None else args.threshold,
+            "output_bytes": args.bytes_threshold if args.bytes_threshold is not None else args.threshold,
+        }
+        failures = check_regressions(results, baseline, thresholds)
+        report["regressions"] = failures
+        if failures:
+            print("性能回归:\n  " + "\n  ".join(failures), file=sys.stderr)
+            exit_code = 1
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+日志分页基准测试
+
+生成大量上传日志后，对比OFFSET分页和游标分页在第1页与深页（默认第10000页）的查询延迟。
+
+用法:
+    python benchmarks/logs_pagination.py --rows 5000000 --deep-page 10000
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def populate(db_path, rows, users):
+    """批量写入日志，时间按秒递增，约一半日志属于同一个用户"""
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    batch = 100000
+    for start in range(0, rows, batch):
+        conn.executemany(
+            "INSERT INTO upload_logs (original_filename, status, ip_address, user_id, upload_time) "
+            "VALUES (?, 'success', '127.0.0.1', ?, datetime('2024-01-01', ?))",
+            ((f"log{i}.png", "hot-user" if i % 2 == 0 else f"user-{i % users}", f"+{i} seconds")
+             for i in range(start, min(rows, start + batch)))
+        )
+        conn.commit()
+    conn.close()
+
+
+def timed(fn, repeat):
+    """多次执行取中位数（毫秒）"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(samples), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日志分页基准测试")
+    parser.add_argument("--rows", type=int, default=5000000, help="日志总行数")
+    parser.add_argument("--users", type=int, default=1000, help="用户数量")
+    parser.add_argument("--limit", type=int, default=20, help="每页条数")
+    parser.add_argument("--deep-page", type=int, default=10000, help="深页页码")
+    parser.add_argument("--repeat", type=int, default=5, help="每个查询重复次数")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="picui-pagination-")
+    db_path = os.path.join(workdir, "picui.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    from sqlalchemy import String, type_coerce
+    from src.migrations import run_migrations
+    from src.database import SessionLocal, UploadLog
+    from src.page_routes import _fetch_logs_page, _encode_log_cursor
+
+    run_migrations()
+    started = time.time()
+    populate(db_path, args.rows, args.users)
+    print(f"已写入 {args.rows} 条日志，用时 {time.time() - started:.1f}s", file=sys.stderr)
+
+    db = SessionLocal()
+    report = {"rows": args.rows, "limit": args.limit, "deep_page": args.deep_page, "results": {}}
+    for scope, user_id in (("hot_user", "hot-user"), ("all_logs", None)):
+        def offset_page(page):
+            query = db.query(UploadLog)
+            if user_id is not None:
+                query = query.filter(UploadLog.user_id == user_id)
+            return query.order_by(UploadLog.upload_time.desc()) \
+                .offset((page - 1) * args.limit).limit(args.limit).all()
+
+        # 沿着游标翻到深页前一页，取得深页的游标（不计时）
+        deep_offset_rows = offset_page(args.deep_page)
+        cursor = None
+        if deep_offset_rows:
+            anchor = offset_page(args.deep_page - 1)[-1]
+            raw_time = db.query(type_coerce(UploadLog.upload_time, String)) \
+                .filter(UploadLog.id == anchor.id).scalar()
+            cursor = _encode_log_cursor(raw_time, anchor.id)
+            keyset_rows, _, _ = _fetch_logs_page(db, user_id, args.limit, before=cursor)
+            assert [r.id for r in keyset_rows] == [r.id for r in deep_offset_rows], "游标分页结果与OFFSET分页不一致"
+
+        report["results"][scope] = {
+            "offset_page_1_ms": timed(lambda: offset_page(1), args.repeat),
+            "offset_deep_page_ms": timed(lambda: offset_page(args.deep_page), args.repeat),
+            "keyset_page_1_ms": timed(lambda: _fetch_logs_page(db, user_id, args.limit), args.repeat),
+            "keyset_deep_page_ms": timed(lambda: _fetch_logs_page(db, user_id, args.limit, before=cursor),
+                                         args.repeat) if cursor else None,
+        }
+    db.close()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
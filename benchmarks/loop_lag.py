@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+事件循环延迟基准测试
+
+在同一个事件循环中运行应用和混合负载（短链接访问、图片查看、日志页面），
+同时用一个探测任务周期性地休眠并记录实际唤醒延迟。
+数据库操作如果在事件循环中同步执行，延迟会随着查询耗时一起增长。
+
+用法:
+    python benchmarks/loop_lag.py --logs 200000 --concurrency 32 --duration 10
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    """计算百分位数"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def prepare_workdir(log_rows, images):
+    """创建临时运行目录，写入测试图片和大量日志记录"""
+    workdir = tempfile.mkdtemp(prefix="picui-lag-")
+    for name in ("templates", "static"):
+        os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+    upload_dir = os.path.join(workdir, "uploads")
+    os.makedirs(upload_dir)
+    os.environ["UPLOAD_DIR"] = upload_dir
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'picui.db')}"
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    from PIL import Image as PILImage
+    from src.database import create_tables, SessionLocal, Image, ShortLink
+    create_tables()
+
+    db = SessionLocal()
+    filenames, codes = [], []
+    for i in range(images):
+        filename = f"{uuid.uuid4().hex}.png"
+        buf = io.BytesIO()
+        PILImage.new("RGB", (64, 64), (i * 7 % 255, 80, 160)).save(buf, "PNG")
+        with open(os.path.join(upload_dir, filename), "wb") as f:
+            f.write(buf.getvalue())
+        code = ShortLink.generate_code(8)
+        db.add(Image(filename=filename, original_filename=f"bench{i}.png", mime_type="image/png", user_id="bench"))
+        db.add(ShortLink(code=code, target_file=filename, user_id="bench"))
+        filenames.append(filename)
+        codes.append(code)
+    db.commit()
+    db.close()
+
+    # 直接用sqlite3批量写入日志，让日志页面的统计查询有足够的耗时
+    conn = sqlite3.connect(os.path.join(workdir, "picui.db"))
+    conn.executemany(
+        "INSERT INTO upload_logs (original_filename, status, ip_address, user_id, upload_time) "
+        "VALUES (?, 'success', '127.0.0.1', ?, datetime('now', ?))",
+        ((f"log{i}.png", f"user-{i % 100}", f"-{i} seconds") for i in range(log_rows))
+    )
+    conn.commit()
+    conn.close()
+    return filenames, codes
+
+
+async def run(args, filenames, codes):
+    import httpx
+    from src.app import app
+
+    lags = []
+    latencies = {"short_link": [], "image": [], "logs": []}
+    stop = asyncio.Event()
+
+    async def probe():
+        interval = args.probe_interval / 1000
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lags.append(loop.time() - start - interval)
+
+    async def client_task(client, rng):
+        while not stop.is_set():
+            roll = rng.random()
+            if roll < 0.6:
+                kind, url = "short_link", f"/s/{rng.choice(codes)}"
+            elif roll < 0.9:
+                kind, url = "image", f"/images/{rng.choice(filenames)}"
+            else:
+                kind, url = "logs", "/logs/"
+            start = time.perf_counter()
+            await client.get(url)
+            latencies[kind].append(time.perf_counter() - start)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await app.router.startup()
+        probe_task = asyncio.create_task(probe())
+        tasks = [asyncio.create_task(client_task(client, random.Random(i))) for i in range(args.concurrency)]
+        await asyncio.sleep(args.duration)
+        stop.set()
+        await asyncio.gather(probe_task, *tasks)
+        await app.router.shutdown()
+
+    report = {
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "log_rows": args.logs,
+        "loop_lag_ms": {
+            "p50": round(percentile(lags, 50) * 1000, 2),
+            "p99": round(percentile(lags, 99) * 1000, 2),
+            "max": round(max(lags) * 1000, 2) if lags else 0.0,
+        },
+        "requests": {},
+    }
+    for kind, values in latencies.items():
+        report["requests"][kind] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="事件循环延迟基准测试")
+    parser.add_argument("--logs", type=int, default=200000, help="预先写入的日志条数")
+    parser.add_argument("--images", type=int, default=50, help="测试图片数量")
+    parser.add_argument("--concurrency", type=int, default=32, help="并发客户端数")
+    parser.add_argument("--duration", type=float, default=10.0, help="运行时长（秒）")
+    parser.add_argument("--probe-interval", type=float, default=5.0, help="探测间隔（毫秒）")
+    args = parser.parse_args()
+
+    filenames, codes = prepare_workdir(args.logs, args.images)
+    report = asyncio.run(run(args, filenames, codes))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+短链接搜索基准测试
+
+生成大量图片和短链接后，对比LIKE '%x%' 全表扫描与FTS5 trigram全文索引
+在短链接管理页面搜索（总数统计 + 第一页）上的延迟。
+
+用法:
+    python benchmarks/short_link_search.py --links 1000000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import string
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ["holiday", "beach", "family", "screenshot", "avatar", "wallpaper", "receipt", "cat", "dog", "sunset"]
+
+
+def populate(db_path, links, seed=42):
+    """批量写入图片和短链接，原始文件名由常见单词组合而成"""
+    rng = random.Random(seed)
+    chars = string.ascii_letters + string.digits
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous=OFF")
+    batch = 50000
+    for start in range(0, links, batch):
+        images, rows = [], []
+        for i in range(start, min(links, start + batch)):
+            filename = f"{uuid.UUID(int=rng.getrandbits(128)).hex}.jpg"
+            original = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{i}.jpg"
+            user_id = f"user-{i % 1000}"
+            images.append((filename, original, user_id))
+            rows.append(("".join(rng.choice(chars) for _ in range(6)) + str(i), filename, user_id))
+        conn.executemany("INSERT INTO images (filename, original_filename, user_id) VALUES (?, ?, ?)", images)
+        conn.executemany("INSERT INTO short_links (code, target_file, user_id) VALUES (?, ?, ?)", rows)
+        conn.commit()
+    conn.close()
+
+
+def timed(fn, repeat):
+    """多次执行取中位数（毫秒）"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(samples), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="短链接搜索基准测试")
+    parser.add_argument("--links", type=int, default=1000000, help="短链接数量")
+    parser.add_argument("--repeat", type=int, default=5, help="每个查询重复次数")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="picui-search-")
+    db_path = os.path.join(workdir, "picui.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    from src.migrations import run_migrations
+    from src.database import SessionLocal, ShortLink, Image
+    from src.page_routes import _short_link_search_filter
+
+    # 先执行迁移创建索引和触发器，写入的数据通过触发器同步到全文索引
+    run_migrations()
+    started = time.time()
+    populate(db_path, args.links)
+    print(f"已写入 {args.links} 条短链接，用时 {time.time() - started:.1f}s", file=sys.stderr)
+
+    db = SessionLocal()
+    sample_code = db.query(ShortLink.code).order_by(ShortLink.id.desc()).first()[0]
+    terms = {"rare_code": sample_code[:6], "common_word": "sunset", "filename_suffix": f"_{args.links // 2}.jpg"}
+
+    def run(search, use_fts):
+        query = db.query(ShortLink).join(Image, ShortLink.target_file == Image.filename)
+        if use_fts:
+            condition = _short_link_search_filter(db, search, include_filename=True)
+        else:
+            condition = ShortLink.code.contains(search) | ShortLink.target_file.contains(search) | \
+                Image.original_filename.contains(search)
+        query = query.filter(condition)
+        total = query.count()
+        rows = query.order_by(ShortLink.created_at.desc()).limit(20).all()
+        return total, [r.id for r in rows]
+
+    report = {"links": args.links, "results": {}}
+    for name, term in terms.items():
+        like_total, _ = run(term, False)
+        fts_total, _ = run(term, True)
+        assert like_total == fts_total, f"搜索结果数量不一致: {term} LIKE={like_total} FTS={fts_total}"
+        report["results"][name] = {
+            "term": term,
+            "matches": fts_total,
+            "like_ms": timed(lambda: run(term, False), args.repeat),
+            "fts_ms": timed(lambda: run(term, True), args.repeat),
+        }
+    db.close()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
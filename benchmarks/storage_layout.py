@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+上传目录存储布局基准测试
+
+分别以平铺布局和分级布局生成大量空文件，随机抽样测量stat、open以及
+resolve_upload_path的延迟，并测量遍历整个目录树的时间。
+
+文件数量较多时请使用实际存放上传文件的磁盘（--dir），tmpfs上的结果没有参考意义。
+以root运行并加上--drop-caches可以在每轮测量前清空页缓存，测量冷缓存下的延迟。
+
+用法:
+    python benchmarks/storage_layout.py --files 5000000 --dir /data/bench
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def populate(base, names, layout_path):
+    """按给定布局创建空文件"""
+    known_dirs = set()
+    for name in names:
+        path = layout_path(base, name)
+        directory = os.path.dirname(path)
+        if directory not in known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            known_dirs.add(directory)
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o644))
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def measure(fn, items):
+    """对每个样本执行一次，返回延迟的p50/p99（微秒）"""
+    samples = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        "p50_us": round(statistics.median(samples), 2),
+        "p99_us": round(samples[int(len(samples) * 0.99) - 1], 2),
+    }
+
+
+def open_close(path):
+    os.close(os.open(path, os.O_RDONLY))
+
+
+def walk_seconds(base):
+    """遍历整个目录树的时间，近似备份工具扫描目录的开销"""
+    start = time.perf_counter()
+    count = 0
+    for _, _, files in os.walk(base):
+        count += len(files)
+    return round(time.perf_counter() - start, 3), count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="上传目录存储布局基准测试")
+    parser.add_argument("--files", type=int, default=5000000, help="文件数量")
+    parser.add_argument("--samples", type=int, default=20000, help="随机抽样次数")
+    parser.add_argument("--dir", default=None, help="生成测试文件的目录，默认使用临时目录")
+    parser.add_argument("--drop-caches", action="store_true", help="每轮测量前清空页缓存（需要root）")
+    parser.add_argument("--keep", action="store_true", help="测试结束后保留生成的文件")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="picui-storage-", dir=args.dir)
+    flat_dir = os.path.join(workdir, "flat")
+    sharded_dir = os.path.join(workdir, "sharded")
+    os.environ["UPLOAD_DIR"] = sharded_dir
+    sys.path.insert(0, ROOT)
+
+    from src import storage
+
+    def sharded_path(base, name):
+        storage.UPLOAD_DIR = base
+        return storage.shard_path(name)
+
+    names = [f"{uuid.uuid4().hex}.jpg" for _ in range(args.files)]
+    try:
+        for label, base, layout_path in (("flat", flat_dir, lambda b, n: os.path.join(b, n)),
+                                         ("sharded", sharded_dir, sharded_path)):
+            os.makedirs(base, exist_ok=True)
+            started = time.time()
+            populate(base, names, layout_path)
+            print(f"已生成 {args.files} 个{label}布局文件，用时 {time.time() - started:.1f}s", file=sys.stderr)
+
+        sample = random.sample(names, min(args.samples, len(names)))
+        missing = [f"{uuid.uuid4().hex}.jpg" for _ in sample]
+        report = {"files": args.files, "samples": len(sample), "results": {}}
+        for label, base in (("flat", flat_dir), ("sharded", sharded_dir)):
+            storage.UPLOAD_DIR = base
+            paths = [os.path.join(base, n) if label == "flat" else storage.shard_path(n) for n in sample]
+            missing_paths = [os.path.join(base, n) if label == "flat" else storage.shard_path(n) for n in missing]
+            result = {}
+            for name, fn, items in (
+                ("stat", os.stat, paths),
+                ("open", open_close, paths),
+                ("stat_missing", os.path.exists, missing_paths),
+                # 平铺目录上的resolve包含分级路径未命中后回退的开销
+                ("resolve", storage.resolve_upload_path, sample),
+            ):
+                if args.drop_caches:
+                    drop_caches()
+                result[name] = measure(fn, items)
+            if args.drop_caches:
+                drop_caches()
+            result["walk_s"], result["walk_files"] = walk_seconds(base)
+            report["results"][label] = result
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ import asyncio
 import multiprocessing
 import time
 import shutil
+import tempfile
 from datetime import datetime
 import logging
 
@@ -40,6 +41,7 @@ HOST = os.getenv("HOST", "0.0.0.0")
 WORKERS = int(os.getenv("WORKERS", 8))
 LOGLEVEL = os.getenv("LOGLEVEL", "info").lower()  # 默认使用info级别，可以看到更多日志
 RELOAD = os.getenv("RELOAD", "false").lower() == "true"
+PROMETHEUS_ENABLED = os.getenv("PROMETHEUS_ENABLED", "true").lower() == "true"
 
 # 设置日志级别映射
 log_levels = {
@@ -59,19 +61,23 @@ logging.basicConfig(
     format="%(levelname)s:%(name)s:%(message)s"
 )
 
-# 清理过大的日志文件
-def cleanup_logs():
-    """清理过期日志文件"""
-    log_file = "upload.log"
-    if os.path.exists(log_file) and os.path.getsize(log_file) > 10 * 1024 * 1024:  # 超过10MB
-        print(f"{Colors.YELLOW}日志文件过大，进行清理...{Colors.ENDC}")
-        # 备份旧日志
-        timestamp = time.strftime("%Y%m%d-%H%M%S")
-        backup_file = f"upload_{timestamp}.log.bak"
-        shutil.copy2(log_file, backup_file)
-        # 清空当前日志
-        open(log_file, 'w').close()
-        print(f"{Colors.GREEN}✓ 日志已清理并备份到 {backup_file}{Colors.ENDC}")
+def prepare_metrics_dir():
+    """
+    多worker模式下启用prometheus_client的多进程模式，使/metrics汇总所有worker的指标
+
+    必须在导入prometheus_client之前设置环境变量，worker进程会继承该变量；
+    目录中上次运行残留的文件会导致计数错误，启动前清空
+    """
+    if not PROMETHEUS_ENABLED or RELOAD or WORKERS <= 1:
+        return
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.path.join(
+        tempfile.gettempdir(), f"picui-metrics-{PORT}"
+    )
+    if os.path.isdir(metrics_dir):
+        shutil.rmtree(metrics_dir)
+    os.makedirs(metrics_dir, exist_ok=True)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+    print(f"{Colors.GREEN}✓ 已启用多进程监控指标: {metrics_dir}{Colors.ENDC}")
 
 def print_banner():
     """打印美化的启动横幅"""
@@ -111,17 +117,17 @@ def main():
     主入口函数
     使用uvicorn启动FastAPI应用，根据CPU核心数自动配置工作进程
     """
-    # 清理过大的日志文件
-    cleanup_logs()
+    # 多进程监控指标目录，需在导入任何使用prometheus_client的模块之前设置
+    prepare_metrics_dir()
     
-    # 从src.database导入并执行数据库升级
+    # 在启动worker之前执行一次数据库迁移，worker启动时只检查版本
     try:
-        from src.database import upgrade_database
-        print(f"{Colors.BLUE}正在升级数据库结构...{Colors.ENDC}")
-        upgrade_database()
-        print(f"{Colors.GREEN}✓ 数据库升级完成{Colors.ENDC}")
+        from src.migrations import run_migrations, latest_version
+        print(f"{Colors.BLUE}正在检查数据库迁移...{Colors.ENDC}")
+        applied = run_migrations()
+        print(f"{Colors.GREEN}✓ 数据库已是最新版本 {latest_version()}（本次应用 {applied} 个迁移）{Colors.ENDC}")
     except Exception as e:
-        print(f"{Colors.RED}! 数据库升级失败: {str(e)}{Colors.ENDC}")
+        print(f"{Colors.RED}! 数据库迁移失败: {str(e)}{Colors.ENDC}")
     
     print_banner()
     print_config()
@@ -3,64 +3,38 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import Response
 import logging
-import threading
 import os
-import prometheus_client
-from prometheus_client import CollectorRegistry
-import uuid
 
-from src.database import create_tables, get_db, Image, UploadLog, ShortLink, upgrade_database
+from src.migrations import ensure_schema
 from src.routes import router as api_router
 from src.page_routes import router as page_router, set_templates
 from src.utils import check_disk_usage
 from src.session import clean_expired_sessions
-
-# 创建日志过滤器，过滤掉特定的警告和错误消息
-class SupressFilter(logging.Filter):
-    """过滤掉重复的数据库结构警告"""
-    def __init__(self, suppress_texts):
-        super().__init__()
-        self.suppress_texts = suppress_texts
-        self.logged_messages = set()  # 存储已记录的消息，避免重复
-        
-    def filter(self, record):
-        # 检查消息是否包含任何要过滤的文本
-        message = record.getMessage()
-        
-        # 如果是短链接创建相关的信息，允许通过
-        if "短链接创建成功" in message or "开始生成短链接" in message:
-            return True
-            
-        # 过滤重复的警告消息
-        for text in self.suppress_texts:
-            if text in message:
-                # 如果是已记录过的消息，直接过滤掉
-                if message in self.logged_messages:
-                    return False
-                # 第一次出现的消息允许记录，但会被加入已记录集合
-                self.logged_messages.add(message)
-                break
-        return True
+from src.database import SessionLocal, engine
+from src.metrics import (
+    PROMETHEUS_ENABLED, CONTENT_TYPE_LATEST, MetricsMiddleware, install_db_metrics,
+    start_executor_sampler, render_metrics, mark_process_dead
+)
+from src.routes import thread_pool, clean_old_request_data
+from src.data_access import db_executor
+from src.storage import io_executor
+from src.body_limit import BodyLimitMiddleware
+from src.profiling import router as profiling_router, ProfilingMiddleware, profiling_enabled
+from src.counters import reconcile_counters
+from src.quota import reconcile_quota_usage, QUOTA_RECONCILE_INTERVAL
+from src.orphans import collect_garbage, GC_INTERVAL, GC_MAX_SECONDS
+from src.bulk_import import router as import_router
+from src.resumable import router as resumable_router, clean_expired_uploads, RESUMABLE_CLEANUP_INTERVAL
+from src.link_purge import purge_short_links, SHORT_LINK_PURGE_INTERVAL, SHORT_LINK_PURGE_MAX_SECONDS
+from src.logging_config import setup_logging, stop_logging
+from src.scheduler import scheduler, SCHEDULER_ENABLED
 
 # 配置日志记录器
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("picui")
 
-# 添加日志过滤器
-db_filter = SupressFilter([
-    "no such column", 
-    "数据库表结构与模型不匹配", 
-    "duplicate column name",
-    "无法添加"
-])
-logger.addFilter(db_filter)
-
-# 创建文件处理器
-file_handler = logging.FileHandler("upload.log", encoding="utf-8")
-file_handler.setLevel(logging.INFO)
-file_formatter = logging.Formatter('%(message)s')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
+# 日志通过队列由后台线程写入，按大小轮转，热点路径的日志按调用位置限流
+setup_logging(logger)
 
 # 环境变量
 DISK_CHECK_INTERVAL = int(os.getenv("DISK_CHECK_INTERVAL", 3600))  # 默认每小时检查一次
@@ -71,18 +45,8 @@ HOST = os.getenv("HOST", "0.0.0.0")
 # 如果未设置BASE_URL，将使用当前请求的URL作为基础URL，而不是写死localhost
 BASE_URL = os.getenv("BASE_URL", "")  # 默认不指定，将会使用请求中的host
 SESSION_CLEANUP_INTERVAL = int(os.getenv("SESSION_CLEANUP_INTERVAL", 3600))  # 默认每小时清理一次会话
-
-# 设置Prometheus指标
-try:
-    # 创建自定义注册表
-    REGISTRY = CollectorRegistry()
-    
-    # 启用Prometheus监控
-    PROMETHEUS_ENABLED = True
-except Exception as e:
-    print(f"Prometheus初始化失败: {str(e)}")
-    PROMETHEUS_ENABLED = False
-    REGISTRY = None
+COUNTER_RECONCILE_INTERVAL = int(os.getenv("COUNTER_RECONCILE_INTERVAL", 21600))  # 默认每6小时校准一次计数器
+REQUEST_COUNTER_CLEANUP_INTERVAL = 600  # 每10分钟清理一次过期的请求频率计数
 
 # 创建FastAPI应用
 app = FastAPI(
@@ -100,6 +64,18 @@ app = FastAPI(
     ]
 )
 
+# 在路由解析请求体之前限制请求体大小和multipart部分数量，先于指标中间件注册，被拒绝的请求也会计入指标
+app.add_middleware(BodyLimitMiddleware)
+
+# 记录请求耗时和数据库语句数量
+if PROMETHEUS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    install_db_metrics(engine)
+
+# 设置了PROFILE_TOKEN时允许对单个请求进行性能分析
+if profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
+
 # 配置模板目录
 templates = Jinja2Templates(directory="templates")
 set_templates(templates)
@@ -107,108 +83,111 @@ set_templates(templates)
 # 确保上传目录存在
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# 定期检查磁盘空间
-def schedule_disk_check():
-    """定期检查磁盘空间利用率"""
-    check_disk_usage(UPLOAD_DIR, DISK_USAGE_THRESHOLD)
-    # 计划下一次检查
-    threading.Timer(DISK_CHECK_INTERVAL, schedule_disk_check).start()
-
-# 定期清理过期会话
-def schedule_session_cleanup():
-    """定期清理过期会话"""
-    clean_expired_sessions()
-    # 计划下一次清理
-    threading.Timer(SESSION_CLEANUP_INTERVAL, schedule_session_cleanup).start()
+# 定期校准计数器
+def reconcile_counter_job():
+    """重新统计计数器，修正触发器之外的修改造成的偏差"""
+    db = SessionLocal()
+    try:
+        reconcile_counters(db)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# 按磁盘文件校准存储用量
+def reconcile_quota_job():
+    """按磁盘上的实际文件大小修正用量计数"""
+    db = SessionLocal()
+    try:
+        reconcile_quota_usage(db)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# 清理孤儿文件和孤儿记录，超过时间预算时下次从中断处继续
+def collect_garbage_job():
+    db = SessionLocal()
+    try:
+        collect_garbage(db)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# 分批删除过期和已禁用的短链接
+def purge_short_links_job():
+    db = SessionLocal()
+    try:
+        purge_short_links(db)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# 注册维护任务：磁盘检查和计数器校准只由leader执行，清理进程内存数据的任务每个worker都执行
+scheduler.add_job("disk_check", lambda: check_disk_usage(UPLOAD_DIR, DISK_USAGE_THRESHOLD),
+                  DISK_CHECK_INTERVAL, timeout=60, run_at_start=True)
+scheduler.add_job("session_cleanup", clean_expired_sessions, SESSION_CLEANUP_INTERVAL,
+                  timeout=60, leader_only=False, run_at_start=True)
+scheduler.add_job("request_counter_cleanup", clean_old_request_data, REQUEST_COUNTER_CLEANUP_INTERVAL,
+                  timeout=60, leader_only=False)
+# 计数器由触发器实时维护，启动时不需要校准，等待一个周期后再开始
+scheduler.add_job("counter_reconcile", reconcile_counter_job, COUNTER_RECONCILE_INTERVAL)
+scheduler.add_job("quota_reconcile", reconcile_quota_job, QUOTA_RECONCILE_INTERVAL, timeout=3600)
+scheduler.add_job("orphan_gc", collect_garbage_job, GC_INTERVAL, timeout=(GC_MAX_SECONDS or 3600) + 300)
+scheduler.add_job("short_link_purge", purge_short_links_job, SHORT_LINK_PURGE_INTERVAL,
+                  timeout=(SHORT_LINK_PURGE_MAX_SECONDS or 3600) + 60)
+scheduler.add_job("resumable_cleanup", clean_expired_uploads, RESUMABLE_CLEANUP_INTERVAL, timeout=300)
 
 # 在应用启动时创建数据库表
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
     """应用启动时执行的初始化操作"""
-    # 创建数据库表
-    create_tables()
-    
-    # 尝试升级现有数据库结构
-    upgrade_database()
-    
-    # 更新现有数据的user_id字段
-    try:
-        # 获取数据库连接
-        db = next(get_db())
-        
-        # 先检查表结构是否匹配模型
-        try:
-            # 尝试获取一个图片记录
-            first_image = db.query(Image).first()
-            # 尝试获取一个短链接记录
-            first_link = db.query(ShortLink).first()
-            
-            # 只有当表结构匹配时才执行数据迁移
-            if first_image is not None or first_link is not None:
-                # 检查是否有需要设置user_id的数据
-                images_without_user_id = db.query(Image).filter(Image.user_id == None).all()
-                logs_without_user_id = db.query(UploadLog).filter(UploadLog.user_id == None).all()
-                links_without_user_id = db.query(ShortLink).filter(ShortLink.user_id == None).all()
-                
-                # 只有在有数据需要迁移时才输出日志
-                total_records = len(images_without_user_id) + len(logs_without_user_id) + len(links_without_user_id)
-                if total_records > 0:
-                    # 按IP地址分组
-                    ip_groups = {}
-                    
-                    # 处理图片数据
-                    for img in images_without_user_id:
-                        if img.upload_ip not in ip_groups:
-                            ip_groups[img.upload_ip] = str(uuid.uuid4())
-                        img.user_id = ip_groups[img.upload_ip]
-                    
-                    # 处理日志数据
-                    for log in logs_without_user_id:
-                        if log.ip_address not in ip_groups:
-                            ip_groups[log.ip_address] = str(uuid.uuid4())
-                        log.user_id = ip_groups[log.ip_address]
-                    
-                    # 处理短链接数据（根据关联的图片）
-                    for link in links_without_user_id:
-                        img = db.query(Image).filter(Image.filename == link.target_file).first()
-                        if img and img.user_id:
-                            link.user_id = img.user_id
-                        elif img and img.upload_ip in ip_groups:
-                            link.user_id = ip_groups[img.upload_ip]
-                    
-                    # 提交更改
-                    db.commit()
-                    logger.info(f"✓ 数据库迁移完成: 更新了 {total_records} 条记录的用户ID")
-        except Exception as table_err:
-            logger.warning(f"数据库表结构与模型不匹配: {str(table_err).split('[')[0]}")
-            logger.debug(f"完整错误信息: {str(table_err)}")
-        
-    except Exception as e:
-        logger.error(f"数据库操作失败: {str(e)}")
+    # 检查数据库版本，迁移（包括旧数据的user_id回填）通常已在部署时由main()执行
+    ensure_schema()
     
-    # 启动磁盘空间检查
-    schedule_disk_check()
-    # 启动会话清理
-    schedule_session_cleanup()
+    # 启动维护任务
+    if SCHEDULER_ENABLED:
+        scheduler.start()
+    # 定期采样各线程池的排队任务数
+    if PROMETHEUS_ENABLED:
+        start_executor_sampler({"image": thread_pool, "db": db_executor, "io": io_executor})
     logger.info("✓ 应用启动完成")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """worker退出时停止维护任务、清理多进程指标文件，并写完队列中剩余的日志"""
+    await scheduler.stop()
+    mark_process_dead()
+    stop_logging()
+
 # Prometheus 指标接口
 @app.get("/metrics")
 async def metrics():
     """返回Prometheus指标"""
-    if PROMETHEUS_ENABLED and REGISTRY:
-        metrics_text = prometheus_client.generate_latest(REGISTRY).decode("utf-8")
-        return Response(content=metrics_text, media_type="text/plain")
+    if PROMETHEUS_ENABLED:
+        return Response(content=render_metrics(), media_type=CONTENT_TYPE_LATEST)
     return Response(content="Prometheus监控未启用", media_type="text/plain")
 
 # 包含API路由
 app.include_router(api_router)
 
+# 包含断点续传上传接口
+app.include_router(resumable_router)
+
+# 包含归档批量导入接口
+app.include_router(import_router)
+
 # 包含页面路由
 app.include_router(page_router)
 
+# 包含性能分析接口（未设置PROFILE_TOKEN时返回404）
+app.include_router(profiling_router)
+
 # 挂载静态文件目录
 app.mount("/static", StaticFiles(directory="static"), name="static")
-
-# 挂载上传目录
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads") 
\ No newline at end of file
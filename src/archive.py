@@ -0,0 +1,377 @@
+"""
+流式读取ZIP和tar归档
+
+批量导入时归档边上传边解析，不缓存整个归档，也不写入临时文件：
+ZIP按顺序读取每个条目前的本地文件头（不依赖位于文件末尾的中央目录），
+tar按512字节的头部块读取，.tar.gz在读取时解压。
+
+每个条目只保留在内存中直到交给调用方，只读取want(名称)为True且不超过max_size的条目，
+其余条目的数据直接跳过。deflate条目的解压输出不超过max_size，压缩炸弹不会占用大量内存。
+
+ZIP的限制：条目使用数据描述符（大小写在数据之后）时只支持deflate压缩，
+这种情况下存储方式（不压缩）的条目无法确定结束位置，遇到时停止读取。
+
+头部中的元数据（ZIP的文件名和扩展字段、tar的pax扩展头部和GNU长文件名）需要完整读入内存，
+ZIP中这些字段的长度本身不超过64KB，tar中超过MAX_METADATA_SIZE时视为归档格式错误。
+"""
+import struct
+import zlib
+from typing import AsyncIterator, Callable, NamedTuple, Optional
+
+ZIP_LOCAL_HEADER = b"PK\x03\x04"
+# 中央目录和结束记录，出现时所有条目已读取完毕
+_ZIP_END_SIGNATURES = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06", b"PK\x06\x07")
+_ZIP_DESCRIPTOR = b"PK\x07\x08"
+_ZIP_FLAG_ENCRYPTED = 0x01
+_ZIP_FLAG_DESCRIPTOR = 0x08
+_ZIP_FLAG_UTF8 = 0x800
+
+_TAR_BLOCK = 512
+_GZIP_MAGIC = b"\x1f\x8b"
+# 每次从流中读取或解压的字节数
+_READ_SIZE = 64 * 1024
+# 读入内存的单个元数据记录的上限，正常的扩展头部只有几百字节
+MAX_METADATA_SIZE = 64 * 1024
+
+class ArchiveError(Exception):
+    """归档格式错误或不完整，无法继续读取后续条目"""
+
+class ArchiveEntry(NamedTuple):
+    name: str
+    # 条目内容，被跳过或读取失败时为None
+    data: Optional[bytes]
+    # 读取失败的原因；data和error都为None表示want返回了False
+    error: Optional[str]
+
+class ByteStream:
+    """在异步字节块迭代器上提供按长度读取、预读和回退"""
+
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        self._chunks = chunks.__aiter__()
+        self._buffer = bytearray()
+        self._eof = False
+        # 从底层迭代器收到的字节数（压缩流为压缩后的大小）
+        self.bytes_read = 0
+
+    async def _fill(self, size: int):
+        while len(self._buffer) < size and not self._eof:
+            try:
+                chunk = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._eof = True
+                break
+            self.bytes_read += len(chunk)
+            self._buffer += chunk
+
+    async def peek(self, size: int) -> bytes:
+        """返回接下来的最多size个字节，不消耗它们"""
+        await self._fill(size)
+        return bytes(self._buffer[:size])
+
+    async def read(self, size: int) -> bytes:
+        """读取最多size个字节，只有在流结束时才会少于size"""
+        await self._fill(size)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def read_exact(self, size: int) -> bytes:
+        data = await self.read(size)
+        if len(data) < size:
+            raise ArchiveError("归档不完整，数据提前结束")
+        return data
+
+    async def read_some(self, limit: int = _READ_SIZE) -> bytes:
+        """读取已缓冲的数据（至少1字节，除非流已结束），不超过limit"""
+        if not self._buffer:
+            await self._fill(1)
+        return await self.read(min(limit, len(self._buffer)))
+
+    async def skip(self, size: int):
+        while size > 0:
+            data = await self.read_some(min(size, _READ_SIZE))
+            if not data:
+                raise ArchiveError("归档不完整，数据提前结束")
+            size -= len(data)
+
+    async def drain(self):
+        """读取并丢弃剩余数据"""
+        while await self.read_some():
+            pass
+
+    def unread(self, data: bytes):
+        """把多读的数据放回流的开头"""
+        self._buffer[:0] = data
+
+async def gunzip_chunks(stream: ByteStream, max_output: int = 0) -> AsyncIterator[bytes]:
+    """逐块解压gzip流（支持多个gzip成员），max_output大于0时限制解压后的总大小"""
+    decompressor = None
+    total = 0
+    while True:
+        data = await stream.read_some()
+        if not data:
+            if decompressor is not None:
+                raise ArchiveError("gzip数据不完整")
+            return
+        while data:
+            if decompressor is None:
+                if not data.strip(b"\x00"):
+                    # 最后一个成员之后的填充字节
+                    break
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            # 限制每次解压的输出，高压缩比的数据不会一次占用大量内存
+            output = decompressor.decompress(data, _READ_SIZE)
+            data = decompressor.unconsumed_tail
+            if output:
+                total += len(output)
+                if 0 < max_output < total:
+                    raise ArchiveError(f"解压后的数据超过限制 ({max_output / 1024 / 1024:.0f}MB)")
+                yield output
+            if decompressor.eof:
+                # 成员结束时剩余的输入都在unused_data中（unconsumed_tail可能与它重复）
+                data = decompressor.unused_data
+                decompressor = None
+
+def detect_format(head: bytes) -> Optional[str]:
+    """按开头的字节识别归档格式：zip、tar或tar.gz，无法识别时返回None"""
+    if head.startswith(ZIP_LOCAL_HEADER) or head.startswith(b"PK\x05\x06"):
+        return "zip"
+    if head.startswith(_GZIP_MAGIC):
+        return "tar.gz"
+    if len(head) >= _TAR_BLOCK and (head[257:262] == b"ustar" or _tar_checksum_ok(head[:_TAR_BLOCK])):
+        return "tar"
+    return None
+
+async def iter_entries(stream: ByteStream, format: str, want: Callable[[str], bool],
+                       max_size: int, max_expanded: int = 0) -> AsyncIterator[ArchiveEntry]:
+    """按归档中的顺序逐个返回文件条目（包括被跳过的），目录、链接等不返回"""
+    if format == "zip":
+        entries = iter_zip(stream, want, max_size)
+    elif format == "tar":
+        entries = iter_tar(stream, want, max_size)
+    elif format == "tar.gz":
+        entries = iter_tar(ByteStream(gunzip_chunks(stream, max_expanded)), want, max_size)
+    else:
+        raise ValueError(f"未知的归档格式: {format}")
+    async for entry in entries:
+        yield entry
+
+def _decode_zip_name(raw: bytes, flags: int) -> str:
+    if flags & _ZIP_FLAG_UTF8:
+        return raw.decode("utf-8", errors="replace")
+    # 没有UTF-8标志时依次尝试UTF-8和GBK（中文Windows创建的ZIP），最后按规范使用cp437
+    for encoding in ("utf-8", "gbk"):
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return raw.decode("cp437")
+
+def _zip64_sizes(extra: bytes, csize: int, usize: int) -> tuple:
+    """从ZIP64扩展字段中取出实际的压缩前后大小"""
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<HH", extra, offset)
+        body = extra[offset + 4:offset + 4 + length]
+        if header_id == 0x0001:
+            values = [struct.unpack_from("<Q", body, i)[0] for i in range(0, len(body) - 7, 8)]
+            # 只有头部中为0xFFFFFFFF的字段出现在扩展字段中，顺序为原始大小、压缩后大小
+            if usize == 0xFFFFFFFF and values:
+                usize = values.pop(0)
+            if csize == 0xFFFFFFFF and values:
+                csize = values.pop(0)
+            return csize, usize, True
+        offset += 4 + length
+    return csize, usize, False
+
+async def _inflate(stream: ByteStream, csize: Optional[int], max_size: int) -> tuple:
+    """
+    解压一个deflate条目，返回 (内容, 是否超过max_size)
+
+    csize已知时只读取csize字节；未知时（数据描述符）读到deflate流结束为止，多读的字节放回流中。
+    超过max_size后不再保留输出，已知csize时直接跳过剩余的压缩数据
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    output = bytearray()
+    oversized = False
+    remaining = csize
+    while not decompressor.eof:
+        if remaining is not None:
+            if remaining <= 0:
+                raise ArchiveError("ZIP条目的压缩数据不完整")
+            if oversized:
+                await stream.skip(remaining)
+                return None, True
+        data = await stream.read_some(_READ_SIZE if remaining is None else min(_READ_SIZE, remaining))
+        if not data:
+            raise ArchiveError("归档不完整，数据提前结束")
+        if remaining is not None:
+            remaining -= len(data)
+        while data and not decompressor.eof:
+            if oversized:
+                # 大小未知时只能继续解压才能找到条目的结束位置，输出直接丢弃
+                decompressor.decompress(data, _READ_SIZE)
+            else:
+                output += decompressor.decompress(data, max_size + 1 - len(output))
+                if len(output) > max_size:
+                    oversized = True
+                    output = bytearray()
+            data = decompressor.unconsumed_tail
+        if decompressor.eof:
+            # deflate流之后的输入都在unused_data中，放回流中继续读取
+            stream.unread(decompressor.unused_data)
+    if remaining:
+        await stream.skip(remaining)
+    return (None if oversized else bytes(output)), oversized
+
+async def iter_zip(stream: ByteStream, want: Callable[[str], bool], max_size: int) -> AsyncIterator[ArchiveEntry]:
+    """按本地文件头顺序读取ZIP条目，遇到中央目录时结束"""
+    while True:
+        signature = await stream.read(4)
+        if not signature or signature in _ZIP_END_SIGNATURES:
+            # 中央目录之后没有更多条目，读完剩余数据以便正常结束请求
+            await stream.drain()
+            return
+        if signature != ZIP_LOCAL_HEADER:
+            raise ArchiveError("ZIP文件头无效")
+
+        (_, flags, method, _, _, crc, csize, usize, name_length, extra_length) = struct.unpack(
+            "<HHHHHIIIHH", await stream.read_exact(26)
+        )
+        raw_name = await stream.read_exact(name_length)
+        if not raw_name or b"\x00" in raw_name:
+            # 没有文件名的头部来自损坏的数据，不作为条目返回
+            raise ArchiveError("ZIP文件头无效")
+        name = _decode_zip_name(raw_name, flags)
+        csize, usize, is_zip64 = _zip64_sizes(await stream.read_exact(extra_length), csize, usize)
+        has_descriptor = bool(flags & _ZIP_FLAG_DESCRIPTOR)
+        # 使用数据描述符时头部中的大小通常为0
+        known_size = not has_descriptor or csize > 0
+
+        is_file = not name.endswith("/")
+        wanted = is_file and want(name)
+        data, error = None, None
+        if flags & _ZIP_FLAG_ENCRYPTED or method not in (0, 8):
+            if not known_size:
+                raise ArchiveError(f"无法跳过加密或不支持的压缩方式的条目: {name}")
+            await stream.skip(csize)
+            error = "不支持加密的条目" if flags & _ZIP_FLAG_ENCRYPTED else f"不支持的压缩方式 ({method})"
+        elif method == 0:
+            if not known_size:
+                raise ArchiveError(f"无法确定未压缩条目的大小: {name}")
+            if not wanted or csize > max_size:
+                await stream.skip(csize)
+                error = "文件大小超过限制" if wanted else None
+            else:
+                data = await stream.read_exact(csize)
+        elif wanted:
+            data, oversized = await _inflate(stream, csize if known_size else None, max_size)
+            error = "文件大小超过限制" if oversized else None
+        elif known_size:
+            await stream.skip(csize)
+        else:
+            await _inflate(stream, None, 0)
+
+        if has_descriptor:
+            if await stream.peek(4) == _ZIP_DESCRIPTOR:
+                await stream.read_exact(4)
+            descriptor = await stream.read_exact(20 if is_zip64 else 12)
+            crc = struct.unpack_from("<I", descriptor)[0]
+
+        if data is not None and zlib.crc32(data) != crc:
+            data, error = None, "CRC校验失败，文件已损坏"
+        if is_file:
+            yield ArchiveEntry(name, data, error if wanted else None)
+
+def _tar_checksum_ok(header: bytes) -> bool:
+    try:
+        expected = int(header[148:156].split(b"\x00")[0].strip() or b"0", 8)
+    except ValueError:
+        return False
+    # 计算校验和时校验和字段本身按8个空格计算
+    actual = sum(header[:148]) + 8 * 0x20 + sum(header[156:])
+    return expected == actual
+
+def _tar_number(field: bytes) -> int:
+    if field and field[0] & 0x80:
+        # GNU的base-256编码，用于超过8GB的大小
+        return int.from_bytes(field[1:], "big")
+    return int(field.split(b"\x00")[0].strip() or b"0", 8)
+
+def _tar_string(field: bytes) -> str:
+    return field.split(b"\x00")[0].decode("utf-8", errors="replace")
+
+def _parse_pax(data: bytes) -> dict:
+    """解析pax扩展头部中"长度 键=值\\n"格式的记录"""
+    records = {}
+    offset = 0
+    while offset < len(data):
+        space = data.find(b" ", offset)
+        if space < 0:
+            break
+        try:
+            length = int(data[offset:space])
+        except ValueError:
+            break
+        if length <= 0:
+            break
+        key, _, value = data[space + 1:offset + length - 1].partition(b"=")
+        records[key.decode("utf-8", errors="replace")] = value.decode("utf-8", errors="replace")
+        offset += length
+    return records
+
+async def iter_tar(stream: ByteStream, want: Callable[[str], bool], max_size: int) -> AsyncIterator[ArchiveEntry]:
+    """按头部块顺序读取tar中的普通文件，支持ustar、pax和GNU长文件名"""
+    long_name = None
+    pax = {}
+    while True:
+        header = await stream.read(_TAR_BLOCK)
+        if len(header) < _TAR_BLOCK or not header.strip(b"\x00"):
+            # 全零块表示归档结束
+            await stream.drain()
+            return
+        if not _tar_checksum_ok(header):
+            raise ArchiveError("tar头部校验和错误")
+
+        type_flag = header[156:157]
+        try:
+            size = int(pax["size"]) if "size" in pax else _tar_number(header[124:136])
+        except ValueError:
+            raise ArchiveError("tar头部中的大小无效")
+        if size < 0:
+            raise ArchiveError("tar头部中的大小无效")
+        padding = -size % _TAR_BLOCK
+
+        if type_flag in (b"x", b"L"):
+            # 描述下一个条目的扩展头部，内容很小，直接读取
+            if size > MAX_METADATA_SIZE:
+                raise ArchiveError(f"tar扩展头部过大 ({size} > {MAX_METADATA_SIZE} 字节)")
+            data = await stream.read_exact(size)
+            await stream.skip(padding)
+            if type_flag == b"x":
+                pax = _parse_pax(data)
+            else:
+                long_name = data.split(b"\x00")[0].decode("utf-8", errors="replace")
+            continue
+
+        name = _tar_string(header[:100])
+        if header[257:262] == b"ustar":
+            prefix = _tar_string(header[345:500])
+            if prefix:
+                name = f"{prefix}/{name}"
+        name = pax.get("path") or long_name or name
+        long_name = None
+        pax = {}
+        if not name:
+            raise ArchiveError("tar头部中缺少文件名")
+
+        is_file = type_flag in (b"0", b"\x00", b"7")
+        wanted = is_file and want(name)
+        if wanted and size <= max_size:
+            data = await stream.read_exact(size)
+            await stream.skip(padding)
+            yield ArchiveEntry(name, data, None)
+            continue
+        await stream.skip(size + padding)
+        if is_file:
+            yield ArchiveEntry(name, None, "文件大小超过限制" if wanted else None)
@@ -0,0 +1,130 @@
+"""
+请求体大小限制
+
+在路由解析multipart之前限制请求体：声明的Content-Length超过限制时不读取请求体，直接返回413；
+没有Content-Length（分块传输）或声明不实时，在读取过程中累计字节数，超过限制时立即中止。
+multipart请求同时统计分隔符出现的次数，限制每个请求的部分（文件和字段）数量。
+超大的请求只消耗读取到限制为止的流量，不会被解析或写入临时文件。
+
+不同路径使用不同的限制，按最长前缀匹配BODY_LIMITS，未匹配的路径使用MAX_REQUEST_BODY。
+"""
+import logging
+import os
+from typing import List, Optional, Tuple
+
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+MAX_REQUEST_BODY = int(os.getenv("MAX_REQUEST_BODY", 1024 * 1024))  # 默认的请求体上限(字节)
+UPLOAD_MAX_BODY = int(os.getenv("UPLOAD_MAX_BODY", 100 * 1024 * 1024))  # 上传接口的请求体上限(字节)，多文件上传时为总大小
+RESUMABLE_MAX_CHUNK = int(os.getenv("RESUMABLE_MAX_CHUNK", 16 * 1024 * 1024))  # 断点续传每个块（PATCH请求体）的上限(字节)
+IMPORT_MAX_BODY = int(os.getenv("IMPORT_MAX_BODY", 2 * 1024 * 1024 * 1024))  # 批量导入归档的请求体上限(字节)，tar.gz同时限制解压后的大小
+MULTIPART_MAX_PARTS = int(os.getenv("MULTIPART_MAX_PARTS", 50))  # 每个multipart请求最多包含的部分数量
+
+# (路径前缀, 请求体上限)，按最长前缀匹配
+BODY_LIMITS: List[Tuple[str, int]] = [
+    ("/upload", UPLOAD_MAX_BODY),
+    ("/upload/resumable", RESUMABLE_MAX_CHUNK),
+    ("/upload/import", IMPORT_MAX_BODY),
+]
+
+def body_limit_for(path: str) -> int:
+    """路径对应的请求体上限，0表示不限制"""
+    best, limit = -1, MAX_REQUEST_BODY
+    for prefix, prefix_limit in BODY_LIMITS:
+        if (path == prefix or path.startswith(prefix.rstrip("/") + "/")) and len(prefix) > best:
+            best, limit = len(prefix), prefix_limit
+    return limit
+
+def _multipart_boundary(content_type: str) -> Optional[bytes]:
+    """从Content-Type中取出multipart分隔符，不是multipart时返回None"""
+    media_type, _, params = content_type.partition(";")
+    if not media_type.strip().lower().startswith("multipart/"):
+        return None
+    for param in params.split(";"):
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary" and value:
+            return value.strip('"').encode("latin-1")
+    return None
+
+def _too_large(limit: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"请求体过大 (上限 {limit / 1024 / 1024:.1f}MB)")
+
+class BodyLimitMiddleware:
+    """按路径限制请求体大小和multipart部分数量的ASGI中间件"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            await self.app(scope, receive, send)
+            return
+
+        limit = body_limit_for(scope["path"])
+        content_length = None
+        content_type = ""
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    content_length = None
+            elif name == b"content-type":
+                content_type = value.decode("latin-1")
+
+        if limit > 0 and content_length is not None and content_length > limit:
+            logger.warning(f"请求体超过限制，未读取即拒绝: {scope['path']} ({content_length} > {limit} 字节)")
+            error = _too_large(limit)
+            await JSONResponse({"detail": error.detail}, status_code=413, headers={"Connection": "close"})(
+                scope, receive, send
+            )
+            return
+
+        boundary = _multipart_boundary(content_type)
+        delimiter = b"--" + boundary if boundary else None
+        received = 0
+        delimiters = 0
+        tail = b""
+
+        async def receive_wrapper():
+            nonlocal received, delimiters, tail
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            body = message.get("body", b"")
+            received += len(body)
+            if limit > 0 and received > limit:
+                logger.warning(f"请求体超过限制，已中止读取: {scope['path']} (> {limit} 字节)")
+                raise _too_large(limit)
+            if delimiter is not None and body:
+                # 保留上一块末尾不足一个分隔符长度的字节，跨块的分隔符也能被统计且不会重复
+                data = tail + body
+                delimiters += data.count(delimiter)
+                tail = data[-(len(delimiter) - 1):]
+                # 第一个分隔符之后每个分隔符开始一个部分，最后一个为结束分隔符
+                if MULTIPART_MAX_PARTS > 0 and delimiters - 1 > MULTIPART_MAX_PARTS:
+                    logger.warning(f"multipart部分数量超过限制: {scope['path']} (> {MULTIPART_MAX_PARTS})")
+                    raise HTTPException(status_code=413, detail=f"请求包含的文件或字段过多 (上限 {MULTIPART_MAX_PARTS} 个)")
+            return message
+
+        response_started = False
+
+        async def send_wrapper(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except HTTPException as e:
+            # 路由之外读取请求体时（如中间件中）抛出的限制错误在这里转换为响应
+            if e.status_code != 413 or response_started:
+                raise
+            await JSONResponse({"detail": e.detail}, status_code=413, headers={"Connection": "close"})(
+                scope, receive, send
+            )
@@ -0,0 +1,356 @@
+"""
+ZIP/tar归档批量导入
+
+迁移已有图库时，把整个归档作为请求体发送到 POST /upload/import，不需要逐个文件调用/upload：
+    curl -N -H "Content-Type: application/zip" --data-binary @gallery.zip http://localhost:8000/upload/import
+
+归档边接收边解析（见archive.py），按扩展名过滤后每个条目经过与/upload相同的检查和处理：
+识别文件头、配额、写入、优化和内容检测；最多IMPORT_CONCURRENCY个条目同时处理，
+内存中最多只有这些条目的内容。处理完成的图片每IMPORT_COMMIT_BATCH个在一个事务中
+写入图片记录、上传日志和短链接，而不是每张图片提交三次。
+
+响应为NDJSON（每行一个JSON对象），按完成顺序返回：
+    {"type": "file", ...}      已导入（所在批次已提交），包含URL和短链接
+    {"type": "error", ...}     条目导入失败
+    {"type": "skipped", ...}   扩展名不支持、隐藏文件等被跳过的条目
+    {"type": "progress", ...}  每提交一批后的累计数量
+    {"type": "summary", ...}   最后一行，归档读取出错时包含error
+归档读取在后台任务中进行，客户端在上传完成前不读取响应也不会阻塞导入。
+客户端断开时停止导入，已提交的批次保留，尚未提交的图片被删除。
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from typing import AsyncIterator, List, Optional
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.requests import ClientDisconnect
+
+from src.archive import ArchiveError, ByteStream, detect_format, iter_entries
+from src.body_limit import IMPORT_MAX_BODY
+from src.database import Image, UploadLog, ShortLink
+from src.data_access import run_db
+from src.phash import to_signed
+from src.quota import reserve_quota, release_quota
+from src.routes import MAX_SIZE, upload_semaphore, process_image, read_processed_header
+from src.session import get_or_create_session
+from src.sniff import SNIFF_BYTES, sniff_format, probe_image
+from src.storage import write_upload, delete_path, run_io
+from src.utils import allowed_file
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", 4))  # 同时处理的条目数量
+IMPORT_COMMIT_BATCH = int(os.getenv("IMPORT_COMMIT_BATCH", 50))  # 每个事务写入的图片数量
+IMPORT_MAX_FILES = int(os.getenv("IMPORT_MAX_FILES", 10000))  # 每个归档最多导入的图片数量，0表示不限制
+
+# 短链接编码与同时创建的其他短链接冲突时的重试次数
+_CODE_RETRIES = 3
+
+# 创建路由器
+router = APIRouter()
+
+class _NDJSONResponse(StreamingResponse):
+    """
+    不监听客户端断开的流式响应
+
+    StreamingResponse在发送响应的同时读取receive()等待断开消息，
+    会取走还没有读取的请求体；导入在发送进度时仍在读取请求体，断开由读取请求体时的异常发现
+    """
+    media_type = "application/x-ndjson"
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+def _skip_reason(name: str) -> Optional[str]:
+    """不导入的条目返回原因"""
+    parts = name.replace("\\", "/").split("/")
+    basename = parts[-1]
+    # macOS打包时附带的资源文件（__MACOSX/、._开头）和其他隐藏文件
+    if "__MACOSX" in parts or basename.startswith("."):
+        return "隐藏文件"
+    if not allowed_file(basename):
+        return "不支持的文件类型"
+    return None
+
+def _new_codes(db: Session, count: int) -> List[str]:
+    """生成count个尚未使用的短链接编码"""
+    codes = set()
+    while len(codes) < count:
+        candidates = {ShortLink.generate_code() for _ in range(count - len(codes))} - codes
+        existing = {code for (code,) in db.query(ShortLink.code).filter(ShortLink.code.in_(candidates))}
+        codes |= candidates - existing
+    return list(codes)
+
+def _insert_batch(db: Session, rows: List[dict], user_id: Optional[str], client_ip: str,
+                  user_agent: str) -> List[str]:
+    """在一个事务中写入一批图片记录、上传日志和永久短链接，返回每张图片的短链接编码"""
+    for attempt in range(_CODE_RETRIES):
+        codes = _new_codes(db, len(rows))
+        for row, code in zip(rows, codes):
+            db.add(Image(
+                filename=row["filename"],
+                original_filename=row["original_filename"],
+                file_size=row["size"],
+                upload_ip=client_ip,
+                user_id=user_id,
+                mime_type=row["mime_type"],
+                width=row["width"],
+                height=row["height"],
+                phash=row["phash"],
+            ))
+            db.add(UploadLog(
+                original_filename=row["original_filename"],
+                saved_filename=row["filename"],
+                status="success",
+                file_size=row["size"],
+                ip_address=client_ip,
+                user_agent=user_agent,
+                user_id=user_id,
+            ))
+            db.add(ShortLink(code=code, target_file=row["filename"], user_id=user_id))
+        try:
+            db.commit()
+            return codes
+        except IntegrityError:
+            db.rollback()
+            if attempt == _CODE_RETRIES - 1:
+                raise
+            logger.warning("批量导入的短链接编码冲突，重新生成后重试")
+
+class _Import:
+    """一次导入的状态：进行中的条目、等待提交的图片和统计"""
+
+    def __init__(self, request: Request, user_id: Optional[str], stream: ByteStream):
+        self.user_id = user_id
+        self.stream = stream
+        self.client_ip = request.client.host if request.client else "unknown"
+        self.user_agent = request.headers.get("user-agent", "unknown")
+        self.base_url = f"{request.url.scheme}://{request.url.netloc}"
+        self.lines: asyncio.Queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(IMPORT_CONCURRENCY)
+        self.commit_lock = asyncio.Lock()
+        self.tasks = set()
+        self.pending: List[dict] = []
+        self.stats = {"entries": 0, "imported": 0, "failed": 0, "skipped": 0}
+        self.started = time.monotonic()
+
+    def emit(self, line: dict):
+        self.lines.put_nowait(json.dumps(line, ensure_ascii=False) + "\n")
+
+    def fail(self, name: str, error: str, code: Optional[str] = None):
+        self.stats["failed"] += 1
+        line = {"type": "error", "name": name, "error": error}
+        if code:
+            line["code"] = code
+        self.emit(line)
+
+    async def submit(self, name: str, data: bytes):
+        """等待空闲的处理槽位后在后台处理条目，槽位全部占用时暂停读取归档"""
+        await self.slots.acquire()
+        task = asyncio.create_task(self._process(name, data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _process(self, name: str, data: bytes):
+        original_filename = os.path.basename(name.replace("\\", "/"))
+        upload_bytes = len(data)
+        reserved = False
+        file_location = None
+        handed_off = False
+        try:
+            # 与/upload相同：按文件头识别真实格式，拒绝损坏的文件和像素数过多的图片
+            head = data[:SNIFF_BYTES]
+            image_format = sniff_format(head)
+            if image_format is None:
+                self.fail(name, "文件内容不是支持的图片格式", "invalid_image")
+                return
+            image_info, probe_error = probe_image(image_format, head, data)
+            if probe_error:
+                self.fail(name, probe_error, "invalid_image")
+                return
+
+            quota_error = await run_db(reserve_quota, self.user_id, upload_bytes)
+            if quota_error:
+                self.fail(name, quota_error, "quota_exceeded")
+                return
+            reserved = True
+
+            filename = f"{uuid.uuid4().hex}{os.path.splitext(original_filename)[1].lower()}"
+            async with upload_semaphore:
+                file_location, _ = await write_upload(filename, data)
+                data = None
+                processed, phash = await process_image(file_location, original_filename, self.client_ip,
+                                                       self.user_agent)
+                if not processed:
+                    self.fail(name, "图片处理失败")
+                    return
+                # 与/upload相同：按处理后的文件记录大小、尺寸和类型，PIL无法解析的SVG使用识别时的信息
+                width, height, mime_type = await read_processed_header(file_location, image_info)
+                size = await run_io("stat", os.path.getsize, file_location)
+
+            self.pending.append({
+                "name": name,
+                "filename": filename,
+                "original_filename": original_filename,
+                "file_location": file_location,
+                "upload_bytes": upload_bytes,
+                "size": size / 1024,
+                "mime_type": mime_type,
+                "width": width,
+                "height": height,
+                "phash": to_signed(phash) if phash is not None else None,
+            })
+            handed_off = True
+            if len(self.pending) >= IMPORT_COMMIT_BATCH:
+                await self.flush()
+        except Exception as e:
+            # 异常信息可能包含服务器上的路径，只记录在日志中
+            logger.error(f"导入条目失败: {name}, {str(e)}", exc_info=True)
+            self.fail(name, "导入图片失败", "import_failed")
+        finally:
+            # 交给批次之前失败或被取消时释放额度并删除已写入的文件
+            if not handed_off:
+                if reserved:
+                    await release_quota(self.user_id, upload_bytes)
+                if file_location:
+                    try:
+                        await delete_path(file_location)
+                    except OSError:
+                        pass
+            self.slots.release()
+
+    async def flush(self):
+        """提交等待中的图片，提交成功后才返回这些图片的URL"""
+        async with self.commit_lock:
+            rows, self.pending = self.pending, []
+            if not rows:
+                return
+            try:
+                codes = await run_db(_insert_batch, rows, self.user_id, self.client_ip, self.user_agent)
+            except Exception as e:
+                logger.error(f"批量导入提交失败: {len(rows)} 张图片, {str(e)}")
+                for row in rows:
+                    self.fail(row["name"], "保存图片记录失败")
+                    try:
+                        await delete_path(row["file_location"])
+                    except OSError:
+                        pass
+                return
+            finally:
+                # 提交后图片已计入用量计数，提交失败时文件已删除，两种情况都释放预留的额度
+                await release_quota(self.user_id, *(row["upload_bytes"] for row in rows))
+
+            for row, code in zip(rows, codes):
+                url = f"{self.base_url}/images/{row['filename']}"
+                self.emit({
+                    "type": "file",
+                    "name": row["name"],
+                    "filename": row["filename"],
+                    "original_filename": row["original_filename"],
+                    "url": url,
+                    "short_code": code,
+                    "short_url": f"{self.base_url}/s/{code}",
+                    "size": row["size"],
+                    "mime_type": row["mime_type"],
+                })
+            self.stats["imported"] += len(rows)
+            self.emit({"type": "progress", **self.stats, "received_bytes": self.stream.bytes_read})
+
+    async def discard(self):
+        """放弃尚未提交的图片"""
+        rows, self.pending = self.pending, []
+        await release_quota(self.user_id, *(row["upload_bytes"] for row in rows))
+        for row in rows:
+            try:
+                await delete_path(row["file_location"])
+            except OSError:
+                pass
+
+    async def run(self, format: str):
+        """读取归档并处理所有条目，最后一行为汇总"""
+        error = None
+        try:
+            async for entry in iter_entries(self.stream, format, lambda name: _skip_reason(name) is None,
+                                            MAX_SIZE, IMPORT_MAX_BODY):
+                self.stats["entries"] += 1
+                if entry.data is None and entry.error is None:
+                    self.stats["skipped"] += 1
+                    self.emit({"type": "skipped", "name": entry.name, "reason": _skip_reason(entry.name)})
+                    continue
+                if IMPORT_MAX_FILES > 0 and self.stats["entries"] - self.stats["skipped"] > IMPORT_MAX_FILES:
+                    error = f"归档中的图片超过数量上限 ({IMPORT_MAX_FILES} 张)，其余条目未导入"
+                    break
+                if entry.error:
+                    self.fail(entry.name, entry.error)
+                    continue
+                await self.submit(entry.name, entry.data)
+        except ArchiveError as e:
+            error = str(e)
+        except StarletteHTTPException as e:
+            # 请求体超过IMPORT_MAX_BODY时由BodyLimitMiddleware在读取中抛出
+            error = str(e.detail)
+        except ClientDisconnect:
+            logger.warning(f"批量导入时客户端断开连接，已导入 {self.stats['imported']} 张")
+            raise
+
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.flush()
+
+        summary = {"type": "summary", **self.stats, "received_bytes": self.stream.bytes_read,
+                   "seconds": round(time.monotonic() - self.started, 3)}
+        if error:
+            summary["error"] = error
+            logger.warning(f"批量导入中止: {error}")
+        logger.info(f"批量导入完成: 导入 {self.stats['imported']} 张，失败 {self.stats['failed']} 个，"
+                    f"跳过 {self.stats['skipped']} 个 ({summary['seconds']}s)")
+        self.emit(summary)
+
+    async def lines_until_done(self, format: str) -> AsyncIterator[str]:
+        """在后台任务中导入，同时按产生的顺序返回NDJSON行"""
+        done = object()
+        runner = asyncio.create_task(self.run(format))
+        # 任务结束后才放入结束标记，此前产生的行都已在队列中
+        runner.add_done_callback(lambda _: self.lines.put_nowait(done))
+        try:
+            while True:
+                line = await self.lines.get()
+                if line is done:
+                    break
+                yield line
+            runner.result()
+        except ClientDisconnect:
+            pass
+        finally:
+            # 发送响应失败（客户端断开）时停止读取归档和处理中的条目
+            tasks = [runner, *self.tasks]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.discard()
+
+@router.post("/upload/import", tags=["图片"], summary="批量导入归档",
+             description="上传ZIP或tar归档，逐个导入其中的图片，以NDJSON流式返回进度")
+async def import_archive(request: Request, response: Response):
+    """边接收边解析归档，每个图片条目经过与/upload相同的处理流程"""
+    _, user_id = get_or_create_session(request, response)
+    stream = ByteStream(request.stream())
+    format = detect_format(await stream.peek(512))
+    if format is None:
+        raise HTTPException(status_code=400, detail="请求体不是支持的归档格式（ZIP、tar或tar.gz）")
+
+    logger.info(f"开始批量导入: 格式={format}, user_id={user_id}")
+    job = _Import(request, user_id, stream)
+    # 会话Cookie设置在response上，直接返回的响应需要带上这些响应头
+    return _NDJSONResponse(job.lines_until_done(format), headers=response.headers)
@@ -0,0 +1,150 @@
+import logging
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+from src.database import Image, UploadLog, ShortLink
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+# 全局计数使用的user_id
+GLOBAL = ""
+
+# 维护的计数器
+# images: 图片数量；logs: 上传日志数量；links: 短链接数量（按短链接自身的user_id）
+# image_links: 指向该用户图片的短链接数量（按图片上传者）
+# bytes: 图片文件的总字节数，用于存储配额
+COUNTER_NAMES = ("images", "logs", "links", "image_links", "bytes")
+
+# 重新统计所有计数器的SQL，迁移初始化和定期校准共用
+RECOMPUTE_SQL = (
+    "INSERT INTO {table} (name, user_id, value) SELECT 'images', '', COUNT(*) FROM images",
+    "INSERT INTO {table} (name, user_id, value) "
+    "SELECT 'images', user_id, COUNT(*) FROM images WHERE user_id IS NOT NULL GROUP BY user_id",
+    "INSERT INTO {table} (name, user_id, value) SELECT 'logs', '', COUNT(*) FROM upload_logs",
+    "INSERT INTO {table} (name, user_id, value) "
+    "SELECT 'logs', user_id, COUNT(*) FROM upload_logs WHERE user_id IS NOT NULL GROUP BY user_id",
+    "INSERT INTO {table} (name, user_id, value) SELECT 'links', '', COUNT(*) FROM short_links",
+    "INSERT INTO {table} (name, user_id, value) "
+    "SELECT 'links', user_id, COUNT(*) FROM short_links WHERE user_id IS NOT NULL GROUP BY user_id",
+    "INSERT INTO {table} (name, user_id, value) "
+    "SELECT 'image_links', i.user_id, COUNT(*) FROM short_links s JOIN images i ON i.filename = s.target_file "
+    "WHERE i.user_id IS NOT NULL GROUP BY i.user_id",
+)
+
+# images.file_size的单位为KB，换算为整数字节，触发器和重新统计使用相同的取整方式
+FILE_BYTES_SQL = "CAST(ROUND(COALESCE({column}, 0) * 1024) AS INTEGER)"
+
+# 重新统计字节数的SQL，由迁移6添加，校准时与RECOMPUTE_SQL一起执行
+BYTES_RECOMPUTE_SQL = (
+    "INSERT INTO {table} (name, user_id, value) "
+    f"SELECT 'bytes', '', COALESCE(SUM({FILE_BYTES_SQL.format(column='file_size')}), 0) FROM images",
+    "INSERT INTO {table} (name, user_id, value) "
+    f"SELECT 'bytes', user_id, SUM({FILE_BYTES_SQL.format(column='file_size')}) FROM images "
+    "WHERE user_id IS NOT NULL GROUP BY user_id",
+)
+
+# 计数器表是否存在（由迁移创建，非SQLite数据库没有该表）
+_counters_available = None
+
+def has_counters(db: Session) -> bool:
+    """检查stat_counters表是否存在，结果在进程内缓存"""
+    global _counters_available
+    if _counters_available is None:
+        if db.get_bind().dialect.name != "sqlite":
+            _counters_available = False
+        else:
+            _counters_available = db.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stat_counters'")
+            ).first() is not None
+    return _counters_available
+
+def _count_directly(db: Session, name: str, user_id: str) -> int:
+    """没有计数器表时直接统计"""
+    if name == "images":
+        query = db.query(func.count(Image.id))
+        return (query if user_id == GLOBAL else query.filter(Image.user_id == user_id)).scalar() or 0
+    if name == "logs":
+        query = db.query(func.count(UploadLog.id))
+        return (query if user_id == GLOBAL else query.filter(UploadLog.user_id == user_id)).scalar() or 0
+    if name == "links":
+        query = db.query(func.count(ShortLink.id))
+        return (query if user_id == GLOBAL else query.filter(ShortLink.user_id == user_id)).scalar() or 0
+    if name == "bytes":
+        query = db.query(func.sum(Image.file_size))
+        kilobytes = (query if user_id == GLOBAL else query.filter(Image.user_id == user_id)).scalar() or 0
+        return int(round(kilobytes * 1024))
+    if name == "image_links":
+        return db.query(func.count(ShortLink.id)).join(
+            Image, ShortLink.target_file == Image.filename
+        ).filter(Image.user_id == user_id).scalar() or 0
+    raise ValueError(f"未知的计数器: {name}")
+
+def get_counters(db: Session, keys: Iterable[Tuple[str, Optional[str]]]) -> Dict[Tuple[str, Optional[str]], int]:
+    """
+    读取多个计数器，keys为 (计数器名, user_id) 列表，user_id为GLOBAL表示全局计数，
+    为None时计数为0（没有user_id的记录只计入全局计数）
+
+    计数器由数据库触发器在写入时同步更新，读取只需一次主键查询
+    """
+    keys = list(keys)
+    if not has_counters(db):
+        return {key: _count_directly(db, *key) if key[1] is not None else 0 for key in keys}
+
+    names = sorted({name for name, _ in keys})
+    user_ids = sorted({user_id for _, user_id in keys if user_id is not None})
+    rows = db.execute(
+        text("SELECT name, user_id, value FROM stat_counters "
+             "WHERE name IN :names AND user_id IN :user_ids").bindparams(
+            bindparam("names", expanding=True),
+            bindparam("user_ids", expanding=True)
+        ),
+        {"names": names, "user_ids": user_ids}
+    ).fetchall()
+    values = {(name, user_id): value for name, user_id, value in rows}
+    return {key: max(0, values.get(key, 0)) for key in keys}
+
+def reconcile_counters(db: Session) -> int:
+    """
+    重新统计所有计数器，修正触发器之外的修改（如手工编辑数据库）造成的偏差
+
+    在一个写事务中完成统计和替换，返回被修正的计数器数量
+    """
+    if not has_counters(db):
+        return 0
+    started = time.time()
+    # 先执行一条写语句取得写锁，统计期间的写入会等待，避免校准覆盖并发更新的计数
+    db.execute(text("UPDATE stat_counters SET value = value WHERE 0"))
+    db.execute(text("CREATE TEMP TABLE IF NOT EXISTS stat_counters_fresh "
+                    "(name TEXT NOT NULL, user_id TEXT NOT NULL, value INTEGER NOT NULL)"))
+    db.execute(text("DELETE FROM stat_counters_fresh"))
+    for sql in RECOMPUTE_SQL + BYTES_RECOMPUTE_SQL:
+        db.execute(text(sql.format(table="stat_counters_fresh")))
+    drift = db.execute(text("""
+        SELECT COUNT(*) FROM (
+            SELECT * FROM (
+                SELECT name, user_id, value FROM stat_counters_fresh WHERE value != 0
+                EXCEPT SELECT name, user_id, value FROM stat_counters WHERE value != 0
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT name, user_id, value FROM stat_counters WHERE value != 0
+                EXCEPT SELECT name, user_id, value FROM stat_counters_fresh WHERE value != 0
+            )
+        )
+    """)).scalar()
+    if drift:
+        db.execute(text("DELETE FROM stat_counters"))
+        db.execute(text("INSERT INTO stat_counters (name, user_id, value) "
+                        "SELECT name, user_id, value FROM stat_counters_fresh"))
+    db.execute(text("DELETE FROM stat_counters_fresh"))
+    db.commit()
+    if drift:
+        logger.warning(f"计数器校准完成，修正了 {drift} 个偏差 ({time.time() - started:.2f}s)")
+    else:
+        logger.debug(f"计数器校准完成，无偏差 ({time.time() - started:.2f}s)")
+    return drift
@@ -0,0 +1,134 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple, TypeVar
+
+from sqlalchemy.orm import Session
+
+from src.database import SessionLocal, Image, ShortLink
+from src.metrics import CACHE_REQUESTS
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+T = TypeVar("T")
+
+# 专用数据库线程池，所有路由中的同步SQLAlchemy操作都在这里执行，避免阻塞事件循环
+# 线程数不应超过连接池容量（DB_POOL_SIZE + DB_MAX_OVERFLOW）
+DB_EXECUTOR_SIZE = int(os.getenv("DB_EXECUTOR_SIZE", 8))
+db_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=DB_EXECUTOR_SIZE,
+    thread_name_prefix="picui_db"
+)
+
+async def run_db(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    在数据库线程池中执行同步数据库操作
+
+    fn的第一个参数为新建的数据库会话，会话在函数返回后关闭。
+    返回的ORM对象已与会话分离，只能访问已加载的属性，
+    因此fn中如果提交了事务，应返回普通数据而不是ORM对象。
+    """
+    def _call():
+        db = SessionLocal()
+        try:
+            return fn(db, *args, **kwargs)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, _call)
+
+# 图片元数据缓存，短链接访问和图片查看只需要MIME类型和原始文件名
+IMAGE_META_CACHE_SIZE = int(os.getenv("IMAGE_META_CACHE_SIZE", 10000))
+IMAGE_META_CACHE_TTL = int(os.getenv("IMAGE_META_CACHE_TTL", 300))  # 秒
+
+class ImageMetaCache:
+    """按文件名缓存图片元数据的LRU缓存，带过期时间"""
+
+    def __init__(self, name: str, max_size: int, ttl: int):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, Tuple[str, str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename: str) -> Optional[Tuple[str, str]]:
+        """读取缓存，未命中或已过期时返回None"""
+        with self._lock:
+            entry = self._data.get(filename)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.misses += 1
+                CACHE_REQUESTS.labels(self.name, "miss").inc()
+                return None
+            self._data.move_to_end(filename)
+            self.hits += 1
+            CACHE_REQUESTS.labels(self.name, "hit").inc()
+            return entry[1]
+
+    def set(self, filename: str, meta: Tuple[str, str]):
+        """写入缓存，超过容量时淘汰最久未使用的条目"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[filename] = (time.monotonic(), meta)
+            self._data.move_to_end(filename)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, *filenames: str):
+        """删除指定文件名的缓存"""
+        with self._lock:
+            for filename in filenames:
+                self._data.pop(filename, None)
+
+image_meta_cache = ImageMetaCache("image_meta", IMAGE_META_CACHE_SIZE, IMAGE_META_CACHE_TTL)
+
+def _load_image_meta(db: Session, filename: str) -> Optional[Tuple[str, str]]:
+    """从数据库读取图片的MIME类型和原始文件名"""
+    row = db.query(Image.mime_type, Image.original_filename).filter(Image.filename == filename).first()
+    if not row:
+        return None
+    return (row[0] or "image/jpeg", row[1] or filename)
+
+async def get_image_meta(filename: str) -> Optional[Tuple[str, str]]:
+    """
+    获取图片元数据 (mime_type, original_filename)
+
+    优先读取缓存，未命中时在数据库线程池中查询。
+    数据库中不存在的图片不会被缓存，避免上传过程中的查询缓存了空结果
+    """
+    meta = image_meta_cache.get(filename)
+    if meta is not None:
+        return meta
+    meta = await run_db(_load_image_meta, filename)
+    if meta is not None:
+        image_meta_cache.set(filename, meta)
+    return meta
+
+def delete_owned_short_link(db: Session, code: str, user_id: str) -> Optional[int]:
+    """
+    删除用户自己图片的短链接，成功返回None
+
+    短链接不存在时返回404，关联的图片属于其他用户时返回403
+    """
+    short_link = db.query(ShortLink).filter(ShortLink.code == code).first()
+    if not short_link:
+        return 404
+    # 检查权限（验证是否是该用户创建的短链接）
+    owner = db.query(Image.user_id).filter(Image.filename == short_link.target_file).first()
+    if owner and owner[0] != user_id:
+        logger.warning(f"用户({user_id})尝试删除其他用户({owner[0]})的短链接: {code}")
+        return 403
+    db.delete(short_link)
+    db.commit()
+    return None
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, BigInteger
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, BigInteger, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.sql import func
@@ -14,13 +14,76 @@ import sqlite3
 # 默认使用SQLite，但也可以通过环境变量使用其他数据库
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./picui.db")
 
+# SQLite存储配置，每个新连接建立时通过PRAGMA应用
+# 多个worker进程同时写入同一个数据库文件时，WAL模式允许读写并发，
+# busy_timeout让写锁冲突时等待而不是立即抛出 "database is locked"
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # 默认256MB
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", -64000))  # 负数单位为KB，默认约64MB
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))  # 毫秒
+SQLITE_TEMP_STORE = os.getenv("SQLITE_TEMP_STORE", "MEMORY")
+
+# 连接池配置
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))  # 秒
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 3600))  # 秒
+
+def get_sqlite_pragmas():
+    """返回要在每个SQLite连接上执行的PRAGMA配置（有序）"""
+    return [
+        ("journal_mode", SQLITE_JOURNAL_MODE),
+        ("synchronous", SQLITE_SYNCHRONOUS),
+        ("mmap_size", SQLITE_MMAP_SIZE),
+        ("cache_size", SQLITE_CACHE_SIZE),
+        ("busy_timeout", SQLITE_BUSY_TIMEOUT),
+        ("temp_store", SQLITE_TEMP_STORE),
+    ]
+
+def apply_sqlite_pragmas(dbapi_connection):
+    """在原始SQLite连接上应用存储配置，同时供迁移等直接使用sqlite3的代码调用"""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in get_sqlite_pragmas():
+            cursor.execute(f"PRAGMA {name}={value};")
+    finally:
+        cursor.close()
+
 # 创建数据库引擎
+def _is_sqlite_memory(url: str) -> bool:
+    """内存数据库（sqlite:// 或 :memory:）使用SingletonThreadPool，不接受QueuePool的参数"""
+    database = url.split("://", 1)[1] if "://" in url else ""
+    database = database.split("?", 1)[0].lstrip("/")
+    return database in ("", ":memory:") or "mode=memory" in url
+
 if DATABASE_URL.startswith("sqlite"):
+    # 连接池参数只用于文件数据库
+    pool_args = {} if _is_sqlite_memory(DATABASE_URL) else dict(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE
+    )
     engine = create_engine(
-        DATABASE_URL, connect_args={"check_same_thread": False}
+        DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        **pool_args
     )
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """每个新建的连接都应用SQLite存储配置"""
+        apply_sqlite_pragmas(dbapi_connection)
 else:
-    engine = create_engine(DATABASE_URL)
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True
+    )
 
 # 创建会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -43,6 +106,7 @@ class Image(Base):
     width = Column(Integer, nullable=True)  # 图片宽度
     height = Column(Integer, nullable=True)  # 图片高度
     description = Column(Text, nullable=True)  # 图片描述
+    phash = Column(BigInteger, nullable=True)  # 64位差值哈希（按有符号整数存储），用于查找相似图片
     
     def __repr__(self):
         return f"<Image {self.filename}>"
@@ -62,6 +126,12 @@ class UploadLog(Base):
     user_agent = Column(String, nullable=True)
     user_id = Column(String, index=True, nullable=True)  # 添加用户ID字段
     
+    # 日志页面按时间倒序的游标分页索引
+    __table_args__ = (
+        Index("idx_upload_logs_user_time", "user_id", "upload_time", "id"),
+        Index("idx_upload_logs_time", "upload_time", "id"),
+    )
+    
     def __repr__(self):
         return f"<UploadLog {self.original_filename} - {self.status}>"
 
@@ -78,6 +148,12 @@ class ShortLink(Base):
     is_enabled = Column(Boolean, default=True, nullable=True)  # 设置默认值为True，允许为空
     user_id = Column(String, index=True, nullable=True)  # 添加用户ID字段
     
+    # 后台清理按过期时间和禁用状态分批查找，只索引相关的行
+    __table_args__ = (
+        Index("idx_short_links_expire_at", "expire_at", sqlite_where=text("expire_at IS NOT NULL")),
+        Index("idx_short_links_disabled", "id", sqlite_where=text("is_enabled = 0")),
+    )
+    
     def is_expired(self):
         """检查链接是否已过期"""
         if self.expire_at is None:
@@ -113,184 +189,187 @@ def create_tables():
         logger.error(f"数据库表结构创建失败: {str(e)}", exc_info=True)
         raise
 
-# 升级数据库结构，添加缺失的列
-def upgrade_database():
-    """升级数据库表结构，添加缺失的列"""
+# 获取SQLite数据库文件路径
+def get_sqlite_path():
+    """从DATABASE_URL中提取SQLite数据库文件路径"""
+    db_path = "picui.db"
+    if DATABASE_URL.startswith("sqlite:///"):
+        db_path = DATABASE_URL.replace("sqlite:///", "").replace("./", "")
+    return db_path
+
+# 补齐旧数据库中缺失的表和列
+def upgrade_schema(cursor):
+    """
+    在给定的sqlite3游标上创建缺失的表并添加缺失的列
+    
+    不提交事务，由调用方（迁移执行器）负责提交。返回已添加的表和列列表
+    """
     logger = logging.getLogger("picui")
     
-    try:
-        # 从DATABASE_URL中提取数据库文件路径
-        db_path = "picui.db"
-        if DATABASE_URL.startswith("sqlite:///"):
-            db_path = DATABASE_URL.replace("sqlite:///", "").replace("./", "")
-        
-        logger.info(f"尝试连接数据库文件: {db_path}")
-        
-        # 连接数据库
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # 记录已添加的列
-        added_columns = []
-        
-        # 检查images表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='images';")
-        if not cursor.fetchone():
-            # images表不存在，创建表
-            logger.info("images表不存在，创建新表")
-            cursor.execute("""
-                CREATE TABLE images (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    filename TEXT UNIQUE,
-                    original_filename TEXT,
-                    file_size FLOAT,
-                    upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    upload_ip TEXT,
-                    user_id TEXT,
-                    mime_type TEXT DEFAULT 'image/jpeg',
-                    width INTEGER,
-                    height INTEGER,
-                    description TEXT
-                )
-            """)
-            cursor.execute("CREATE INDEX idx_images_filename ON images(filename);")
-            cursor.execute("CREATE INDEX idx_images_user_id ON images(user_id);")
-            added_columns.append("创建images表")
-        else:
-            # 获取images表的列信息
-            cursor.execute("PRAGMA table_info(images);")
-            existing_columns = [column[1] for column in cursor.fetchall()]
-            
-            # 需要检查的列
-            columns_to_check = {
-                "upload_ip": "TEXT",
-                "file_size": "FLOAT",
-                "width": "INTEGER",
-                "height": "INTEGER",
-                "description": "TEXT",
-                "user_id": "TEXT",
-                "mime_type": "TEXT DEFAULT 'image/jpeg'"
-            }
-            
-            # 检查并添加缺失的列
-            for col_name, col_type in columns_to_check.items():
-                if col_name not in existing_columns:
-                    try:
-                        sql = f"ALTER TABLE images ADD COLUMN {col_name} {col_type};"
-                        cursor.execute(sql)
-                        added_columns.append(f"images.{col_name}")
-                        logger.info(f"成功添加 {col_name} 列到 images 表")
-                    except sqlite3.OperationalError as e:
-                        if "duplicate column name" not in str(e).lower():
-                            logger.warning(f"无法添加 {col_name} 列到 images 表: {str(e)}")
+    # 记录已添加的列
+    added_columns = []
+    
+    # 检查images表是否存在
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='images';")
+    if not cursor.fetchone():
+        # images表不存在，创建表
+        logger.info("images表不存在，创建新表")
+        cursor.execute("""
+            CREATE TABLE images (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT UNIQUE,
+                original_filename TEXT,
+                file_size FLOAT,
+                upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                upload_ip TEXT,
+                user_id TEXT,
+                mime_type TEXT DEFAULT 'image/jpeg',
+                width INTEGER,
+                height INTEGER,
+                description TEXT
+            )
+        """)
+        cursor.execute("CREATE INDEX idx_images_filename ON images(filename);")
+        cursor.execute("CREATE INDEX idx_images_user_id ON images(user_id);")
+        added_columns.append("创建images表")
+    else:
+        # 获取images表的列信息
+        cursor.execute("PRAGMA table_info(images);")
+        existing_columns = [column[1] for column in cursor.fetchall()]
         
-        # 检查short_links表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='short_links';")
-        if not cursor.fetchone():
-            # short_links表不存在，创建表
-            logger.info("short_links表不存在，创建新表")
-            cursor.execute("""
-                CREATE TABLE short_links (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT UNIQUE,
-                    target_file TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    access_count INTEGER DEFAULT 0,
-                    expire_at TIMESTAMP,
-                    is_enabled BOOLEAN DEFAULT 1,
-                    user_id TEXT
-                )
-            """)
-            cursor.execute("CREATE INDEX idx_short_links_code ON short_links(code);")
-            cursor.execute("CREATE INDEX idx_short_links_target_file ON short_links(target_file);")
-            cursor.execute("CREATE INDEX idx_short_links_user_id ON short_links(user_id);")
-            added_columns.append("创建short_links表")
-        else:
-            # 获取short_links表的列信息
-            cursor.execute("PRAGMA table_info(short_links);")
-            existing_columns = [column[1] for column in cursor.fetchall()]
-            
-            # 需要检查的列
-            columns_to_check = {
-                "is_enabled": "BOOLEAN DEFAULT 1",
-                "user_id": "TEXT",
-                "access_count": "INTEGER DEFAULT 0",
-                "expire_at": "TIMESTAMP"
-            }
-            
-            # 检查并添加缺失的列
-            for col_name, col_type in columns_to_check.items():
-                if col_name not in existing_columns:
-                    try:
-                        sql = f"ALTER TABLE short_links ADD COLUMN {col_name} {col_type};"
-                        cursor.execute(sql)
-                        added_columns.append(f"short_links.{col_name}")
-                        logger.info(f"成功添加 {col_name} 列到 short_links 表")
-                    except sqlite3.OperationalError as e:
-                        if "duplicate column name" not in str(e).lower():
-                            logger.warning(f"无法添加 {col_name} 列到 short_links 表: {str(e)}")
+        # 需要检查的列
+        columns_to_check = {
+            "upload_ip": "TEXT",
+            "file_size": "FLOAT",
+            "width": "INTEGER",
+            "height": "INTEGER",
+            "description": "TEXT",
+            "user_id": "TEXT",
+            "mime_type": "TEXT DEFAULT 'image/jpeg'"
+        }
         
-        # 检查upload_logs表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='upload_logs';")
-        if not cursor.fetchone():
-            # upload_logs表不存在，创建表
-            logger.info("upload_logs表不存在，创建新表")
-            cursor.execute("""
-                CREATE TABLE upload_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    original_filename TEXT,
-                    saved_filename TEXT,
-                    status TEXT,
-                    file_size FLOAT,
-                    error_message TEXT,
-                    upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    ip_address TEXT,
-                    user_agent TEXT,
-                    user_id TEXT
-                )
-            """)
-            cursor.execute("CREATE INDEX idx_upload_logs_user_id ON upload_logs(user_id);")
-            added_columns.append("创建upload_logs表")
-        else:
-            # 获取upload_logs表的列信息
-            cursor.execute("PRAGMA table_info(upload_logs);")
-            existing_columns = [column[1] for column in cursor.fetchall()]
-            
-            # 需要检查的列
-            columns_to_check = {
-                "saved_filename": "TEXT",
-                "file_size": "FLOAT",
-                "user_id": "TEXT",
-                "user_agent": "TEXT"
-            }
-            
-            # 检查并添加缺失的列
-            for col_name, col_type in columns_to_check.items():
-                if col_name not in existing_columns:
-                    try:
-                        sql = f"ALTER TABLE upload_logs ADD COLUMN {col_name} {col_type};"
-                        cursor.execute(sql)
-                        added_columns.append(f"upload_logs.{col_name}")
-                        logger.info(f"成功添加 {col_name} 列到 upload_logs 表")
-                    except sqlite3.OperationalError as e:
-                        if "duplicate column name" not in str(e).lower():
-                            logger.warning(f"无法添加 {col_name} 列到 upload_logs 表: {str(e)}")
+        # 检查并添加缺失的列
+        for col_name, col_type in columns_to_check.items():
+            if col_name not in existing_columns:
+                try:
+                    sql = f"ALTER TABLE images ADD COLUMN {col_name} {col_type};"
+                    cursor.execute(sql)
+                    added_columns.append(f"images.{col_name}")
+                    logger.info(f"成功添加 {col_name} 列到 images 表")
+                except sqlite3.OperationalError as e:
+                    if "duplicate column name" not in str(e).lower():
+                        logger.warning(f"无法添加 {col_name} 列到 images 表: {str(e)}")
+    
+    # 检查short_links表是否存在
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='short_links';")
+    if not cursor.fetchone():
+        # short_links表不存在，创建表
+        logger.info("short_links表不存在，创建新表")
+        cursor.execute("""
+            CREATE TABLE short_links (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                code TEXT UNIQUE,
+                target_file TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                access_count INTEGER DEFAULT 0,
+                expire_at TIMESTAMP,
+                is_enabled BOOLEAN DEFAULT 1,
+                user_id TEXT
+            )
+        """)
+        cursor.execute("CREATE INDEX idx_short_links_code ON short_links(code);")
+        cursor.execute("CREATE INDEX idx_short_links_target_file ON short_links(target_file);")
+        cursor.execute("CREATE INDEX idx_short_links_user_id ON short_links(user_id);")
+        added_columns.append("创建short_links表")
+    else:
+        # 获取short_links表的列信息
+        cursor.execute("PRAGMA table_info(short_links);")
+        existing_columns = [column[1] for column in cursor.fetchall()]
         
-        # 提交所有更改
-        conn.commit()
+        # 需要检查的列
+        columns_to_check = {
+            "is_enabled": "BOOLEAN DEFAULT 1",
+            "user_id": "TEXT",
+            "access_count": "INTEGER DEFAULT 0",
+            "expire_at": "TIMESTAMP"
+        }
         
-        # 添加详细日志信息
-        if added_columns:
-            logger.info(f"数据库升级完成，添加了以下列: {', '.join(added_columns)}")
-        else:
-            logger.info("数据库结构已是最新，无需升级")
+        # 检查并添加缺失的列
+        for col_name, col_type in columns_to_check.items():
+            if col_name not in existing_columns:
+                try:
+                    sql = f"ALTER TABLE short_links ADD COLUMN {col_name} {col_type};"
+                    cursor.execute(sql)
+                    added_columns.append(f"short_links.{col_name}")
+                    logger.info(f"成功添加 {col_name} 列到 short_links 表")
+                except sqlite3.OperationalError as e:
+                    if "duplicate column name" not in str(e).lower():
+                        logger.warning(f"无法添加 {col_name} 列到 short_links 表: {str(e)}")
+    
+    # 检查upload_logs表是否存在
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='upload_logs';")
+    if not cursor.fetchone():
+        # upload_logs表不存在，创建表
+        logger.info("upload_logs表不存在，创建新表")
+        cursor.execute("""
+            CREATE TABLE upload_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                original_filename TEXT,
+                saved_filename TEXT,
+                status TEXT,
+                file_size FLOAT,
+                error_message TEXT,
+                upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                ip_address TEXT,
+                user_agent TEXT,
+                user_id TEXT
+            )
+        """)
+        cursor.execute("CREATE INDEX idx_upload_logs_user_id ON upload_logs(user_id);")
+        added_columns.append("创建upload_logs表")
+    else:
+        # 获取upload_logs表的列信息
+        cursor.execute("PRAGMA table_info(upload_logs);")
+        existing_columns = [column[1] for column in cursor.fetchall()]
         
-        # 关闭连接
-        conn.close()
+        # 需要检查的列
+        columns_to_check = {
+            "saved_filename": "TEXT",
+            "file_size": "FLOAT",
+            "user_id": "TEXT",
+            "user_agent": "TEXT"
+        }
         
-    except Exception as e:
-        logger.error(f"数据库升级失败: {str(e)}", exc_info=True)
-        raise
+        # 检查并添加缺失的列
+        for col_name, col_type in columns_to_check.items():
+            if col_name not in existing_columns:
+                try:
+                    sql = f"ALTER TABLE upload_logs ADD COLUMN {col_name} {col_type};"
+                    cursor.execute(sql)
+                    added_columns.append(f"upload_logs.{col_name}")
+                    logger.info(f"成功添加 {col_name} 列到 upload_logs 表")
+                except sqlite3.OperationalError as e:
+                    if "duplicate column name" not in str(e).lower():
+                        logger.warning(f"无法添加 {col_name} 列到 upload_logs 表: {str(e)}")
+    
+    # 添加详细日志信息
+    if added_columns:
+        logger.info(f"数据库升级完成，添加了以下列: {', '.join(added_columns)}")
+    else:
+        logger.info("数据库结构已是最新，无需升级")
+    
+    return added_columns
+
+# 升级数据库结构
+def upgrade_database():
+    """
+    升级数据库结构到最新版本
+    
+    实际的升级由src.migrations中的迁移执行器完成，
+    保留该函数以兼容 `python -c "from src.database import upgrade_database; upgrade_database()"`
+    """
+    from src.migrations import run_migrations
+    run_migrations()
 
 # 获取数据库会话
 def get_db():
@@ -299,10 +378,4 @@ def get_db():
         yield db
     finally:
         db.close()
-
-# 如果数据库文件不存在，则创建表
-if not os.path.exists("picui.db"):
-    create_tables()
-# 尝试升级数据库结构
-else:
-    upgrade_database() 
\ No newline at end of file
+ 
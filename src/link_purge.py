@@ -0,0 +1,71 @@
+"""
+过期和已禁用短链接的后台清理
+
+过期的短链接在SHORT_LINK_RETENTION秒的保留期后删除，保留期内访问仍返回"已过期"而不是"不存在"；
+已禁用的短链接无法再访问，直接删除。删除按过期时间索引和禁用状态的部分索引分批查找，
+每批单独提交并暂停SHORT_LINK_PURGE_SLEEP秒，让前台的写入在批次之间取得写锁；
+超过时间预算时停止，剩余的行在下次运行时继续删除。短链接计数由触发器同步更新。
+"""
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict
+
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.orm import Session
+
+from src.metrics import SHORT_LINKS_PURGED
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+SHORT_LINK_PURGE_INTERVAL = int(os.getenv("SHORT_LINK_PURGE_INTERVAL", 3600))  # 清理的间隔(秒)，0表示禁用
+SHORT_LINK_RETENTION = int(os.getenv("SHORT_LINK_RETENTION", 7 * 86400))  # 过期后保留的时间(秒)
+SHORT_LINK_PURGE_BATCH = int(os.getenv("SHORT_LINK_PURGE_BATCH", 500))  # 每批删除的行数
+SHORT_LINK_PURGE_SLEEP = float(os.getenv("SHORT_LINK_PURGE_SLEEP", 0.05))  # 每批之间暂停的秒数
+SHORT_LINK_PURGE_MAX_SECONDS = float(os.getenv("SHORT_LINK_PURGE_MAX_SECONDS", 60))  # 单次清理的时间预算(秒)，0表示不限制
+
+# 每种清理原因对应的查找条件，子查询按对应的部分索引取一批id
+PURGE_SQL = {
+    "expired": text(
+        "DELETE FROM short_links WHERE id IN ("
+        "SELECT id FROM short_links WHERE expire_at IS NOT NULL AND expire_at < :cutoff "
+        "ORDER BY expire_at LIMIT :batch)"
+    ).bindparams(bindparam("cutoff", type_=DateTime)),
+    "disabled": text(
+        "DELETE FROM short_links WHERE id IN ("
+        "SELECT id FROM short_links WHERE is_enabled = 0 ORDER BY id LIMIT :batch)"
+    ),
+}
+
+def purge_short_links(db: Session, batch_size: int = SHORT_LINK_PURGE_BATCH,
+                      max_seconds: float = SHORT_LINK_PURGE_MAX_SECONDS) -> Dict[str, int]:
+    """分批删除超过保留期的过期短链接和已禁用的短链接，返回每种原因删除的行数"""
+    started = time.monotonic()
+    cutoff = datetime.utcnow() - timedelta(seconds=SHORT_LINK_RETENTION)
+    stats = {reason: 0 for reason in PURGE_SQL}
+    finished = True
+    for reason, statement in PURGE_SQL.items():
+        while True:
+            if max_seconds > 0 and time.monotonic() - started > max_seconds:
+                finished = False
+                break
+            deleted = db.execute(statement, {"cutoff": cutoff, "batch": batch_size}).rowcount
+            db.commit()
+            if deleted <= 0:
+                break
+            stats[reason] += deleted
+            SHORT_LINKS_PURGED.labels(reason).inc(deleted)
+            if deleted < batch_size:
+                break
+            if SHORT_LINK_PURGE_SLEEP > 0:
+                time.sleep(SHORT_LINK_PURGE_SLEEP)
+        if not finished:
+            break
+
+    total = sum(stats.values())
+    message = (f"短链接清理{'完成' if finished else '达到时间预算，剩余部分下次继续'}: "
+               f"过期 {stats['expired']} 个，已禁用 {stats['disabled']} 个 ({time.monotonic() - started:.1f}s)")
+    logger.log(logging.INFO if total or not finished else logging.DEBUG, message)
+    return stats
@@ -0,0 +1,182 @@
+"""
+非阻塞的日志管道
+
+请求处理中调用logger只把日志放入内存队列，由QueueListener的后台线程写入文件和控制台，
+日志文件按大小轮转，磁盘变慢时不会拖慢请求。队列已满时直接丢弃日志，不等待。
+
+热点路径（短链接访问、页面访问等）的INFO日志按调用位置限流，每个位置每秒最多记录
+LOG_RATE_LIMIT条，被省略的条数附加在该位置下一条记录的日志中；WARNING及以上级别不限流。
+数据库结构相关的重复警告只记录一次，记住的消息数量有上限。
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from src.metrics import LOG_RECORDS_DROPPED
+
+LOG_FILE = os.getenv("LOG_FILE", "upload.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))  # 单个日志文件的最大字节数，0表示不轮转
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))  # 保留的轮转文件数量
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))  # 等待写入的日志条数上限
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", 20))  # 每个调用位置每秒最多记录的INFO日志条数，0表示不限流
+LOG_DEDUP_SIZE = int(os.getenv("LOG_DEDUP_SIZE", 1024))  # 去重过滤器记住的消息数量
+
+# 只记录一次的数据库结构警告
+SUPPRESS_TEXTS = (
+    "no such column",
+    "数据库表结构与模型不匹配",
+    "duplicate column name",
+    "无法添加",
+)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_setup_lock = threading.Lock()
+
+class DedupFilter(logging.Filter):
+    """包含指定文本的消息只记录第一次，最多记住max_entries条，超出时淘汰最早的消息"""
+
+    def __init__(self, suppress_texts: Iterable[str], max_entries: int = LOG_DEDUP_SIZE):
+        super().__init__()
+        self.suppress_texts = tuple(suppress_texts)
+        self.max_entries = max_entries
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        message = record.getMessage()
+        if not any(text in message for text in self.suppress_texts):
+            return True
+        with self._lock:
+            if message in self._seen:
+                self._seen.move_to_end(message)
+                LOG_RECORDS_DROPPED.labels("dedup").inc()
+                return False
+            self._seen[message] = None
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+        return True
+
+class RateLimitFilter(logging.Filter):
+    """
+    按调用位置（文件和行号）限制低于WARNING级别日志的记录频率
+
+    日志消息大多是f-string，同一位置每次的文本都不同，因此按位置而不是按文本计数；
+    调用位置的数量由代码决定，计数表不会无限增长
+    """
+
+    def __init__(self, rate: int = LOG_RATE_LIMIT, window: float = 1.0):
+        super().__init__()
+        self.rate = rate
+        self.window = window
+        # 调用位置 -> [窗口开始时间, 窗口内已记录条数, 被省略的条数]
+        self._sites: Dict[Tuple[str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                self._sites[key] = [now, 1, 0]
+                return True
+            if now - site[0] >= self.window:
+                site[0], site[1] = now, 0
+            if site[1] >= self.rate:
+                site[2] += 1
+                LOG_RECORDS_DROPPED.labels("sampled").inc()
+                return False
+            site[1] += 1
+            skipped, site[2] = site[2], 0
+        if skipped:
+            record.msg = f"{record.getMessage()} (此前省略了 {skipped} 条同一位置的日志)"
+            record.args = None
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """队列已满时丢弃日志而不是阻塞或打印异常"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels("queue_full").inc()
+
+def _same_file(stream, path_stat) -> bool:
+    stream_stat = os.fstat(stream.fileno())
+    return (stream_stat.st_dev, stream_stat.st_ino) == (path_stat.st_dev, path_stat.st_ino)
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    多个worker进程写同一个日志文件时使用的轮转处理器
+
+    其他进程轮转后，本进程仍持有旧文件的句柄；写入前检查路径对应的文件是否已被替换，
+    被替换时重新打开，并以路径上的实际文件大小决定是否轮转
+    """
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            return False
+        try:
+            if not _same_file(self.stream, os.stat(self.baseFilename)):
+                self.stream.close()
+                self.stream = self._open()
+        except FileNotFoundError:
+            self.stream.close()
+            self.stream = self._open()
+            return False
+        except OSError:
+            return False
+        return super().shouldRollover(record)
+
+def setup_logging(logger: logging.Logger) -> Optional[logging.handlers.QueueListener]:
+    """
+    为logger配置队列日志管道，返回后台写入线程的QueueListener
+
+    控制台输出也通过队列完成，logger不再向上传递给root的处理器；重复调用时不会重复配置
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return _listener
+
+        file_handler = SharedRotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+        file_handler.setLevel(logging.INFO)
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        console_handler = logging.StreamHandler(sys.stderr)
+        console_handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+
+        queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        queue_handler.addFilter(DedupFilter(SUPPRESS_TEXTS))
+        queue_handler.addFilter(RateLimitFilter())
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+
+        _listener = logging.handlers.QueueListener(
+            queue_handler.queue, file_handler, console_handler, respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(stop_logging)
+        return _listener
+
+def stop_logging():
+    """停止后台写入线程，写完队列中剩余的日志"""
+    global _listener
+    with _setup_lock:
+        if _listener is None:
+            return
+        listener, _listener = _listener, None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
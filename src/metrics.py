@@ -0,0 +1,187 @@
+"""
+Prometheus监控指标
+
+使用多个uvicorn worker时，main()会在启动worker之前设置PROMETHEUS_MULTIPROC_DIR，
+各进程的指标写入该目录下的文件，/metrics 汇总所有worker的数据。
+该环境变量必须在导入prometheus_client之前设置，因此本模块只能在app导入链中导入，
+不要在main.py的顶层导入。
+"""
+import logging
+import os
+import threading
+import time
+
+import prometheus_client
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, multiprocess
+)
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+PROMETHEUS_ENABLED = os.getenv("PROMETHEUS_ENABLED", "true").lower() == "true"
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+MULTIPROCESS = bool(MULTIPROC_DIR)
+# 线程池队列长度的采样间隔(秒)
+METRICS_SAMPLE_INTERVAL = float(os.getenv("METRICS_SAMPLE_INTERVAL", 5))
+
+# 单进程模式下使用独立的注册表；多进程模式下指标写入文件，抓取时再汇总
+REGISTRY = None if MULTIPROCESS else CollectorRegistry()
+
+# 延迟分桶(秒)，覆盖从缓存命中的短链接访问到大图上传
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "picui_http_request_duration_seconds", "HTTP请求处理耗时",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+HTTP_RESPONSE_BYTES = Counter(
+    "picui_http_response_bytes", "HTTP响应体字节数",
+    ["route"], registry=REGISTRY
+)
+HTTP_IN_FLIGHT = Gauge(
+    "picui_http_requests_in_flight", "正在处理的HTTP请求数",
+    registry=REGISTRY, multiprocess_mode="livesum"
+)
+UPLOAD_STAGE_SECONDS = Histogram(
+    "picui_upload_stage_duration_seconds", "上传处理各阶段耗时（write/optimize/check/db）",
+    ["stage"], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+EXECUTOR_QUEUE_DEPTH = Gauge(
+    "picui_executor_queue_depth", "线程池中等待执行的任务数",
+    ["pool"], registry=REGISTRY, multiprocess_mode="livesum"
+)
+CACHE_REQUESTS = Counter(
+    "picui_cache_requests", "缓存查询次数",
+    ["cache", "result"], registry=REGISTRY
+)
+DB_QUERIES = Counter(
+    "picui_db_queries", "执行的数据库语句数",
+    ["statement"], registry=REGISTRY
+)
+LOG_RECORDS_DROPPED = Counter(
+    "picui_log_records_dropped", "未写入的日志条数（queue_full/sampled/dedup）",
+    ["reason"], registry=REGISTRY
+)
+STORAGE_IO_SECONDS = Histogram(
+    "picui_storage_io_duration_seconds", "文件操作耗时",
+    ["op"], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+
+SCHEDULER_LEADER = Gauge(
+    "picui_scheduler_leader", "当前进程是否为维护任务leader，多进程时为leader数量",
+    registry=REGISTRY, multiprocess_mode="livesum"
+)
+SCHEDULER_JOB_RUNS = Counter(
+    "picui_scheduler_job_runs", "维护任务执行次数（ok/error/timeout/skipped）",
+    ["job", "result"], registry=REGISTRY
+)
+SCHEDULER_JOB_LAST_RUN = Gauge(
+    "picui_scheduler_job_last_run_timestamp_seconds", "维护任务最近一次执行结束的时间",
+    ["job"], registry=REGISTRY, multiprocess_mode="max"
+)
+SCHEDULER_JOB_DURATION = Gauge(
+    "picui_scheduler_job_last_duration_seconds", "维护任务最近一次执行的耗时",
+    ["job"], registry=REGISTRY, multiprocess_mode="mostrecent"
+)
+
+GC_ORPHANS = Counter(
+    "picui_gc_orphans", "孤儿清理发现的孤儿文件(file)和孤儿记录(row)数量",
+    ["kind", "action"], registry=REGISTRY
+)
+GC_RECLAIMED_BYTES = Counter(
+    "picui_gc_reclaimed_bytes", "孤儿清理删除或隔离的文件字节数",
+    registry=REGISTRY
+)
+SHORT_LINKS_PURGED = Counter(
+    "picui_short_links_purged", "后台清理删除的过期(expired)和已禁用(disabled)短链接数量",
+    ["reason"], registry=REGISTRY
+)
+
+def route_label(scope) -> str:
+    """
+    请求对应的路由模板，例如 /images/{filename}
+
+    使用模板而不是实际路径，避免标签数量随文件名无限增长；
+    挂载的静态目录使用挂载路径，未匹配任何路由的请求统一为unmatched
+    """
+    route = scope.get("route")
+    if route is not None:
+        return getattr(route, "path", "unmatched")
+    return scope.get("root_path") or "unmatched"
+
+class MetricsMiddleware:
+    """记录每个请求的耗时、状态码和响应字节数的ASGI中间件"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        sent_bytes = 0
+
+        async def send_wrapper(message):
+            nonlocal status, sent_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent_bytes += len(message.get("body", b""))
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = route_label(scope)
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, str(status)).observe(time.perf_counter() - started)
+            if sent_bytes:
+                HTTP_RESPONSE_BYTES.labels(route).inc(sent_bytes)
+
+def install_db_metrics(engine):
+    """按语句类型统计数据库语句数量"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        if keyword not in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+            keyword = "OTHER"
+        DB_QUERIES.labels(keyword).inc()
+
+def start_executor_sampler(executors):
+    """
+    后台线程定期采样线程池的队列长度
+
+    executors为 {名称: ThreadPoolExecutor}，多进程模式下各worker的值相加
+    """
+    def _sample():
+        while True:
+            for name, executor in executors.items():
+                try:
+                    EXECUTOR_QUEUE_DEPTH.labels(name).set(executor._work_queue.qsize())
+                except Exception:
+                    pass
+            time.sleep(METRICS_SAMPLE_INTERVAL)
+
+    thread = threading.Thread(target=_sample, name="picui_metrics_sampler", daemon=True)
+    thread.start()
+    return thread
+
+def render_metrics() -> bytes:
+    """生成Prometheus文本格式的指标，多进程模式下汇总所有worker"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return prometheus_client.generate_latest(registry)
+    return prometheus_client.generate_latest(REGISTRY)
+
+def mark_process_dead():
+    """worker退出时清理多进程模式下该进程的实时指标文件"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
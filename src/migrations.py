@@ -0,0 +1,456 @@
+"""
+数据库版本化迁移
+
+每个迁移有一个递增的版本号，已应用的版本记录在schema_version表中。
+迁移只在部署时由main()执行一次，执行期间持有文件锁，
+多个worker同时启动时不会重复执行或互相竞争；
+worker启动时只需一次版本检查（ensure_schema）。
+
+新增迁移时使用 @migration(版本号, 描述) 注册，版本号必须递增且不可修改已发布的迁移。
+"""
+import logging
+import os
+import sqlite3
+import time
+from typing import Callable, List, Tuple
+
+from src.database import (
+    DATABASE_URL, SQLITE_BUSY_TIMEOUT, get_sqlite_path, apply_sqlite_pragmas,
+    upgrade_schema, create_tables
+)
+from src.counters import RECOMPUTE_SQL, BYTES_RECOMPUTE_SQL, FILE_BYTES_SQL
+from src.utils import FileLock
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+# 迁移锁文件路径，默认与数据库文件放在同一目录
+MIGRATION_LOCK_FILE = os.getenv("MIGRATION_LOCK_FILE", "")
+
+# 数据迁移每批处理的行数
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", 5000))
+
+# 已注册的迁移: (版本号, 描述, 迁移函数, 是否在单个事务中执行)
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None], bool]] = []
+
+def migration(version: int, description: str, transactional: bool = True):
+    """
+    注册迁移的装饰器，迁移函数接收一个sqlite3连接
+
+    transactional为True时迁移在执行器开启的事务中运行；
+    为False时迁移自行分批提交（用于大表数据迁移），必须可以重复执行，
+    中断后再次执行会从未完成的部分继续
+    """
+    def decorator(fn):
+        if any(m[0] == version for m in MIGRATIONS):
+            raise ValueError(f"重复的迁移版本号: {version}")
+        MIGRATIONS.append((version, description, fn, transactional))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+def latest_version() -> int:
+    """返回最新的迁移版本号"""
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def _is_sqlite() -> bool:
+    return DATABASE_URL.startswith("sqlite")
+
+def _lock_path() -> str:
+    return MIGRATION_LOCK_FILE or f"{get_sqlite_path()}.migrate.lock"
+
+def _connect() -> sqlite3.Connection:
+    """打开用于迁移的sqlite3连接，事务由执行器显式控制"""
+    conn = sqlite3.connect(get_sqlite_path(), timeout=SQLITE_BUSY_TIMEOUT / 1000, isolation_level=None)
+    apply_sqlite_pragmas(conn)
+    return conn
+
+def _read_version(conn: sqlite3.Connection) -> int:
+    """读取当前数据库版本，版本表不存在时返回0"""
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError as e:
+        if "no such table" in str(e).lower():
+            return 0
+        raise
+    return row[0] or 0
+
+def get_schema_version() -> int:
+    """查询数据库当前的迁移版本"""
+    if not _is_sqlite():
+        return latest_version()
+    if not os.path.exists(get_sqlite_path()):
+        return 0
+    conn = _connect()
+    try:
+        return _read_version(conn)
+    finally:
+        conn.close()
+
+def run_migrations() -> int:
+    """
+    持有文件锁执行所有未应用的迁移，返回本次应用的迁移数量
+
+    事务性迁移与其版本记录在同一个事务中提交，中途失败时该迁移整体回滚；
+    分批迁移中途失败时已提交的批次保留。下次执行时都从失败的迁移继续
+    """
+    if not _is_sqlite():
+        # 非SQLite数据库直接按模型创建表
+        create_tables()
+        return 0
+
+    applied = 0
+    with FileLock(_lock_path()):
+        conn = _connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            current = _read_version(conn)
+            for version, description, fn, transactional in MIGRATIONS:
+                if version <= current:
+                    continue
+                started = time.time()
+                try:
+                    if not transactional:
+                        # 分批提交的数据迁移，完成后再记录版本
+                        fn(conn)
+                    conn.execute("BEGIN IMMEDIATE")
+                    if transactional:
+                        fn(conn)
+                    conn.execute(
+                        "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                        (version, description)
+                    )
+                    conn.execute("COMMIT")
+                except Exception:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    logger.error(f"数据库迁移 {version} 失败: {description}", exc_info=True)
+                    raise
+                applied += 1
+                logger.info(f"✓ 已应用数据库迁移 {version}: {description} ({time.time() - started:.2f}s)")
+        finally:
+            conn.close()
+
+    if applied == 0:
+        logger.debug(f"数据库已是最新版本 {latest_version()}")
+    return applied
+
+def ensure_schema():
+    """
+    worker启动时调用，只执行一次版本检查
+
+    正常部署时迁移已由main()完成；直接使用uvicorn启动等情况下数据库版本落后，
+    此时执行迁移，文件锁保证只有一个进程真正执行
+    """
+    current = get_schema_version()
+    if current >= latest_version():
+        return
+    logger.info(f"数据库版本 {current} 落后于 {latest_version()}，开始执行迁移")
+    run_migrations()
+
+def run_batches(conn: sqlite3.Connection, sql: str, label: str, total: int,
+                batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """
+    重复执行一条带LIMIT参数的UPDATE/DELETE语句直到不再影响任何行
+
+    sql中的 :limit 会被替换为批大小，每批单独提交以限制写锁持有时间，
+    并输出进度日志。返回处理的总行数
+    """
+    processed = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            changed = conn.execute(sql, {"limit": batch_size}).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if changed <= 0:
+            break
+        processed += changed
+        logger.info(f"{label}: 已处理 {processed}/{total} 行")
+    return processed
+
+# SQLite中生成与uuid.uuid4()格式相同的随机UUID
+_SQL_UUID4 = (
+    "lower(hex(randomblob(4))) || '-' || lower(hex(randomblob(2))) || '-4' || "
+    "substr(lower(hex(randomblob(2))), 2) || '-' || "
+    "substr('89ab', 1 + (abs(random()) % 4), 1) || substr(lower(hex(randomblob(2))), 2) || '-' || "
+    "lower(hex(randomblob(6)))"
+)
+
+# ---------------------------------------------------------------------------
+# 迁移定义
+# ---------------------------------------------------------------------------
+
+@migration(1, "创建基础表并补齐旧版本缺失的列")
+def _migration_base_schema(conn: sqlite3.Connection):
+    upgrade_schema(conn.cursor())
+
+@migration(2, "为旧数据按上传IP回填user_id", transactional=False)
+def _migration_backfill_user_id(conn: sqlite3.Connection):
+    """
+    旧版本没有user_id字段，按上传IP为每个IP分配一个用户ID
+
+    IP与用户ID的对应关系保存在_backfill_ip_user表中，中断后重新执行时
+    同一IP仍然分配到相同的用户ID。所有更新均为分批的集合操作，不会把整表读入内存
+    """
+    pending = {
+        table: conn.execute(f"SELECT COUNT(*) FROM {table} WHERE user_id IS NULL").fetchone()[0]
+        for table in ("images", "upload_logs", "short_links")
+    }
+    if not any(pending.values()):
+        return
+    logger.info(f"开始回填user_id: 图片 {pending['images']} 条，日志 {pending['upload_logs']} 条，"
+                f"短链接 {pending['short_links']} 条")
+
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("CREATE TABLE IF NOT EXISTS _backfill_ip_user (ip TEXT PRIMARY KEY, user_id TEXT NOT NULL)")
+    for table, ip_column in (("images", "upload_ip"), ("upload_logs", "ip_address")):
+        conn.execute(f"""
+            INSERT OR IGNORE INTO _backfill_ip_user (ip, user_id)
+            SELECT ip, {_SQL_UUID4} FROM (
+                SELECT DISTINCT COALESCE({ip_column}, '') AS ip FROM {table} WHERE user_id IS NULL
+            )
+        """)
+    conn.execute("COMMIT")
+
+    for table, ip_column in (("images", "upload_ip"), ("upload_logs", "ip_address")):
+        run_batches(conn, f"""
+            UPDATE {table}
+            SET user_id = (SELECT m.user_id FROM _backfill_ip_user m WHERE m.ip = COALESCE({table}.{ip_column}, ''))
+            WHERE id IN (SELECT id FROM {table} WHERE user_id IS NULL ORDER BY id LIMIT :limit)
+        """, f"回填{table}.user_id", pending[table])
+
+    # 短链接使用其目标图片的user_id
+    run_batches(conn, """
+        UPDATE short_links
+        SET user_id = (SELECT i.user_id FROM images i WHERE i.filename = short_links.target_file)
+        WHERE id IN (
+            SELECT s.id FROM short_links s JOIN images i ON i.filename = s.target_file
+            WHERE s.user_id IS NULL AND i.user_id IS NOT NULL
+            ORDER BY s.id LIMIT :limit
+        )
+    """, "回填short_links.user_id", pending["short_links"])
+
+    conn.execute("DROP TABLE IF EXISTS _backfill_ip_user")
+
+@migration(3, "为日志游标分页添加 (user_id, upload_time, id) 复合索引")
+def _migration_upload_logs_keyset_indexes(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_logs_user_time ON upload_logs(user_id, upload_time, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_logs_time ON upload_logs(upload_time, id)")
+
+@migration(4, "短链接代码、目标文件和原始文件名的FTS5全文索引")
+def _migration_short_link_search(conn: sqlite3.Connection):
+    """
+    使用trigram分词的FTS5表支持任意子串搜索，rowid与short_links.id一致，由触发器保持同步
+
+    SQLite版本过低（不支持FTS5或trigram分词器）时跳过，搜索会退回到LIKE查询
+    """
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS short_link_search
+            USING fts5(code, target_file, original_filename, tokenize='trigram')
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"当前SQLite不支持FTS5 trigram分词器，短链接搜索将使用LIKE查询: {str(e)}")
+        return
+
+    conn.execute("DELETE FROM short_link_search")
+    conn.execute("""
+        INSERT INTO short_link_search (rowid, code, target_file, original_filename)
+        SELECT s.id, s.code, s.target_file, COALESCE(i.original_filename, '')
+        FROM short_links s LEFT JOIN images i ON i.filename = s.target_file
+    """)
+    # executescript会隐式提交当前事务，因此逐条执行
+    for trigger_sql in (
+        """
+            CREATE TRIGGER IF NOT EXISTS short_link_search_ai AFTER INSERT ON short_links BEGIN
+                INSERT INTO short_link_search (rowid, code, target_file, original_filename)
+                VALUES (new.id, new.code, new.target_file,
+                        COALESCE((SELECT original_filename FROM images WHERE filename = new.target_file), ''));
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS short_link_search_ad AFTER DELETE ON short_links BEGIN
+                DELETE FROM short_link_search WHERE rowid = old.id;
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS short_link_search_au AFTER UPDATE OF code, target_file ON short_links BEGIN
+                DELETE FROM short_link_search WHERE rowid = old.id;
+                INSERT INTO short_link_search (rowid, code, target_file, original_filename)
+                VALUES (new.id, new.code, new.target_file,
+                        COALESCE((SELECT original_filename FROM images WHERE filename = new.target_file), ''));
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS short_link_search_image_ai AFTER INSERT ON images BEGIN
+                UPDATE short_link_search SET original_filename = COALESCE(new.original_filename, '')
+                WHERE rowid IN (SELECT id FROM short_links WHERE target_file = new.filename);
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS short_link_search_image_au AFTER UPDATE OF filename, original_filename ON images BEGIN
+                UPDATE short_link_search SET original_filename = ''
+                WHERE rowid IN (SELECT id FROM short_links WHERE target_file = old.filename);
+                UPDATE short_link_search SET original_filename = COALESCE(new.original_filename, '')
+                WHERE rowid IN (SELECT id FROM short_links WHERE target_file = new.filename);
+            END
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS short_link_search_image_ad AFTER DELETE ON images BEGIN
+                UPDATE short_link_search SET original_filename = ''
+                WHERE rowid IN (SELECT id FROM short_links WHERE target_file = old.filename);
+            END
+        """,
+    ):
+        conn.execute(trigger_sql)
+
+def _bump_counter(name: str, user_expr: str, delta: str, source: str = "", where: str = "1") -> str:
+    """生成触发器中增减计数器的语句，user_expr为NULL时不更新"""
+    return (
+        f"INSERT INTO stat_counters (name, user_id, value) SELECT '{name}', {user_expr}, {delta} {source} "
+        f"WHERE {user_expr} IS NOT NULL AND {where} "
+        f"ON CONFLICT(name, user_id) DO UPDATE SET value = value + excluded.value;"
+    )
+
+def _links_to(filename_expr: str) -> str:
+    return f"(SELECT COUNT(*) FROM short_links WHERE target_file = {filename_expr})"
+
+@migration(5, "图片、日志和短链接数量的计数器表，由触发器维护")
+def _migration_stat_counters(conn: sqlite3.Connection):
+    """
+    页面上的总数不再每次COUNT(*)全表，而是读取stat_counters中的计数，
+    计数由触发器在同一事务中更新，全局计数的user_id为空字符串
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stat_counters (
+            name TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, user_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("DELETE FROM stat_counters")
+    for sql in RECOMPUTE_SQL:
+        conn.execute(sql.format(table="stat_counters"))
+
+    triggers = {
+        "stat_images_ai": ("AFTER INSERT ON images", [
+            _bump_counter("images", "''", "1"),
+            _bump_counter("images", "new.user_id", "1"),
+            _bump_counter("image_links", "new.user_id", _links_to("new.filename"),
+                          where=f"{_links_to('new.filename')} > 0"),
+        ]),
+        "stat_images_ad": ("AFTER DELETE ON images", [
+            _bump_counter("images", "''", "-1"),
+            _bump_counter("images", "old.user_id", "-1"),
+            _bump_counter("image_links", "old.user_id", f"-{_links_to('old.filename')}",
+                          where=f"{_links_to('old.filename')} > 0"),
+        ]),
+        "stat_images_au": ("AFTER UPDATE OF user_id, filename ON images "
+                           "WHEN old.user_id IS NOT new.user_id OR old.filename IS NOT new.filename", [
+            _bump_counter("images", "old.user_id", "-1"),
+            _bump_counter("images", "new.user_id", "1"),
+            _bump_counter("image_links", "old.user_id", f"-{_links_to('old.filename')}",
+                          where=f"{_links_to('old.filename')} > 0"),
+            _bump_counter("image_links", "new.user_id", _links_to("new.filename"),
+                          where=f"{_links_to('new.filename')} > 0"),
+        ]),
+        "stat_logs_ai": ("AFTER INSERT ON upload_logs", [
+            _bump_counter("logs", "''", "1"),
+            _bump_counter("logs", "new.user_id", "1"),
+        ]),
+        "stat_logs_ad": ("AFTER DELETE ON upload_logs", [
+            _bump_counter("logs", "''", "-1"),
+            _bump_counter("logs", "old.user_id", "-1"),
+        ]),
+        "stat_logs_au": ("AFTER UPDATE OF user_id ON upload_logs WHEN old.user_id IS NOT new.user_id", [
+            _bump_counter("logs", "old.user_id", "-1"),
+            _bump_counter("logs", "new.user_id", "1"),
+        ]),
+        "stat_links_ai": ("AFTER INSERT ON short_links", [
+            _bump_counter("links", "''", "1"),
+            _bump_counter("links", "new.user_id", "1"),
+            _bump_counter("image_links", "i.user_id", "1", source="FROM images i",
+                          where="i.filename = new.target_file"),
+        ]),
+        "stat_links_ad": ("AFTER DELETE ON short_links", [
+            _bump_counter("links", "''", "-1"),
+            _bump_counter("links", "old.user_id", "-1"),
+            _bump_counter("image_links", "i.user_id", "-1", source="FROM images i",
+                          where="i.filename = old.target_file"),
+        ]),
+        "stat_links_au": ("AFTER UPDATE OF user_id, target_file ON short_links "
+                          "WHEN old.user_id IS NOT new.user_id OR old.target_file IS NOT new.target_file", [
+            _bump_counter("links", "old.user_id", "-1"),
+            _bump_counter("links", "new.user_id", "1"),
+            _bump_counter("image_links", "i.user_id", "-1", source="FROM images i",
+                          where="i.filename = old.target_file"),
+            _bump_counter("image_links", "i.user_id", "1", source="FROM images i",
+                          where="i.filename = new.target_file"),
+        ]),
+    }
+    for name, (event, statements) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {' '.join(statements)} END")
+
+@migration(6, "按用户统计图片字节数的计数器，用于存储配额")
+def _migration_stat_bytes(conn: sqlite3.Connection):
+    """在stat_counters中增加bytes计数，由images表的触发器按file_size增减"""
+    conn.execute("DELETE FROM stat_counters WHERE name = 'bytes'")
+    for sql in BYTES_RECOMPUTE_SQL:
+        conn.execute(sql.format(table="stat_counters"))
+
+    new_bytes = FILE_BYTES_SQL.format(column="new.file_size")
+    old_bytes = FILE_BYTES_SQL.format(column="old.file_size")
+    triggers = {
+        "stat_bytes_ai": ("AFTER INSERT ON images", [
+            _bump_counter("bytes", "''", new_bytes),
+            _bump_counter("bytes", "new.user_id", new_bytes),
+        ]),
+        "stat_bytes_ad": ("AFTER DELETE ON images", [
+            _bump_counter("bytes", "''", f"-{old_bytes}"),
+            _bump_counter("bytes", "old.user_id", f"-{old_bytes}"),
+        ]),
+        "stat_bytes_au": ("AFTER UPDATE OF user_id, file_size ON images "
+                          "WHEN old.user_id IS NOT new.user_id OR old.file_size IS NOT new.file_size", [
+            _bump_counter("bytes", "''", f"{new_bytes} - {old_bytes}"),
+            _bump_counter("bytes", "old.user_id", f"-{old_bytes}"),
+            _bump_counter("bytes", "new.user_id", new_bytes),
+        ]),
+    }
+    for name, (event, statements) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {' '.join(statements)} END")
+
+@migration(7, "为清理过期和已禁用的短链接添加部分索引")
+def _migration_short_link_purge_indexes(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_short_links_expire_at ON short_links(expire_at) "
+                 "WHERE expire_at IS NOT NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_short_links_disabled ON short_links(id) WHERE is_enabled = 0")
+
+@migration(8, "为相似图片查找添加images.phash感知哈希列")
+def _migration_image_phash(conn: sqlite3.Connection):
+    """旧图片的哈希为空，可以使用 python -m src.phash backfill 回填"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(images)")]
+    if "phash" not in columns:
+        conn.execute("ALTER TABLE images ADD COLUMN phash INTEGER")
+
+@migration(9, "存储配额的预留记录表，多个worker共享正在进行的上传占用的额度")
+def _migration_quota_reservations(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS quota_reservations (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quota_reservations_user "
+                 "ON quota_reservations(user_id, created_at)")
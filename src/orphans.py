@@ -0,0 +1,372 @@
+"""
+孤儿文件和孤儿记录清理
+
+上传处理中途失败、进程崩溃或删除出错时，会留下没有数据库记录的文件，或文件已不存在的图片记录。
+清理按分级目录逐个进行：每个叶子目录的文件名排序后，与数据库中同一前缀范围内按文件名排序的记录
+做归并比较，内存中只保留一个目录的内容。两个相邻目录之间的文件名范围（对应的分级目录不存在，
+包括平铺布局的旧文件名）中的记录按文件名分批读取，文件在两种布局下都不存在时判定为孤儿记录，
+因此所有图片记录都会被检查。上传目录根下的平铺文件分批按文件名查询数据库。
+处理进度保存在状态文件中，单次运行超过时间预算时停止，下次从中断的目录继续。
+
+处理方式（GC_MODE）：
+    report      只统计和记录日志
+    quarantine  把孤儿文件移动到隔离目录，孤儿记录只统计
+    delete      删除孤儿文件，并删除孤儿记录及指向它的短链接
+
+最近GC_MIN_AGE秒内修改的文件和上传的记录不处理，避免误删正在上传的图片。
+
+手动执行：
+    python -m src.orphans [--mode report|quarantine|delete] [--max-seconds 0] [--reset]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+
+from src.database import get_sqlite_path
+from src.metrics import GC_ORPHANS, GC_RECLAIMED_BYTES
+from src.storage import UPLOAD_DIR, SHARD_DEPTH, resolve_upload_path
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+GC_INTERVAL = int(os.getenv("GC_INTERVAL", 21600))  # 后台清理的间隔(秒)，0表示禁用
+GC_MODE = os.getenv("GC_MODE", "report").lower()  # report / quarantine / delete
+GC_MIN_AGE = int(os.getenv("GC_MIN_AGE", 3600))  # 只处理早于该时间(秒)的文件和记录
+GC_BATCH_SIZE = int(os.getenv("GC_BATCH_SIZE", 1000))  # 平铺文件每批查询的数量
+GC_MAX_SECONDS = float(os.getenv("GC_MAX_SECONDS", 300))  # 单次运行的时间预算(秒)
+GC_SLEEP = float(os.getenv("GC_SLEEP", 0.01))  # 每处理一批后暂停的秒数，限制IO压力
+GC_STATE_FILE = os.getenv("GC_STATE_FILE", "")
+GC_QUARANTINE_DIR = os.getenv("GC_QUARANTINE_DIR", "") or os.path.join(UPLOAD_DIR, ".quarantine")
+
+MODES = ("report", "quarantine", "delete")
+# 每处理多少个目录保存一次进度
+_CHECKPOINT_EVERY = 100
+_IN_CHUNK_SIZE = 500
+
+def _state_path() -> str:
+    return GC_STATE_FILE or f"{get_sqlite_path()}.gc-state.json"
+
+def _empty_totals() -> Dict[str, int]:
+    return {"files_checked": 0, "rows_checked": 0, "orphan_files": 0,
+            "orphan_rows": 0, "reclaimed_bytes": 0}
+
+def load_state() -> dict:
+    try:
+        with open(_state_path(), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state: dict):
+    path = _state_path()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def _sorted_subdirs(path: str) -> List[str]:
+    """分级目录的子目录，只包含长度为2且不以点开头的目录"""
+    try:
+        with os.scandir(path) as entries:
+            return sorted(e.name for e in entries
+                          if len(e.name) == 2 and not e.name.startswith(".") and e.is_dir(follow_symlinks=False))
+    except FileNotFoundError:
+        return []
+
+def iter_shard_dirs(after: Optional[str] = None, prefix: str = "", depth: int = SHARD_DEPTH) -> Iterator[str]:
+    """按文件名顺序遍历分级布局的叶子目录（如 ab/cd），跳过after及之前的目录"""
+    for name in _sorted_subdirs(os.path.join(UPLOAD_DIR, prefix)):
+        rel = f"{prefix}/{name}" if prefix else name
+        if depth > 1:
+            # after之前的整个子树都可以跳过
+            if after and rel < after[:len(rel)]:
+                continue
+            yield from iter_shard_dirs(after, rel, depth - 1)
+        elif not after or rel > after:
+            yield rel
+
+def _prefix_range(prefix: str) -> Tuple[str, str]:
+    """以prefix开头的文件名范围 [lo, hi)"""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class OrphanCollector:
+    """一次清理运行，累计统计并执行处理动作"""
+
+    def __init__(self, db: Session, mode: str):
+        if mode not in MODES:
+            raise ValueError(f"未知的清理方式: {mode}")
+        self.db = db
+        self.mode = mode
+        self.now = time.time()
+        self.stats = _empty_totals()
+
+    def _rows_in_db(self, filenames: List[str]) -> set:
+        found = set()
+        for i in range(0, len(filenames), _IN_CHUNK_SIZE):
+            rows = self.db.execute(
+                text("SELECT filename FROM images WHERE filename IN :names").bindparams(
+                    bindparam("names", expanding=True)),
+                {"names": filenames[i:i + _IN_CHUNK_SIZE]}
+            ).fetchall()
+            found.update(row[0] for row in rows)
+        return found
+
+    def _handle_orphan_files(self, candidates: List[Tuple[str, str, int]]):
+        """candidates为 (文件名, 路径, 字节数)，再次按文件名确认没有数据库记录后处理"""
+        if not candidates:
+            return
+        in_db = self._rows_in_db([name for name, _, _ in candidates])
+        quarantine_dir = os.path.join(GC_QUARANTINE_DIR, datetime.now().strftime("%Y%m%d"))
+        for name, path, size in candidates:
+            if name in in_db:
+                continue
+            self.stats["orphan_files"] += 1
+            try:
+                if self.mode == "delete":
+                    os.remove(path)
+                elif self.mode == "quarantine":
+                    os.makedirs(quarantine_dir, exist_ok=True)
+                    os.rename(path, os.path.join(quarantine_dir, name))
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.error(f"处理孤儿文件失败: {path}, {str(e)}")
+                continue
+            GC_ORPHANS.labels("file", self.mode).inc()
+            if self.mode != "report":
+                self.stats["reclaimed_bytes"] += size
+                GC_RECLAIMED_BYTES.inc(size)
+            logger.info(f"孤儿文件({self.mode}): {path} ({size} 字节)")
+
+    def _handle_orphan_rows(self, filenames: List[str]):
+        """再次确认文件在两种布局下都不存在后处理"""
+        orphans = [name for name in filenames if resolve_upload_path(name) is None]
+        if not orphans:
+            return
+        self.stats["orphan_rows"] += len(orphans)
+        GC_ORPHANS.labels("row", self.mode).inc(len(orphans))
+        if self.mode == "delete":
+            params = {"names": orphans}
+            for table, column in (("short_links", "target_file"), ("images", "filename")):
+                self.db.execute(
+                    text(f"DELETE FROM {table} WHERE {column} IN :names").bindparams(
+                        bindparam("names", expanding=True)),
+                    params
+                )
+            self.db.commit()
+        logger.info(f"文件不存在的图片记录({self.mode}): {', '.join(orphans[:20])}"
+                    + (f" 等 {len(orphans)} 条" if len(orphans) > 20 else ""))
+
+    def _old_enough(self, mtime: float) -> bool:
+        return self.now - mtime >= GC_MIN_AGE
+
+    def scan_shard_dir(self, rel: str):
+        """归并比较一个叶子目录中的文件和数据库中同一前缀的记录"""
+        directory = os.path.join(UPLOAD_DIR, rel)
+        files = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                    files.append((entry.name, entry.path, st.st_size, st.st_mtime))
+        except FileNotFoundError:
+            return
+        files.sort()
+
+        lo, hi = _prefix_range(rel.replace("/", ""))
+        rows = self.db.execute(
+            text("SELECT filename, upload_time < datetime('now', :age) FROM images "
+                 "WHERE filename >= :lo AND filename < :hi ORDER BY filename"),
+            {"lo": lo, "hi": hi, "age": f"-{GC_MIN_AGE} seconds"}
+        ).fetchall()
+        self.stats["files_checked"] += len(files)
+        self.stats["rows_checked"] += len(rows)
+
+        orphan_files, orphan_rows = [], []
+        i = j = 0
+        while i < len(files) or j < len(rows):
+            if j >= len(rows) or (i < len(files) and files[i][0] < rows[j][0]):
+                name, path, size, mtime = files[i]
+                if self._old_enough(mtime):
+                    orphan_files.append((name, path, size))
+                i += 1
+            elif i >= len(files) or rows[j][0] < files[i][0]:
+                # upload_time为空的旧记录视为足够早
+                if rows[j][1] is None or rows[j][1]:
+                    orphan_rows.append(rows[j][0])
+                j += 1
+            else:
+                i += 1
+                j += 1
+        self._handle_orphan_files(orphan_files)
+        self._handle_orphan_rows(orphan_rows)
+
+    def scan_missing_rows(self, lo: str, hi: Optional[str], after: Optional[str], deadline: float) -> Optional[str]:
+        """
+        检查文件名在 [lo, hi) 范围内、分级目录不存在的记录，hi为None表示不限上界
+
+        after不为None时从该文件名之后继续。超过时间预算时返回最后检查的文件名，完成时返回None
+        """
+        while True:
+            rows = self.db.execute(
+                text("SELECT filename, upload_time < datetime('now', :age) FROM images "
+                     "WHERE filename >= :lo AND (:hi IS NULL OR filename < :hi) "
+                     "AND (:after IS NULL OR filename > :after) ORDER BY filename LIMIT :limit"),
+                {"lo": lo, "hi": hi, "after": after, "age": f"-{GC_MIN_AGE} seconds", "limit": GC_BATCH_SIZE}
+            ).fetchall()
+            if not rows:
+                return None
+            self.stats["rows_checked"] += len(rows)
+            # upload_time为空的旧记录视为足够早
+            self._handle_orphan_rows([name for name, old in rows if old is None or old])
+            after = rows[-1][0]
+            if len(rows) < GC_BATCH_SIZE:
+                return None
+            if time.time() > deadline:
+                return after
+            if GC_SLEEP > 0:
+                time.sleep(GC_SLEEP)
+
+    def scan_flat_files(self, deadline: float) -> bool:
+        """分批检查上传目录根下的平铺文件，返回是否在时间预算内完成"""
+        batch = []
+        with os.scandir(UPLOAD_DIR) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                self.stats["files_checked"] += 1
+                if self._old_enough(st.st_mtime):
+                    batch.append((entry.name, entry.path, st.st_size))
+                if len(batch) >= GC_BATCH_SIZE:
+                    self._handle_orphan_files(batch)
+                    batch = []
+                    if time.time() > deadline:
+                        return False
+                    if GC_SLEEP > 0:
+                        time.sleep(GC_SLEEP)
+        self._handle_orphan_files(batch)
+        return True
+
+def _looks_unmounted(db: Session) -> bool:
+    """上传目录为空而数据库中有图片时，可能是存储未挂载，此时不能判定孤儿记录"""
+    try:
+        with os.scandir(UPLOAD_DIR) as entries:
+            if any(not e.name.startswith(".") for e in entries):
+                return False
+    except FileNotFoundError:
+        pass
+    return db.execute(text("SELECT 1 FROM images LIMIT 1")).first() is not None
+
+def collect_garbage(db: Session, mode: str = GC_MODE, max_seconds: float = GC_MAX_SECONDS) -> dict:
+    """
+    从上次中断的位置继续清理，最多运行max_seconds秒（0表示不限制）
+
+    返回本次运行的统计；完成一整轮时记录汇总日志，并从头开始下一轮
+    """
+    if _looks_unmounted(db):
+        logger.error(f"上传目录为空但数据库中有图片记录，跳过孤儿清理: {UPLOAD_DIR}")
+        return {"completed": False, "aborted": True}
+
+    started = time.time()
+    deadline = started + max_seconds if max_seconds > 0 else float("inf")
+    state = load_state()
+    if state.get("mode") != mode:
+        # 切换处理方式后重新开始一轮
+        state = {}
+    state.setdefault("mode", mode)
+    state.setdefault("phase", "shards")
+    state.setdefault("totals", _empty_totals())
+    state.setdefault("started_at", started)
+
+    collector = OrphanCollector(db, mode)
+    completed = False
+
+    def scan_gap(hi: Optional[str]) -> bool:
+        """检查上一个目录之后、hi之前没有分级目录的记录，超过时间预算时保存位置并返回False"""
+        cursor = state.get("cursor")
+        lo = _prefix_range(cursor.replace("/", ""))[1] if cursor else ""
+        row_cursor = collector.scan_missing_rows(lo, hi, state.get("row_cursor"), deadline)
+        if row_cursor is not None:
+            state["row_cursor"] = row_cursor
+            return False
+        state.pop("row_cursor", None)
+        return True
+
+    if state["phase"] == "shards":
+        scanned = 0
+        finished = True
+        for rel in iter_shard_dirs(state.get("cursor")):
+            if not scan_gap(rel.replace("/", "")):
+                finished = False
+                break
+            collector.scan_shard_dir(rel)
+            state["cursor"] = rel
+            scanned += 1
+            if scanned % _CHECKPOINT_EVERY == 0:
+                if GC_SLEEP > 0:
+                    time.sleep(GC_SLEEP)
+                if time.time() > deadline:
+                    finished = False
+                    break
+                save_state({**state, "totals": _merge(state["totals"], collector.stats)})
+        # 最后一个目录之后的记录
+        if finished and not scan_gap(None):
+            finished = False
+        if finished:
+            state["phase"] = "flat"
+            state.pop("cursor", None)
+    if state["phase"] == "flat" and time.time() <= deadline:
+        completed = collector.scan_flat_files(deadline)
+
+    totals = _merge(state["totals"], collector.stats)
+    if completed:
+        elapsed = time.time() - state["started_at"]
+        logger.info(
+            f"孤儿清理完成({mode}): 检查文件 {totals['files_checked']} 个、记录 {totals['rows_checked']} 条，"
+            f"孤儿文件 {totals['orphan_files']} 个，孤儿记录 {totals['orphan_rows']} 条，"
+            f"回收 {totals['reclaimed_bytes'] / 1024 / 1024:.1f}MB，用时 {elapsed:.1f}s"
+        )
+        save_state({"mode": mode, "last_report": {**totals, "finished_at": time.time(), "seconds": elapsed}})
+    else:
+        save_state({**state, "totals": totals})
+    return {**collector.stats, "completed": completed}
+
+def _merge(totals: Dict[str, int], stats: Dict[str, int]) -> Dict[str, int]:
+    return {key: totals.get(key, 0) + stats.get(key, 0) for key in _empty_totals()}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PicUI孤儿文件和孤儿记录清理")
+    parser.add_argument("--mode", choices=MODES, default=GC_MODE, help="处理方式")
+    parser.add_argument("--max-seconds", type=float, default=0, help="运行时间上限，0表示运行完整一轮")
+    parser.add_argument("--reset", action="store_true", help="忽略保存的进度，从头开始")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
+    if not os.path.isdir(UPLOAD_DIR):
+        logger.error(f"上传目录不存在: {UPLOAD_DIR}")
+        return 1
+    if args.reset:
+        save_state({})
+
+    from src.database import SessionLocal
+    db = SessionLocal()
+    try:
+        result = collect_garbage(db, args.mode, args.max_seconds)
+    finally:
+        db.close()
+    print(json.dumps(result, ensure_ascii=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
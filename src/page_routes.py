@@ -1,11 +1,15 @@
-from fastapi import APIRouter, Depends, Request, Response, Query
+from fastapi import APIRouter, HTTPException, Request, Response, Query
 from fastapi.responses import HTMLResponse
+from sqlalchemy import Integer, String, column, text, tuple_, type_coerce
 from sqlalchemy.orm import Session
-from sqlalchemy.sql import func
 from datetime import datetime
+from typing import Optional, Tuple
+import base64
 import logging
 
-from src.database import get_db, ShortLink, UploadLog, Image
+from src.database import ShortLink, UploadLog, Image
+from src.data_access import run_db, delete_owned_short_link
+from src.counters import GLOBAL, get_counters
 from src.session import get_or_create_session, get_user_id
 
 # 配置日志
@@ -52,65 +56,113 @@ async def home(request: Request, response: Response):
             status_code=500
         )
 
+def _encode_log_cursor(raw_time: str, log_id: int) -> str:
+    """把 (upload_time, id) 编码为URL安全的分页游标"""
+    return base64.urlsafe_b64encode(f"{raw_time}|{log_id}".encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_log_cursor(token: str) -> Optional[Tuple[str, int]]:
+    """解析分页游标，格式无效（包括时间部分不是有效的时间）时返回None"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("utf-8")
+        raw_time, log_id = raw.rsplit("|", 1)
+        datetime.fromisoformat(raw_time)
+        return raw_time, int(log_id)
+    except Exception:
+        return None
+
+def _fetch_logs_page(db: Session, user_id: Optional[str], limit: int,
+                     before: Optional[str] = None, after: Optional[str] = None):
+    """
+    按 (upload_time, id) 倒序的游标分页查询日志
+
+    before: 返回比该游标更早的一页（下一页）
+    after: 返回比该游标更新的一页（上一页）
+    user_id为None时查询所有用户的日志。
+    借助 (user_id, upload_time, id) 和 (upload_time, id) 复合索引，任意页的查询代价都与页码无关。
+    upload_time为NULL的旧记录无法与游标比较，不在分页结果中。
+
+    返回 (日志列表, 上一页游标, 下一页游标)，没有对应页时游标为None
+    """
+    # 直接比较数据库中存储的时间字符串，避免绑定参数的格式与存储格式不一致
+    raw_time = type_coerce(UploadLog.upload_time, String)
+    query = db.query(UploadLog, raw_time).filter(UploadLog.upload_time.isnot(None))
+    if user_id is not None:
+        query = query.filter(UploadLog.user_id == user_id)
+
+    cursor = _decode_log_cursor(after) if after else None
+    if cursor:
+        # 向前翻页：升序取比游标更新的记录，再反转为倒序
+        rows = query.filter(tuple_(raw_time, UploadLog.id) > tuple_(*cursor)) \
+            .order_by(UploadLog.upload_time.asc(), UploadLog.id.asc()).limit(limit + 1).all()
+        has_newer = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+        has_older = True
+    else:
+        cursor = _decode_log_cursor(before) if before else None
+        if cursor:
+            query = query.filter(tuple_(raw_time, UploadLog.id) < tuple_(*cursor))
+        rows = query.order_by(UploadLog.upload_time.desc(), UploadLog.id.desc()).limit(limit + 1).all()
+        has_older = len(rows) > limit
+        rows = rows[:limit]
+        has_newer = cursor is not None
+
+    logs = [log for log, _ in rows]
+    prev_cursor = _encode_log_cursor(rows[0][1], rows[0][0].id) if rows and has_newer else None
+    next_cursor = _encode_log_cursor(rows[-1][1], rows[-1][0].id) if rows and has_older else None
+    return logs, prev_cursor, next_cursor
+
+def _query_logs(db: Session, user_id: str, limit: int, before: Optional[str], after: Optional[str]):
+    """查询日志页面数据，返回 (日志列表, 日志总数, 上一页游标, 下一页游标)"""
+    # 读取日志计数，以决定是否应该显示所有日志而不是只显示当前用户的
+    counts = get_counters(db, [("logs", GLOBAL), ("logs", user_id)])
+    all_logs_count = counts[("logs", GLOBAL)]
+    user_logs_count = counts[("logs", user_id)]
+    
+    logger.info(f"数据库中有 {all_logs_count} 条总日志，当前用户有 {user_logs_count} 条日志")
+    
+    # 如果当前用户没有日志但数据库中有日志，则显示所有日志
+    if user_logs_count == 0 and all_logs_count > 0:
+        logger.info("当前用户没有日志，将显示所有日志")
+        total_logs = all_logs_count
+        logs, prev_cursor, next_cursor = _fetch_logs_page(db, None, limit, before, after)
+    else:
+        # 正常情况，只显示当前用户的日志
+        total_logs = user_logs_count
+        logs, prev_cursor, next_cursor = _fetch_logs_page(db, user_id, limit, before, after)
+
+    return logs, total_logs, prev_cursor, next_cursor
+
 # 查看上传日志页面
 @router.get("/logs/", response_class=HTMLResponse, tags=["页面"], summary="上传日志", description="查看上传日志页面")
 async def view_logs(
     request: Request,
     response: Response,
-    page: int = 1,
-    limit: int = 20,
-    db: Session = Depends(get_db)
+    limit: int = Query(20, ge=1, le=100),
+    before: Optional[str] = Query(None, description="分页游标，返回比该游标更早的日志"),
+    after: Optional[str] = Query(None, description="分页游标，返回比该游标更新的日志")
 ):
     """渲染上传日志页面"""
+    for token in (before, after):
+        if token and _decode_log_cursor(token) is None:
+            raise HTTPException(status_code=400, detail="无效的分页游标")
     try:
         # 获取或创建会话
         _, user_id = get_or_create_session(request, response)
         logger.info(f"用户访问日志页面: user_id={user_id}")
         
-        # 计算偏移量
-        offset = (page - 1) * limit
-        
-        # 查询当前用户的日志总数 - 打印更详细的SQL查询信息
-        user_id_condition = f"user_id = '{user_id}'"
-        logger.info(f"查询条件: {user_id_condition}")
-        
-        # 查询所有日志，以决定是否应该显示所有日志而不是只显示当前用户的
-        all_logs_count = db.query(func.count(UploadLog.id)).scalar()
-        user_logs_count = db.query(func.count(UploadLog.id)).filter(UploadLog.user_id == user_id).scalar()
-        
-        # 获取一些示例日志，检查用户ID分布
-        sample_logs = db.query(UploadLog).limit(5).all()
-        user_ids = set()
-        for log in sample_logs:
-            if log.user_id:
-                user_ids.add(log.user_id)
-        
-        logger.info(f"数据库中有 {all_logs_count} 条总日志，当前用户有 {user_logs_count} 条日志")
-        logger.info(f"示例日志中的用户ID: {user_ids}")
-        
-        # 如果当前用户没有日志但数据库中有日志，则显示所有日志
-        if user_logs_count == 0 and all_logs_count > 0:
-            logger.info("当前用户没有日志，将显示所有日志")
-            total_logs = all_logs_count
-            logs = db.query(UploadLog).order_by(UploadLog.upload_time.desc()).offset(offset).limit(limit).all()
-        else:
-            # 正常情况，只显示当前用户的日志
-            total_logs = user_logs_count
-            logs = db.query(UploadLog).filter(UploadLog.user_id == user_id).order_by(UploadLog.upload_time.desc()).offset(offset).limit(limit).all()
+        # 在数据库线程池中执行查询，避免阻塞事件循环
+        logs, total_logs, prev_cursor, next_cursor = await run_db(_query_logs, user_id, limit, before, after)
         
         logger.info(f"最终查询结果: 找到 {len(logs)} 条日志记录")
         
-        # 计算总页数
-        total_pages = max(1, (total_logs + limit - 1) // limit)
-        
         # 返回模板
         return templates.TemplateResponse(
             "logs.html",
             {
                 "request": request,
                 "logs": logs,
-                "page": page,
-                "total_pages": total_pages,
+                "prev_cursor": prev_cursor,
+                "next_cursor": next_cursor,
                 "total_logs": total_logs,
                 "limit": limit,
                 "user_id": user_id  # 添加user_id到模板上下文中方便调试
@@ -145,6 +197,87 @@ async def admin_panel(request: Request, response: Response):
         {"request": request}
     )
 
+# 短链接全文索引是否可用（由迁移创建，不支持FTS5时不存在）
+_short_link_fts_available = None
+
+def _has_short_link_fts(db: Session) -> bool:
+    """检查short_link_search全文索引表是否存在，结果在进程内缓存"""
+    global _short_link_fts_available
+    if _short_link_fts_available is None:
+        if db.get_bind().dialect.name != "sqlite":
+            _short_link_fts_available = False
+        else:
+            _short_link_fts_available = db.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'short_link_search'")
+            ).first() is not None
+    return _short_link_fts_available
+
+def _short_link_search_filter(db: Session, search: str, include_filename: bool):
+    """
+    构造短链接搜索条件
+
+    优先使用trigram全文索引匹配子串；搜索词少于3个字符（trigram无法匹配）
+    或索引不可用时退回到LIKE查询。include_filename为True时同时搜索图片原始文件名
+    """
+    if len(search) >= 3 and _has_short_link_fts(db):
+        columns = "{code target_file original_filename}" if include_filename else "{code target_file}"
+        phrase = '"' + search.replace('"', '""') + '"'
+        matched_ids = text(
+            "SELECT rowid FROM short_link_search WHERE short_link_search MATCH :fts_query"
+        ).bindparams(fts_query=f"{columns} : {phrase}").columns(column("rowid", Integer))
+        return ShortLink.id.in_(matched_ids)
+
+    condition = ShortLink.code.contains(search) | ShortLink.target_file.contains(search)
+    if include_filename:
+        condition = condition | Image.original_filename.contains(search)
+    return condition
+
+def _query_short_links(db: Session, user_id: str, search: str, offset: int, limit: int):
+    """查询短链接管理页面数据，返回 (短链接列表, 总数)"""
+    # 读取所有短链接、当前用户的短链接以及与当前用户图片关联的短链接的计数
+    counts = get_counters(db, [("links", GLOBAL), ("links", user_id), ("image_links", user_id)])
+    all_links_count = counts[("links", GLOBAL)]
+    user_links_direct = counts[("links", user_id)]
+    user_links_joined = counts[("image_links", user_id)]
+    
+    logger.info(f"数据库中有 {all_links_count} 条总短链接，当前用户直接关联 {user_links_direct} 条，通过图片关联 {user_links_joined} 条")
+    
+    # 如果当前用户没有短链接但数据库中有短链接，则显示所有短链接
+    if (user_links_direct == 0 and user_links_joined == 0) and all_links_count > 0:
+        logger.info("当前用户没有短链接，将显示所有短链接")
+        
+        # 使用简单查询
+        query = db.query(ShortLink)
+        if search:
+            query = query.filter(_short_link_search_filter(db, search, include_filename=False))
+        
+        # 没有搜索条件时总数直接使用计数器
+        total = query.count() if search else all_links_count
+        short_links = query.order_by(ShortLink.created_at.desc()).offset(offset).limit(limit).all()
+    else:
+        # 如果join查询有结果，使用join查询
+        if user_links_joined > 0:
+            # 使用join查询
+            query = db.query(ShortLink).join(
+                Image, ShortLink.target_file == Image.filename
+            ).filter(Image.user_id == user_id)
+            
+            if search:
+                query = query.filter(_short_link_search_filter(db, search, include_filename=True))
+            
+            total = query.count() if search else user_links_joined
+            short_links = query.order_by(ShortLink.created_at.desc()).offset(offset).limit(limit).all()
+        else:
+            # 使用直接查询
+            query = db.query(ShortLink).filter(ShortLink.user_id == user_id)
+            if search:
+                query = query.filter(_short_link_search_filter(db, search, include_filename=False))
+            
+            total = query.count() if search else user_links_direct
+            short_links = query.order_by(ShortLink.created_at.desc()).offset(offset).limit(limit).all()
+
+    return short_links, total
+
 # 短链管理页面
 @router.get("/admin/short-links", tags=["页面"], summary="短链管理", description="管理短链接", response_class=HTMLResponse)
 async def manage_short_links(
@@ -152,8 +285,7 @@ async def manage_short_links(
     response: Response,
     page: int = 1,
     limit: int = 20,
-    search: str = "",
-    db: Session = Depends(get_db)
+    search: str = ""
 ):
     """渲染短链接管理页面"""
     try:
@@ -164,59 +296,8 @@ async def manage_short_links(
         # 计算偏移量
         offset = (page - 1) * limit
         
-        # 查询所有短链接和当前用户的短链接
-        all_links_count = db.query(func.count(ShortLink.code)).scalar()
-        user_links_direct = db.query(func.count(ShortLink.code)).filter(ShortLink.user_id == user_id).scalar()
-        
-        # 查询与图片表关联的短链接
-        user_links_joined = db.query(func.count(ShortLink.code)).join(
-            Image, ShortLink.target_file == Image.filename
-        ).filter(Image.user_id == user_id).scalar()
-        
-        logger.info(f"数据库中有 {all_links_count} 条总短链接，当前用户直接关联 {user_links_direct} 条，通过图片关联 {user_links_joined} 条")
-        
-        # 如果当前用户没有短链接但数据库中有短链接，则显示所有短链接
-        if (user_links_direct == 0 and user_links_joined == 0) and all_links_count > 0:
-            logger.info("当前用户没有短链接，将显示所有短链接")
-            
-            # 使用简单查询
-            query = db.query(ShortLink)
-            if search:
-                query = query.filter(
-                    ShortLink.code.contains(search) | 
-                    ShortLink.target_file.contains(search)
-                )
-            
-            total = query.count()
-            short_links = query.order_by(ShortLink.created_at.desc()).offset(offset).limit(limit).all()
-        else:
-            # 如果join查询有结果，使用join查询
-            if user_links_joined > 0:
-                # 使用join查询
-                query = db.query(ShortLink).join(
-                    Image, ShortLink.target_file == Image.filename
-                ).filter(Image.user_id == user_id)
-                
-                if search:
-                    query = query.filter(
-                        ShortLink.code.contains(search) | 
-                        ShortLink.target_file.contains(search) |
-                        Image.original_filename.contains(search)
-                    )
-                
-                total = query.count()
-                short_links = query.order_by(ShortLink.created_at.desc()).offset(offset).limit(limit).all()
-            else:
-                # 使用直接查询
-                query = db.query(ShortLink).filter(ShortLink.user_id == user_id)
-                if search:
-                    query = query.filter(
-                        ShortLink.code.contains(search) | 
-                        ShortLink.target_file.contains(search)
-                    )
-                
-                total = query.count()
-                short_links = query.order_by(ShortLink.created_at.desc()).offset(offset).limit(limit).all()
+        # 在数据库线程池中执行查询，避免阻塞事件循环
+        short_links, total = await run_db(_query_short_links, user_id, search, offset, limit)
         
         logger.info(f"最终查询结果: 找到 {len(short_links)} 条短链接记录")
         
@@ -260,8 +341,7 @@ async def manage_short_links(
 @router.delete("/admin/short-links/{code}", tags=["页面"], summary="删除短链接", description="删除指定的短链接")
 async def delete_short_link(
     code: str,
-    request: Request,
-    db: Session = Depends(get_db)
+    request: Request
 ):
     """删除指定的短链接"""
     logger.info(f"接收到删除短链接请求: code={code}")
@@ -272,28 +352,16 @@ async def delete_short_link(
             logger.warning("删除短链接失败: 用户未登录")
             return {"success": False, "message": "用户未登录"}
         
-        # 查询短链接
-        short_link = db.query(ShortLink).filter(ShortLink.code == code).first()
-        if not short_link:
+        # 查询、检查权限并删除短链接
+        status_code = await run_db(delete_owned_short_link, code, user_id)
+        if status_code == 404:
             logger.warning(f"删除短链接失败: 短链接不存在, code={code}")
             return {"success": False, "message": "短链接不存在"}
-        
-        # 检查权限（验证是否是该用户创建的短链接）
-        # 查找关联的图片
-        image = db.query(Image).filter(Image.filename == short_link.target_file).first()
-        if image and image.user_id != user_id:
-            logger.warning(f"用户({user_id})尝试删除其他用户({image.user_id})的短链接: {code}")
+        if status_code == 403:
             return {"success": False, "message": "无权删除其他用户的短链接"}
-        
-        # 删除短链接
-        db.delete(short_link)
-        db.commit()
         logger.info(f"短链接已删除: code={code}, user_id={user_id}")
         
         return {"success": True, "message": "短链接已成功删除"}
     except Exception as e:
         logger.error(f"删除短链接时出错: {str(e)}", exc_info=True)
-        db.rollback()
-        return {"success": False, "message": f"删除短链接时出错: {str(e)}"}
-
-# 删除了测试页面路由 
\ No newline at end of file
+        return {"success": False, "message": f"删除短链接时出错: {str(e)}"}
\ No newline at end of file
@@ -0,0 +1,300 @@
+"""
+感知哈希与相似图片查找
+
+上传时在内容检测使用的缩略图上计算64位差值哈希（dHash），保存在images.phash中。
+重新编码、缩放或轻微调色后的副本与原图的哈希只有少数几位不同，按汉明距离查找即可发现。
+
+查找使用多索引哈希：把64位哈希分成4段16位，每段按值排序建立一张表。两个哈希的汉明距离
+不超过k时，至少有一段的距离不超过 k // 4，因此只需在每张表中查找与查询段相差不超过 k // 4 位的值，
+再计算候选的完整距离。k不超过7时每段只需查找17个值，查找次数与图片总数无关。
+
+索引在第一次查找时从数据库分批加载，之后每次查找前按id读取新上传的图片，
+新记录先放在待合并区线性比较，积累到一定数量后再合并进排序表。已删除的图片在返回前
+按数据库过滤；为已有图片回填的哈希在下次完整加载（PHASH_INDEX_REFRESH）后生效。
+
+回填旧图片的哈希：
+    python -m src.phash backfill [--batch-size 500]
+"""
+import argparse
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image as PILImage
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+
+from src.storage import resolve_upload_path
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+PHASH_ENABLED = os.getenv("PHASH_ENABLED", "true").lower() == "true"
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 10))  # 查询允许的最大汉明距离
+PHASH_INDEX_REFRESH = int(os.getenv("PHASH_INDEX_REFRESH", 3600))  # 完整重新加载索引的间隔(秒)，0表示不重新加载
+
+# 哈希的宽和高，比较相邻像素得到 8x8=64 位
+HASH_SIZE = 8
+# 分段数和每段位数
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+# 待合并区达到该数量时合并进排序表
+MERGE_SIZE = 4096
+# 从数据库加载索引时每批读取的行数
+LOAD_BATCH_SIZE = 50000
+
+# 每个字节的置1位数，用于批量计算汉明距离
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def dhash(img: PILImage.Image) -> int:
+    """计算64位差值哈希：缩小为9x8灰度图，逐行比较相邻像素的亮度"""
+    gray = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), PILImage.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def to_signed(value: int) -> int:
+    """SQLite的INTEGER是有符号64位整数，存储前转换"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+def hamming_distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    """计算uint64数组中每个哈希与value的汉明距离"""
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    return _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+def _flip_masks(radius: int) -> np.ndarray:
+    """一段内不超过radius位不同的所有异或掩码"""
+    masks = [0]
+    for r in range(1, radius + 1):
+        for bits in itertools.combinations(range(CHUNK_BITS), r):
+            masks.append(sum(1 << b for b in bits))
+    return np.array(masks, dtype=np.uint16)
+
+class MultiIndexHash:
+    """按16位分段排序的多索引哈希表，支持追加和按汉明距离查找"""
+
+    def __init__(self):
+        self._ids = np.empty(0, dtype=np.int64)
+        self._hashes = np.empty(0, dtype=np.uint64)
+        # 每段: (排序后的段值, 对应的行号)
+        self._tables: List[Tuple[np.ndarray, np.ndarray]] = []
+        self._pending_ids: List[int] = []
+        self._pending_hashes: List[int] = []
+        self._masks = {}
+        self._build_tables()
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._pending_ids)
+
+    def _build_tables(self):
+        self._tables = []
+        for c in range(CHUNKS):
+            keys = ((self._hashes >> np.uint64(c * CHUNK_BITS)) & np.uint64(CHUNK_MASK)).astype(np.uint16)
+            order = np.argsort(keys, kind="stable")
+            self._tables.append((keys[order], order))
+
+    def load(self, ids: np.ndarray, hashes: np.ndarray):
+        """用完整的数据替换索引内容"""
+        self._ids = ids
+        self._hashes = hashes
+        self._pending_ids = []
+        self._pending_hashes = []
+        self._build_tables()
+
+    def add_many(self, ids: List[int], hashes: List[int]):
+        """追加 (id, 无符号哈希)，先放入待合并区"""
+        self._pending_ids.extend(ids)
+        self._pending_hashes.extend(hashes)
+        if len(self._pending_ids) >= MERGE_SIZE:
+            self.merge()
+
+    def merge(self):
+        """把待合并区并入排序表"""
+        if not self._pending_ids:
+            return
+        self._ids = np.concatenate([self._ids, np.array(self._pending_ids, dtype=np.int64)])
+        self._hashes = np.concatenate([self._hashes, np.array(self._pending_hashes, dtype=np.uint64)])
+        self._pending_ids = []
+        self._pending_hashes = []
+        self._build_tables()
+
+    def _probe_masks(self, radius: int) -> np.ndarray:
+        if radius not in self._masks:
+            self._masks[radius] = _flip_masks(radius)
+        return self._masks[radius]
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, int]]:
+        """返回与value的汉明距离不超过max_distance的 (id, 距离)，按距离排序"""
+        masks = self._probe_masks(max_distance // CHUNKS)
+        candidates = []
+        for c, (keys, order) in enumerate(self._tables):
+            if len(keys) == 0:
+                break
+            probes = np.bitwise_xor(masks, np.uint16((value >> (c * CHUNK_BITS)) & CHUNK_MASK))
+            starts = np.searchsorted(keys, probes, side="left")
+            ends = np.searchsorted(keys, probes, side="right")
+            for start, end in zip(starts[starts < ends], ends[starts < ends]):
+                candidates.append(order[start:end])
+
+        results = []
+        if candidates:
+            rows = np.unique(np.concatenate(candidates))
+            distances = hamming_distances(self._hashes[rows], value)
+            matched = distances <= max_distance
+            results.extend(zip(self._ids[rows][matched].tolist(), distances[matched].tolist()))
+        if self._pending_ids:
+            distances = hamming_distances(np.array(self._pending_hashes, dtype=np.uint64), value)
+            for i in np.nonzero(distances <= max_distance)[0].tolist():
+                results.append((self._pending_ids[i], int(distances[i])))
+        results.sort(key=lambda item: (item[1], item[0]))
+        return results
+
+class PhashIndex:
+    """进程内的相似图片索引，首次查找时加载，之后按id增量同步数据库中的新图片"""
+
+    def __init__(self):
+        self._index: Optional[MultiIndexHash] = None
+        self._last_id = 0
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _fetch_batches(self, db: Session):
+        """按id顺序分批读取上次同步之后的图片哈希，产出 (id数组, 无符号哈希数组)"""
+        while True:
+            rows = db.execute(
+                text("SELECT id, phash FROM images WHERE id > :last_id AND phash IS NOT NULL "
+                     "ORDER BY id LIMIT :limit"),
+                {"last_id": self._last_id, "limit": LOAD_BATCH_SIZE}
+            ).fetchall()
+            if not rows:
+                break
+            self._last_id = rows[-1][0]
+            ids, hashes = zip(*rows)
+            yield np.array(ids, dtype=np.int64), np.array(hashes, dtype=np.int64).view(np.uint64)
+
+    def sync(self, db: Session) -> MultiIndexHash:
+        """加载或增量更新索引，返回可查找的索引"""
+        expired = PHASH_INDEX_REFRESH > 0 and time.monotonic() - self._loaded_at > PHASH_INDEX_REFRESH
+        if self._index is None or expired:
+            started = time.monotonic()
+            self._last_id = 0
+            batches = list(self._fetch_batches(db))
+            index = MultiIndexHash()
+            if batches:
+                index.load(np.concatenate([b[0] for b in batches]), np.concatenate([b[1] for b in batches]))
+            self._index = index
+            self._loaded_at = time.monotonic()
+            logger.info(f"相似图片索引已加载: {len(index)} 张图片 ({time.monotonic() - started:.2f}s)")
+        else:
+            for ids, hashes in self._fetch_batches(db):
+                self._index.add_many(ids.tolist(), hashes.tolist())
+        return self._index
+
+    def search(self, db: Session, value: int, max_distance: int) -> List[Tuple[int, int]]:
+        with self._lock:
+            return self.sync(db).search(value, max_distance)
+
+    def reset(self):
+        with self._lock:
+            self._index = None
+
+phash_index = PhashIndex()
+
+def find_similar(db: Session, filename: str, user_id: Optional[str], max_distance: int,
+                 limit: int) -> Optional[dict]:
+    """
+    查找与filename相似的图片，只返回user_id上传的图片
+
+    图片不存在时返回None；图片没有哈希（非位图或上传于启用该功能之前）时results为空
+    """
+    row = db.execute(text("SELECT id, phash FROM images WHERE filename = :filename"),
+                     {"filename": filename}).first()
+    if row is None:
+        return None
+    image_id, phash = row
+    result = {"filename": filename, "phash": None, "distance": max_distance, "results": []}
+    if phash is None:
+        return result
+    value = to_unsigned(phash)
+    result["phash"] = f"{value:016x}"
+
+    matches = [(i, d) for i, d in phash_index.search(db, value, max_distance) if i != image_id]
+    distances = dict(matches)
+    # 按距离顺序分批读取，跳过已删除和其他用户的图片
+    owner = "user_id = :user_id" if user_id is not None else "user_id IS NULL"
+    query = text(
+        f"SELECT id, filename, original_filename, width, height FROM images WHERE id IN :ids AND {owner}"
+    ).bindparams(bindparam("ids", expanding=True))
+    for start in range(0, len(matches), 500):
+        ids = [i for i, _ in matches[start:start + 500]]
+        rows = db.execute(query, {"ids": ids, "user_id": user_id}).fetchall()
+        for rid, name, original_filename, width, height in sorted(rows, key=lambda r: (distances[r[0]], r[0])):
+            result["results"].append({
+                "filename": name,
+                "original_filename": original_filename,
+                "width": width,
+                "height": height,
+                "distance": distances[rid],
+            })
+            if len(result["results"]) >= limit:
+                return result
+    return result
+
+def backfill(db: Session, batch_size: int = 500) -> int:
+    """为没有哈希的旧图片计算哈希，返回更新的数量"""
+    # utils在上传时导入本模块计算哈希，这里延迟导入避免循环引用
+    from src.utils import analyze_image
+
+    updated = 0
+    last_id = 0
+    while True:
+        rows = db.execute(
+            text("SELECT id, filename FROM images WHERE id > :last_id AND phash IS NULL ORDER BY id LIMIT :limit"),
+            {"last_id": last_id, "limit": batch_size}
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = []
+        for image_id, filename in rows:
+            path = resolve_upload_path(filename)
+            if path is None:
+                continue
+            _, value = analyze_image(path)
+            if value is not None:
+                updates.append({"id": image_id, "phash": to_signed(value)})
+        if updates:
+            db.execute(text("UPDATE images SET phash = :phash WHERE id = :id"), updates)
+            db.commit()
+            updated += len(updates)
+        logger.info(f"感知哈希回填: 已处理到id {last_id}，更新 {updated} 张")
+    return updated
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="感知哈希工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    fill = sub.add_parser("backfill", help="为没有哈希的旧图片计算哈希")
+    fill.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    from src.database import SessionLocal
+    db = SessionLocal()
+    try:
+        if args.command == "backfill":
+            print(f"已更新 {backfill(db, args.batch_size)} 张图片的感知哈希")
+    finally:
+        db.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""
+按需性能分析
+
+设置 PROFILE_TOKEN 后启用，未设置时所有分析功能和接口都不可用。
+
+单个请求分析：在请求中带上 X-Profile 请求头（或 __profile 查询参数）以及令牌
+（X-Profile-Token 请求头或 __profile_token 查询参数），响应头 X-Profile-Id 为结果文件名：
+    X-Profile: cprofile  使用cProfile记录事件循环线程上的调用，结果为.pstats文件；
+                         线程池中执行的图片处理只体现为等待时间，同时处理的其他请求也会被记录
+    X-Profile: sample    对所有线程定期采样调用栈（包括图片处理线程池），结果为折叠栈.collapsed文件
+
+时间窗口采样：POST /admin/profiles/sample?seconds=30 在当前worker中采样一段时间内所有请求的热点调用栈。
+
+结果通过 GET /admin/profiles/{name} 下载，.pstats可以用snakeviz等工具查看，
+.collapsed可以直接导入speedscope或用flamegraph.pl生成火焰图。
+"""
+import asyncio
+import cProfile
+import hmac
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Callable, Dict, Optional
+from urllib.parse import parse_qs
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import FileResponse
+
+from src.storage import run_io
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 50))  # 最多保留的结果文件数量
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.005))  # 采样间隔(秒)
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 300))  # 时间窗口采样的最长时间
+
+# 同一进程中同时只能运行一个cProfile
+_cprofile_lock = threading.Lock()
+# 同一进程中同时只运行一个时间窗口采样
+_window_lock = threading.Lock()
+
+router = APIRouter()
+
+def profiling_enabled() -> bool:
+    return bool(PROFILE_TOKEN)
+
+def check_token(token: Optional[str]) -> bool:
+    """常量时间比较令牌"""
+    return profiling_enabled() and bool(token) and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+def _new_profile_name(kind: str, label: str, suffix: str) -> str:
+    label = re.sub(r"[^A-Za-z0-9]+", "_", label).strip("_")[:40] or "root"
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}-{label}-{uuid.uuid4().hex[:8]}{suffix}"
+
+def _prune_profiles():
+    """只保留最新的PROFILE_MAX_FILES个结果文件"""
+    try:
+        entries = sorted(
+            (e for e in os.scandir(PROFILE_DIR) if e.is_file()),
+            key=lambda e: e.stat().st_mtime,
+            reverse=True
+        )
+        for entry in entries[PROFILE_MAX_FILES:]:
+            os.remove(entry.path)
+    except OSError as e:
+        logger.warning(f"清理性能分析结果失败: {str(e)}")
+
+def _profile_path(name: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, name)
+
+def _write_profile(save: Callable[[str], None], name: str):
+    """保存结果文件并清理旧文件，在IO线程池中执行"""
+    save(_profile_path(name))
+    _prune_profiles()
+
+def _list_profiles() -> list:
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    entries = sorted(
+        (e for e in os.scandir(PROFILE_DIR) if e.is_file()),
+        key=lambda e: e.stat().st_mtime,
+        reverse=True
+    )
+    return [{"name": e.name, "size": e.stat().st_size, "created_at": e.stat().st_mtime} for e in entries]
+
+class StackSampler:
+    """
+    统计式采样分析器
+
+    后台线程每隔interval秒通过sys._current_frames()读取所有线程的调用栈并计数，
+    开销与线程数成正比，不需要修改被分析的代码。结果为折叠栈格式，每行为
+    "线程;外层函数;...;内层函数 次数"
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _thread_label(name: str) -> str:
+        # 线程池中的线程按池名合并，例如 picui_worker_3 -> picui_worker
+        return re.sub(r"_\d+$", "", name)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names: Dict[int, str] = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(self._thread_label(names.get(thread_id, str(thread_id))))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="picui_profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stop_and_save(self, path: str):
+        """停止采样并保存结果，会等待采样线程退出，应在线程池中调用"""
+        self.stop()
+        self.save(path)
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+class ProfilingMiddleware:
+    """对带有分析标记和有效令牌的请求进行性能分析的ASGI中间件"""
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _profile_request(scope) -> Optional[str]:
+        """返回请求要求的分析模式，未要求或令牌无效时返回None"""
+        headers = dict(scope.get("headers") or [])
+        mode = headers.get(b"x-profile", b"").decode("latin-1")
+        token = headers.get(b"x-profile-token", b"").decode("latin-1")
+        if not mode and b"__profile" in scope.get("query_string", b""):
+            query = parse_qs(scope["query_string"].decode("latin-1"))
+            mode = query.get("__profile", [""])[0]
+            token = token or query.get("__profile_token", [""])[0]
+        if not mode:
+            return None
+        if not check_token(token):
+            logger.warning(f"性能分析令牌无效，忽略分析请求: {scope.get('path')}")
+            return None
+        return "sample" if mode.lower() == "sample" else "cprofile"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiling_enabled():
+            await self.app(scope, receive, send)
+            return
+        mode = self._profile_request(scope)
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+
+        if mode == "cprofile" and not _cprofile_lock.acquire(blocking=False):
+            # 已有请求正在使用cProfile，本次请求不分析
+            await self.app(scope, receive, self._with_headers(send, {b"x-profile-status": b"busy"}))
+            return
+
+        suffix = ".pstats" if mode == "cprofile" else ".collapsed"
+        name = _new_profile_name(mode, f"{scope['method']}_{scope['path']}", suffix)
+        send = self._with_headers(send, {b"x-profile-id": name.encode("latin-1")})
+        started = time.perf_counter()
+        if mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                profiler.disable()
+                _cprofile_lock.release()
+                # 写入结果文件不阻塞事件循环
+                await run_io("profile_write", _write_profile, profiler.dump_stats, name)
+        else:
+            sampler = StackSampler()
+            sampler.start()
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                await run_io("profile_write", _write_profile, sampler.stop_and_save, name)
+        logger.info(f"已保存性能分析结果: {name} ({time.perf_counter() - started:.3f}s)")
+
+    @staticmethod
+    def _with_headers(send, extra: Dict[bytes, bytes]):
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + list(extra.items())
+            await send(message)
+        return send_wrapper
+
+def _require_token(request: Request):
+    """未启用分析时返回404，令牌无效时返回403"""
+    if not profiling_enabled():
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = request.headers.get("x-profile-token") or request.query_params.get("__profile_token")
+    if not check_token(token):
+        raise HTTPException(status_code=403, detail="性能分析令牌无效")
+
+@router.get("/admin/profiles", tags=["系统"], summary="性能分析结果列表", include_in_schema=False)
+async def list_profiles(request: Request):
+    _require_token(request)
+    return {"profiles": await run_io("stat", _list_profiles)}
+
+@router.get("/admin/profiles/{name}", tags=["系统"], summary="下载性能分析结果", include_in_schema=False)
+async def download_profile(name: str, request: Request):
+    _require_token(request)
+    if os.path.basename(name) != name or not name.endswith((".pstats", ".collapsed")):
+        raise HTTPException(status_code=404, detail="结果文件不存在")
+    path = os.path.join(PROFILE_DIR, name)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="结果文件不存在")
+    media_type = "text/plain" if name.endswith(".collapsed") else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=name)
+
+@router.post("/admin/profiles/sample", tags=["系统"], summary="时间窗口采样分析", include_in_schema=False)
+async def sample_window(
+    request: Request,
+    seconds: float = Query(30, gt=0),
+    interval: float = Query(PROFILE_SAMPLE_INTERVAL, ge=0.001, le=1.0)
+):
+    """在当前worker中采样指定时间内所有线程的调用栈，完成后返回结果文件名"""
+    _require_token(request)
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+    if not _window_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="已有采样正在进行")
+    try:
+        sampler = StackSampler(interval)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            name = _new_profile_name("window", f"{int(seconds)}s", ".collapsed")
+            await run_io("profile_write", _write_profile, sampler.stop_and_save, name)
+    finally:
+        _window_lock.release()
+    logger.info(f"已保存时间窗口采样结果: {name}, 共 {sampler.samples} 次采样")
+    return {"name": name, "samples": sampler.samples, "pid": os.getpid(), "url": f"/admin/profiles/{name}"}
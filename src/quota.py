@@ -0,0 +1,222 @@
+"""
+按用户的存储配额
+
+用户已用的字节数和文件数读取stat_counters中的bytes和images计数，由images表的触发器在
+上传和删除时同步增减，检查配额只需一次主键查询。上传在写入文件之前检查配额并预留额度，
+记录写入并计入计数器后释放。
+
+预留记录保存在quota_reservations表中，检查和预留在一条INSERT ... SELECT语句中完成，
+SQLite串行执行写入，多个worker同时上传时也不会一起越过配额。worker在上传过程中退出时
+留下的预留记录超过QUOTA_RESERVATION_TTL秒后不再计入，并在该用户下次上传时删除。
+没有该表（非SQLite数据库或尚未迁移）时在进程内预留，只能保证同一worker内不超出配额。
+
+定期校准按磁盘上的实际文件大小修正images.file_size，再重新统计计数器。
+"""
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from src.counters import get_counters, has_counters, reconcile_counters
+from src.data_access import run_db
+from src.storage import resolve_upload_path
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+USER_QUOTA_BYTES = int(os.getenv("USER_QUOTA_BYTES", 1024 * 1024 * 1024))  # 每个用户的存储字节数上限，0表示不限制
+USER_QUOTA_FILES = int(os.getenv("USER_QUOTA_FILES", 10000))  # 每个用户的图片数量上限，0表示不限制
+QUOTA_RECONCILE_INTERVAL = int(os.getenv("QUOTA_RECONCILE_INTERVAL", 86400))  # 按磁盘文件校准用量的间隔(秒)
+QUOTA_RECONCILE_BATCH_SIZE = 1000
+
+QUOTA_RESERVATION_TTL = int(os.getenv("QUOTA_RESERVATION_TTL", 3600))  # 预留额度的最长有效时间(秒)
+
+# 没有quota_reservations表时，本进程中正在上传、尚未计入计数器的额度: user_id -> [字节数, 文件数]
+_reserved: Dict[str, List[int]] = {}
+_reserved_lock = threading.Lock()
+
+# 预留表是否存在（由迁移创建），结果在进程内缓存
+_reservations_available = None
+
+# 在一条语句中检查配额并写入预留记录，SELECT不返回行时表示超出配额
+_RESERVE_SQL = text("""
+    INSERT INTO quota_reservations (user_id, bytes, created_at)
+    SELECT :user_id, :size, :now
+    WHERE (:max_files <= 0 OR
+           COALESCE((SELECT value FROM stat_counters WHERE name = 'images' AND user_id = :user_id), 0)
+           + (SELECT COUNT(*) FROM quota_reservations WHERE user_id = :user_id AND created_at > :cutoff)
+           + 1 <= :max_files)
+      AND (:max_bytes <= 0 OR
+           COALESCE((SELECT value FROM stat_counters WHERE name = 'bytes' AND user_id = :user_id), 0)
+           + COALESCE((SELECT SUM(bytes) FROM quota_reservations WHERE user_id = :user_id AND created_at > :cutoff), 0)
+           + :size <= :max_bytes)
+""")
+
+def quota_enabled() -> bool:
+    return USER_QUOTA_BYTES > 0 or USER_QUOTA_FILES > 0
+
+def has_reservations(db: Session) -> bool:
+    """检查quota_reservations表是否存在"""
+    global _reservations_available
+    if _reservations_available is None:
+        _reservations_available = has_counters(db) and db.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'quota_reservations'")
+        ).first() is not None
+    return _reservations_available
+
+def get_usage(db: Session, user_id: Optional[str]) -> Tuple[int, int]:
+    """返回用户已用的 (字节数, 文件数)"""
+    counters = get_counters(db, [("bytes", user_id), ("images", user_id)])
+    return counters[("bytes", user_id)], counters[("images", user_id)]
+
+def get_quota_info(db: Session, user_id: Optional[str]) -> dict:
+    used_bytes, used_files = get_usage(db, user_id)
+    return {
+        "used_bytes": used_bytes,
+        "used_files": used_files,
+        "limit_bytes": USER_QUOTA_BYTES or None,
+        "limit_files": USER_QUOTA_FILES or None,
+    }
+
+def _quota_error(used_bytes: int, used_files: int, pending_bytes: int, pending_files: int,
+                 size: int) -> Optional[str]:
+    if USER_QUOTA_FILES > 0 and used_files + pending_files + 1 > USER_QUOTA_FILES:
+        return f"已达到图片数量上限 ({USER_QUOTA_FILES} 张)"
+    if USER_QUOTA_BYTES > 0 and used_bytes + pending_bytes + size > USER_QUOTA_BYTES:
+        return (f"存储空间不足 (已用 {used_bytes / 1024 / 1024:.1f}MB，"
+                f"上限 {USER_QUOTA_BYTES / 1024 / 1024:.1f}MB)")
+    return None
+
+def _pending_in_db(db: Session, user_id: str, cutoff: float) -> Tuple[int, int]:
+    row = db.execute(
+        text("SELECT COALESCE(SUM(bytes), 0), COUNT(*) FROM quota_reservations "
+             "WHERE user_id = :user_id AND created_at > :cutoff"),
+        {"user_id": user_id, "cutoff": cutoff}
+    ).first()
+    return row[0], row[1]
+
+def check_quota(db: Session, user_id: Optional[str], size: int) -> Optional[str]:
+    """只检查上传size字节后是否超出配额（包括正在进行的上传），不预留额度"""
+    if not quota_enabled() or user_id is None:
+        return None
+    used_bytes, used_files = get_usage(db, user_id)
+    if has_reservations(db):
+        pending_bytes, pending_files = _pending_in_db(db, user_id, time.time() - QUOTA_RESERVATION_TTL)
+    else:
+        with _reserved_lock:
+            pending_bytes, pending_files = _reserved.get(user_id, [0, 0])
+    return _quota_error(used_bytes, used_files, pending_bytes, pending_files, size)
+
+def reserve_quota(db: Session, user_id: Optional[str], size: int) -> Optional[str]:
+    """
+    检查上传size字节后是否超出配额，未超出时预留额度并返回None，超出时返回错误信息
+
+    预留的额度在上传结束后由release_quota释放，此时记录已写入数据库并计入计数器
+    """
+    if not quota_enabled() or user_id is None:
+        return None
+    if not has_reservations(db):
+        used_bytes, used_files = get_usage(db, user_id)
+        with _reserved_lock:
+            pending = _reserved.get(user_id, [0, 0])
+            error = _quota_error(used_bytes, used_files, pending[0], pending[1], size)
+            if error is None:
+                _reserved[user_id] = [pending[0] + size, pending[1] + 1]
+        return error
+
+    now = time.time()
+    cutoff = now - QUOTA_RESERVATION_TTL
+    # 删除过期的预留记录（写入过程中退出的worker留下的），同时取得写锁
+    db.execute(text("DELETE FROM quota_reservations WHERE user_id = :user_id AND created_at <= :cutoff"),
+               {"user_id": user_id, "cutoff": cutoff})
+    inserted = db.execute(_RESERVE_SQL, {
+        "user_id": user_id, "size": size, "now": now, "cutoff": cutoff,
+        "max_files": USER_QUOTA_FILES, "max_bytes": USER_QUOTA_BYTES,
+    }).rowcount
+    if inserted:
+        db.commit()
+        return None
+    # 超出配额，在同一事务中读取用量生成错误信息
+    used_bytes, used_files = get_usage(db, user_id)
+    pending_bytes, pending_files = _pending_in_db(db, user_id, cutoff)
+    db.commit()
+    return _quota_error(used_bytes, used_files, pending_bytes, pending_files, size) or "存储配额不足"
+
+def _release_reservations(db: Session, user_id: str, sizes: Tuple[int, ...]):
+    if not has_reservations(db):
+        with _reserved_lock:
+            pending = _reserved.get(user_id)
+            if pending is None:
+                return
+            pending[0] -= sum(sizes)
+            pending[1] -= len(sizes)
+            if pending[1] <= 0:
+                del _reserved[user_id]
+        return
+    # 同一用户相同大小的预留记录可以互换，每个size删除一条
+    db.execute(
+        text("DELETE FROM quota_reservations WHERE id = (SELECT id FROM quota_reservations "
+             "WHERE user_id = :user_id AND bytes = :size ORDER BY id LIMIT 1)"),
+        [{"user_id": user_id, "size": size} for size in sizes]
+    )
+    db.commit()
+
+async def release_quota(user_id: Optional[str], *sizes: int):
+    """释放reserve_quota预留的额度，每个size对应一次预留；释放失败的记录会在过期后失效"""
+    if not quota_enabled() or user_id is None or not sizes:
+        return
+    try:
+        await run_db(_release_reservations, user_id, sizes)
+    except Exception as e:
+        logger.error(f"释放预留的存储配额失败: user_id={user_id}, {str(e)}")
+
+def sync_file_sizes(db: Session, batch_size: int = QUOTA_RECONCILE_BATCH_SIZE) -> Dict[str, int]:
+    """
+    按磁盘上的实际文件大小修正images.file_size，触发器会同步更新字节计数
+
+    按id分批读取和提交，每批只短暂持有写锁；文件不存在的记录只计数，由孤儿文件清理处理
+    """
+    stats = {"checked": 0, "updated": 0, "missing": 0}
+    last_id = 0
+    while True:
+        rows = db.execute(
+            text("SELECT id, filename, file_size FROM images WHERE id > :last_id ORDER BY id LIMIT :limit"),
+            {"last_id": last_id, "limit": batch_size}
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = []
+        for image_id, filename, file_size in rows:
+            stats["checked"] += 1
+            path = resolve_upload_path(filename)
+            if path is None:
+                stats["missing"] += 1
+                continue
+            try:
+                actual = os.path.getsize(path)
+            except OSError:
+                stats["missing"] += 1
+                continue
+            if round((file_size or 0) * 1024) != actual:
+                updates.append({"id": image_id, "file_size": actual / 1024})
+        if updates:
+            db.execute(text("UPDATE images SET file_size = :file_size WHERE id = :id"), updates)
+            db.commit()
+            stats["updated"] += len(updates)
+    return stats
+
+def reconcile_quota_usage(db: Session) -> Dict[str, int]:
+    """按磁盘文件校准用量，再重新统计计数器"""
+    started = time.time()
+    stats = sync_file_sizes(db)
+    stats["counter_drift"] = reconcile_counters(db)
+    level = logging.WARNING if stats["updated"] or stats["counter_drift"] else logging.INFO
+    logger.log(level, f"存储用量校准完成: 检查 {stats['checked']} 个文件，修正大小 {stats['updated']} 个，"
+                      f"文件缺失 {stats['missing']} 个，计数器偏差 {stats['counter_drift']} 个 "
+                      f"({time.time() - started:.1f}s)")
+    return stats
@@ -0,0 +1,137 @@
+"""
+按新的肤色阈值重新检测已上传的图片
+
+调整SKIN_THRESHOLD后，新阈值只对之后的上传生效。本工具按id分批读取图片记录，
+每批图片在线程池中以降低的分辨率并行解码，再一次计算整批的肤色占比，
+超过阈值的图片以JSON行输出到标准输出，最后一行为汇总。
+
+处理方式（--action）：
+    report  只输出超过阈值的图片
+    delete  删除超过阈值的图片记录、指向它的短链接和文件
+
+中断后可以用 --start-id 从日志中最后处理的id继续。--fill-phash 同时为没有感知哈希的旧图片补齐哈希。
+
+用法:
+    python -m src.rescan [--threshold 0.6] [--action report|delete] [--batch-size 64] [--workers 4]
+                         [--start-id 0] [--fill-phash]
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Optional, TextIO
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+
+from src.phash import to_signed
+from src.storage import UPLOAD_DIR, resolve_upload_path, remove_upload
+from src.utils import scan_images
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+SKIN_THRESHOLD = float(os.getenv("SKIN_THRESHOLD", "0.5"))
+ACTIONS = ("report", "delete")
+
+def _delete_images(db: Session, filenames: List[str]):
+    """先删除记录再删除文件，文件删除失败时由孤儿清理处理"""
+    params = {"filenames": filenames}
+    db.execute(text("DELETE FROM short_links WHERE target_file IN :filenames").bindparams(
+        bindparam("filenames", expanding=True)), params)
+    db.execute(text("DELETE FROM images WHERE filename IN :filenames").bindparams(
+        bindparam("filenames", expanding=True)), params)
+    db.commit()
+    for filename in filenames:
+        try:
+            remove_upload(filename)
+        except OSError as e:
+            logger.warning(f"删除文件失败: {filename}, {str(e)}")
+
+def rescan(db: Session, threshold: float = SKIN_THRESHOLD, action: str = "report", batch_size: int = 64,
+           workers: Optional[int] = None, start_id: int = 0, fill_phash: bool = False,
+           out: Optional[TextIO] = None) -> Dict[str, int]:
+    """重新检测id大于start_id的所有图片，返回汇总"""
+    if action not in ACTIONS:
+        raise ValueError(f"未知的处理方式: {action}")
+    out = out or sys.stdout
+    started = time.time()
+    stats = {"scanned": 0, "flagged": 0, "deleted": 0, "undecodable": 0, "missing": 0,
+             "phash_filled": 0, "last_id": start_id}
+    workers = workers or min(8, os.cpu_count() or 1)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="picui_rescan") as executor:
+        while True:
+            rows = db.execute(
+                text("SELECT id, filename, user_id, phash FROM images WHERE id > :last_id ORDER BY id LIMIT :limit"),
+                {"last_id": stats["last_id"], "limit": batch_size}
+            ).fetchall()
+            if not rows:
+                break
+
+            present, paths = [], []
+            for row in rows:
+                path = resolve_upload_path(row[1])
+                if path is None:
+                    stats["missing"] += 1
+                    continue
+                present.append(row)
+                paths.append(path)
+
+            flagged, hashes = [], []
+            for (image_id, filename, user_id, phash), (ratio, value) in zip(present, scan_images(paths, executor)):
+                stats["scanned"] += 1
+                if ratio is None:
+                    stats["undecodable"] += 1
+                    continue
+                if fill_phash and phash is None:
+                    hashes.append({"id": image_id, "phash": to_signed(value)})
+                if ratio > threshold:
+                    flagged.append(filename)
+                    out.write(json.dumps({"id": image_id, "filename": filename, "user_id": user_id,
+                                          "skin_ratio": round(ratio, 4)}, ensure_ascii=False) + "\n")
+
+            if hashes:
+                db.execute(text("UPDATE images SET phash = :phash WHERE id = :id"), hashes)
+                db.commit()
+                stats["phash_filled"] += len(hashes)
+            stats["flagged"] += len(flagged)
+            if flagged and action == "delete":
+                _delete_images(db, flagged)
+                stats["deleted"] += len(flagged)
+
+            stats["last_id"] = rows[-1][0]
+            logger.info(f"重新检测: 已处理到id {stats['last_id']}，检测 {stats['scanned']} 张，"
+                        f"超过阈值 {stats['flagged']} 张 ({time.time() - started:.1f}s)")
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="按新的肤色阈值重新检测已上传的图片")
+    parser.add_argument("--threshold", type=float, default=SKIN_THRESHOLD, help="肤色占比阈值(0-1)")
+    parser.add_argument("--action", choices=ACTIONS, default="report", help="超过阈值的图片的处理方式")
+    parser.add_argument("--batch-size", type=int, default=64, help="每批检测的图片数量")
+    parser.add_argument("--workers", type=int, default=0, help="并行解码的线程数，默认为CPU核数（最多8）")
+    parser.add_argument("--start-id", type=int, default=0, help="从该id之后开始，用于中断后继续")
+    parser.add_argument("--fill-phash", action="store_true", help="同时为没有感知哈希的图片补齐哈希")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
+    if not os.path.isdir(UPLOAD_DIR):
+        logger.error(f"上传目录不存在: {UPLOAD_DIR}")
+        return 1
+
+    from src.database import SessionLocal
+    db = SessionLocal()
+    try:
+        stats = rescan(db, args.threshold, args.action, args.batch_size, args.workers or None,
+                       args.start_id, args.fill_phash)
+    finally:
+        db.close()
+    print(json.dumps({"summary": stats}, ensure_ascii=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
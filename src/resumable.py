@@ -0,0 +1,499 @@
+"""
+断点续传上传（参照tus协议）
+
+网络不稳定的客户端把图片分块上传，中断后只需重传缺失的部分：
+    POST   /upload/resumable                 创建上传，请求头Upload-Length为文件总大小，
+                                            Upload-Metadata中的filename为base64编码的原始文件名
+    PATCH  /upload/resumable/{id}            请求头Upload-Offset为本块的起始位置，请求体为块内容
+    HEAD   /upload/resumable/{id}            响应头Upload-Offset为从0开始连续收到的字节数
+    GET    /upload/resumable/{id}            以JSON返回已收到的所有区间，用于并行上传时补传缺失的块
+    POST   /upload/resumable/{id}/finalize   所有字节收到后进入与/upload相同的处理流程，返回URL和短链接
+    DELETE /upload/resumable/{id}            放弃上传
+
+与tus不同，PATCH不要求按顺序发送，多个块可以并行上传到不同的位置。
+创建时按总大小预分配临时文件，每块直接写入文件中的对应位置，不在内存中拼接；
+已收到的区间和上传信息保存在旁边的JSON文件中，由文件锁保护，多个worker可以处理同一上传的不同块。
+每个PATCH在整个写入期间持有该上传的共享锁，多个块可以同时写入；完成请求需要取得互斥锁才能切换状态，
+有块正在写入时返回409，切换后开始的PATCH会看到新的状态，不会再写入已被移走的临时文件。
+最后一块之后RESUMABLE_EXPIRE秒内没有新的块或完成请求的上传会被定期清理。
+"""
+import base64
+import binascii
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from email.utils import formatdate
+from typing import List, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Request, Response
+
+from src.body_limit import RESUMABLE_MAX_CHUNK
+from src.data_access import run_db
+from src.quota import check_quota
+from src.routes import MAX_SIZE, save_upload
+from src.session import get_or_create_session, get_user_id
+from src.sniff import SNIFF_BYTES, PROBE_UNREADABLE, sniff_format, probe_image
+from src.storage import UPLOAD_DIR, FSYNC_POLICY, run_io, move_upload
+from src.utils import FileLock, allowed_file
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+# 临时文件目录，默认位于上传目录中，完成时在同一文件系统内移动文件
+RESUMABLE_DIR = os.getenv("RESUMABLE_DIR", os.path.join(UPLOAD_DIR, ".resumable"))
+RESUMABLE_EXPIRE = int(os.getenv("RESUMABLE_EXPIRE", 24 * 3600))  # 没有新的块时保留上传的时间(秒)
+RESUMABLE_MAX_SESSIONS = int(os.getenv("RESUMABLE_MAX_SESSIONS", 10))  # 每个用户同时进行的上传数量，0表示不限制
+RESUMABLE_CLEANUP_INTERVAL = int(os.getenv("RESUMABLE_CLEANUP_INTERVAL", 3600))  # 清理过期上传的间隔(秒)，0表示禁用
+
+TUS_VERSION = "1.0.0"
+TUS_EXTENSIONS = "creation,expiration,termination"
+# 写入文件前在内存中累积的字节数，减少线程池调度次数
+_WRITE_BUFFER = 1024 * 1024
+
+_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+_USER_PATTERN = re.compile(r"[\w-]+")
+
+# 创建路由器
+router = APIRouter()
+
+def _lock() -> FileLock:
+    # 所有上传共用一个锁文件，锁内只读写很小的JSON，块的写入不持有锁
+    return FileLock(os.path.join(RESUMABLE_DIR, ".lock"))
+
+def _upload_lock(user_id: str, upload_id: str, shared: bool = False) -> FileLock:
+    # 单个上传的锁，写入块时持有共享锁，进入完成状态时需要互斥锁
+    return FileLock(os.path.join(RESUMABLE_DIR, user_id, f"{upload_id}.lock"), shared=shared)
+
+def _paths(user_id: str, upload_id: str) -> Tuple[str, str]:
+    """上传的 (临时文件路径, 信息文件路径)"""
+    directory = os.path.join(RESUMABLE_DIR, user_id)
+    return os.path.join(directory, f"{upload_id}.part"), os.path.join(directory, f"{upload_id}.json")
+
+def _read_meta(meta_path: str) -> Optional[dict]:
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _write_meta(meta_path: str, meta: dict):
+    # 先写临时文件再替换，读取方不会看到写了一半的JSON
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+def _remove_session(user_id: str, upload_id: str):
+    for path in (*_paths(user_id, upload_id), _upload_lock(user_id, upload_id).path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _add_range(ranges: List[List[int]], start: int, end: int) -> List[List[int]]:
+    """把[start, end)合并进已排序的区间列表，相邻或重叠的区间合并为一个"""
+    merged = []
+    for s, e in sorted(ranges + [[start, end]]):
+        if merged and s <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+    return merged
+
+def _offset(meta: dict) -> int:
+    """从0开始连续收到的字节数"""
+    ranges = meta["ranges"]
+    return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+
+def _is_complete(meta: dict) -> bool:
+    return _offset(meta) >= meta["length"]
+
+def _expires_header(meta: dict) -> str:
+    return formatdate(meta["expires"], usegmt=True)
+
+def _tus_headers(meta: Optional[dict] = None) -> dict:
+    headers = {"Tus-Resumable": TUS_VERSION, "Cache-Control": "no-store"}
+    if meta is not None:
+        headers.update({
+            "Upload-Offset": str(_offset(meta)),
+            "Upload-Length": str(meta["length"]),
+            "Upload-Expires": _expires_header(meta),
+        })
+    return headers
+
+def _parse_metadata(value: str) -> dict:
+    """解析Upload-Metadata请求头：逗号分隔的"键 base64值"对"""
+    metadata = {}
+    for item in value.split(","):
+        key, _, encoded = item.strip().partition(" ")
+        if not key:
+            continue
+        try:
+            metadata[key] = base64.b64decode(encoded.strip(), validate=True).decode("utf-8")
+        except (binascii.Error, UnicodeDecodeError):
+            raise HTTPException(status_code=400, detail=f"Upload-Metadata中的{key}不是有效的base64编码")
+    return metadata
+
+def _int_header(request: Request, name: str) -> int:
+    value = request.headers.get(name)
+    if value is None:
+        raise HTTPException(status_code=400, detail=f"缺少{name}请求头")
+    if not value.isdigit():
+        raise HTTPException(status_code=400, detail=f"{name}请求头必须是非负整数")
+    return int(value)
+
+def _create_session(user_id: str, upload_id: str, meta: dict) -> Optional[str]:
+    """预分配临时文件并保存上传信息，返回错误信息"""
+    part_path, meta_path = _paths(user_id, upload_id)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    with _lock():
+        if RESUMABLE_MAX_SESSIONS > 0:
+            active = sum(1 for name in os.listdir(os.path.dirname(part_path)) if name.endswith(".json"))
+            if active >= RESUMABLE_MAX_SESSIONS:
+                return f"进行中的上传过多 (上限 {RESUMABLE_MAX_SESSIONS} 个)，请先完成或取消已有的上传"
+        with open(part_path, "wb") as f:
+            # 按总大小预分配磁盘空间，不支持时退化为稀疏文件
+            if hasattr(os, "posix_fallocate") and meta["length"] > 0:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, meta["length"])
+                except OSError:
+                    f.truncate(meta["length"])
+            else:
+                f.truncate(meta["length"])
+        _write_meta(meta_path, meta)
+    return None
+
+def _load_session(user_id: Optional[str], upload_id: str) -> Optional[dict]:
+    """读取当前用户的上传信息，不存在、不属于该用户或已过期时返回None"""
+    if not user_id or not _USER_PATTERN.fullmatch(user_id) or not _ID_PATTERN.fullmatch(upload_id):
+        return None
+    meta = _read_meta(_paths(user_id, upload_id)[1])
+    if meta is None or meta["expires"] < time.time():
+        return None
+    return meta
+
+def _record_range(user_id: str, upload_id: str, start: int, end: int) -> Optional[dict]:
+    """记录已写入的区间并延长有效期，返回更新后的上传信息"""
+    meta_path = _paths(user_id, upload_id)[1]
+    with _lock():
+        meta = _read_meta(meta_path)
+        if meta is None:
+            return None
+        if end > start:
+            meta["ranges"] = _add_range(meta["ranges"], start, end)
+        meta["expires"] = time.time() + RESUMABLE_EXPIRE
+        _write_meta(meta_path, meta)
+    return meta
+
+def _set_state(user_id: str, upload_id: str, expected: str, state: str) -> Tuple[Optional[dict], Optional[str]]:
+    """把上传从expected状态改为state，返回 (上传信息, 错误信息)"""
+    meta_path = _paths(user_id, upload_id)[1]
+    upload_lock = _upload_lock(user_id, upload_id)
+    # 取得上传的互斥锁时没有正在写入的块，之后开始的PATCH会看到新的状态
+    if state == "finalizing" and not upload_lock.acquire(blocking=False):
+        return _read_meta(meta_path), "有块正在上传，请稍后再完成"
+    try:
+        return _change_state(meta_path, expected, state)
+    finally:
+        upload_lock.release()
+
+def _change_state(meta_path: str, expected: str, state: str) -> Tuple[Optional[dict], Optional[str]]:
+    with _lock():
+        meta = _read_meta(meta_path)
+        if meta is None or meta["expires"] < time.time():
+            return None, "上传不存在或已过期"
+        if meta["state"] != expected:
+            return meta, "上传正在完成中"
+        if state == "finalizing" and not _is_complete(meta):
+            return meta, f"上传尚未完成 (已连续收到 {_offset(meta)}/{meta['length']} 字节)"
+        meta["state"] = state
+        meta["expires"] = time.time() + RESUMABLE_EXPIRE
+        _write_meta(meta_path, meta)
+    return meta, None
+
+def _terminate(user_id: str, upload_id: str) -> Optional[str]:
+    meta_path = _paths(user_id, upload_id)[1]
+    with _lock():
+        meta = _read_meta(meta_path)
+        if meta is None:
+            return "上传不存在或已过期"
+        if meta["state"] != "uploading":
+            return "上传正在完成中"
+        _remove_session(user_id, upload_id)
+    return None
+
+def _open_chunk(user_id: str, upload_id: str) -> Tuple[Optional[FileLock], Optional[int]]:
+    """
+    取得上传的共享锁后确认仍处于上传状态并打开临时文件，返回 (锁, 文件描述符)
+
+    已开始完成、已删除或已过期时返回 (None, None)
+    """
+    lock = _upload_lock(user_id, upload_id, shared=True)
+    lock.acquire()
+    try:
+        meta = _load_session(user_id, upload_id)
+        if meta is None or meta["state"] != "uploading":
+            lock.release()
+            return None, None
+        return lock, os.open(_paths(user_id, upload_id)[0], os.O_WRONLY)
+    except BaseException:
+        lock.release()
+        raise
+
+def _write_chunk(fd: int, data: bytes, offset: int):
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+    else:
+        # 每个请求使用自己的文件描述符，seek后写入不会与其他块冲突
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+def _close_chunk(fd: int):
+    try:
+        if FSYNC_POLICY in ("file", "full"):
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _read_head(path: str, size: int) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(size)
+
+def clean_expired_uploads() -> int:
+    """删除已过期的上传及其临时文件，返回删除的上传数量"""
+    now = time.time()
+    removed = 0
+    try:
+        user_dirs = [entry.path for entry in os.scandir(RESUMABLE_DIR) if entry.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return 0
+    for directory in user_dirs:
+        user_id = os.path.basename(directory)
+        with _lock():
+            for entry in os.scandir(directory):
+                upload_id, ext = os.path.splitext(entry.name)
+                if ext == ".json":
+                    meta = _read_meta(entry.path)
+                    if meta is not None and meta["expires"] >= now:
+                        continue
+                elif ext in (".part", ".lock"):
+                    # 没有信息文件的临时文件来自创建时的中断，按修改时间清理；
+                    # 已随信息文件一起删除的临时文件也会出现在列表中
+                    try:
+                        if os.path.exists(os.path.join(directory, f"{upload_id}.json")) \
+                                or entry.stat().st_mtime + RESUMABLE_EXPIRE >= now:
+                            continue
+                    except FileNotFoundError:
+                        continue
+                else:
+                    continue
+                _remove_session(user_id, upload_id)
+                if ext == ".json":
+                    removed += 1
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+    if removed:
+        logger.info(f"清理过期的断点续传上传: {removed} 个")
+    return removed
+
+@router.options("/upload/resumable", tags=["断点续传"], summary="查询断点续传支持的功能")
+async def resumable_options():
+    """tus协议的能力发现"""
+    return Response(status_code=204, headers={
+        "Tus-Resumable": TUS_VERSION,
+        "Tus-Version": TUS_VERSION,
+        "Tus-Extension": TUS_EXTENSIONS,
+        "Tus-Max-Size": str(MAX_SIZE),
+    })
+
+@router.post("/upload/resumable", tags=["断点续传"], summary="创建断点续传上传", status_code=201)
+async def create_upload(request: Request, response: Response):
+    """创建上传并预分配临时文件，返回上传地址"""
+    _, user_id = get_or_create_session(request, response)
+    length = _int_header(request, "Upload-Length")
+    if length <= 0:
+        raise HTTPException(status_code=400, detail="Upload-Length必须大于0")
+    if length > MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"文件大小超过限制 ({length / 1024 / 1024:.1f}MB > {MAX_SIZE / 1024 / 1024:.1f}MB)")
+
+    metadata = _parse_metadata(request.headers.get("Upload-Metadata", ""))
+    original_filename = metadata.get("filename")
+    if not original_filename:
+        raise HTTPException(status_code=400, detail="Upload-Metadata中缺少filename")
+    if not allowed_file(original_filename):
+        raise HTTPException(status_code=400, detail=f"不支持的文件类型: {original_filename}")
+
+    # 开始上传之前先检查存储配额，避免传完才发现空间不足；完成时会再次预留
+    quota_error = await run_db(check_quota, user_id, length)
+    if quota_error:
+        raise HTTPException(status_code=413, detail=quota_error)
+
+    upload_id = uuid.uuid4().hex
+    now = time.time()
+    meta = {
+        "filename": original_filename,
+        "length": length,
+        "ranges": [],
+        "state": "uploading",
+        "created": now,
+        "expires": now + RESUMABLE_EXPIRE,
+    }
+    error = await run_io("resumable_create", _create_session, user_id, upload_id, meta)
+    if error:
+        raise HTTPException(status_code=429, detail=error)
+
+    # 按请求的主机构建地址，部署在反向代理或其他域名下时客户端也能访问
+    location = f"{request.url.scheme}://{request.url.netloc}/upload/resumable/{upload_id}"
+    logger.info(f"创建断点续传上传: id={upload_id}, user_id={user_id}, 文件={original_filename}, 大小={length}")
+    response.headers.update(_tus_headers(meta))
+    response.headers["Location"] = location
+    return {
+        "id": upload_id,
+        "location": location,
+        "length": length,
+        "max_chunk_size": RESUMABLE_MAX_CHUNK,
+        "expires_at": _expires_header(meta),
+    }
+
+@router.head("/upload/resumable/{upload_id}", tags=["断点续传"], summary="查询已上传的偏移量")
+async def get_upload_offset(upload_id: str, request: Request):
+    """返回从0开始连续收到的字节数"""
+    meta = await run_io("stat", _load_session, get_user_id(request), upload_id)
+    if meta is None:
+        return Response(status_code=404, headers=_tus_headers())
+    return Response(status_code=200, headers=_tus_headers(meta))
+
+@router.get("/upload/resumable/{upload_id}", tags=["断点续传"], summary="查询上传进度")
+async def get_upload_status(upload_id: str, request: Request, response: Response):
+    """返回已收到的所有区间，并行上传时用于找出缺失的块"""
+    meta = await run_io("stat", _load_session, get_user_id(request), upload_id)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="上传不存在或已过期")
+    response.headers.update(_tus_headers(meta))
+    return {
+        "id": upload_id,
+        "filename": meta["filename"],
+        "length": meta["length"],
+        "offset": _offset(meta),
+        "received": meta["ranges"],
+        "complete": _is_complete(meta),
+        "state": meta["state"],
+        "expires_at": _expires_header(meta),
+    }
+
+@router.patch("/upload/resumable/{upload_id}", tags=["断点续传"], summary="上传一个块")
+async def upload_chunk(upload_id: str, request: Request):
+    """把请求体写入临时文件中Upload-Offset开始的位置，块之间可以乱序或并行"""
+    user_id = get_user_id(request)
+    meta = await run_io("stat", _load_session, user_id, upload_id)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="上传不存在或已过期")
+    if meta["state"] != "uploading":
+        raise HTTPException(status_code=409, detail="上传正在完成中")
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type != "application/offset+octet-stream":
+        raise HTTPException(status_code=415, detail="Content-Type必须是application/offset+octet-stream")
+
+    offset = _int_header(request, "Upload-Offset")
+    length = meta["length"]
+    content_length = request.headers.get("content-length")
+    if offset > length or (content_length and content_length.isdigit() and offset + int(content_length) > length):
+        raise HTTPException(status_code=400, detail=f"块超出了文件大小 (Upload-Length {length})")
+
+    # 写入期间持有共享锁，完成请求无法在块写入过程中移走临时文件
+    lock, fd = await run_io("open", _open_chunk, user_id, upload_id)
+    if fd is None:
+        raise HTTPException(status_code=409, detail="上传正在完成中")
+    position = offset
+    buffer = bytearray()
+
+    async def flush():
+        nonlocal position
+        await run_io("write", _write_chunk, fd, bytes(buffer), position)
+        position += len(buffer)
+        buffer.clear()
+
+    try:
+        async for data in request.stream():
+            if position + len(buffer) + len(data) > length:
+                raise HTTPException(status_code=400, detail=f"块超出了文件大小 (Upload-Length {length})")
+            buffer += data
+            if len(buffer) >= _WRITE_BUFFER:
+                await flush()
+    finally:
+        # 连接中断时已收到的部分同样写入并记录，客户端只需从新的偏移量继续
+        try:
+            if buffer:
+                await flush()
+        finally:
+            try:
+                await run_io("close", _close_chunk, fd)
+                meta = await run_io("resumable_meta", _record_range, user_id, upload_id, offset, position)
+            finally:
+                # 记录区间之后再释放，完成请求取得互斥锁时能看到本块
+                await run_io("resumable_meta", lock.release)
+
+    if meta is None:
+        raise HTTPException(status_code=404, detail="上传不存在或已过期")
+    return Response(status_code=204, headers=_tus_headers(meta))
+
+@router.post("/upload/resumable/{upload_id}/finalize", tags=["断点续传"], summary="完成断点续传上传")
+async def finalize_upload(upload_id: str, request: Request):
+    """所有字节收到后检查图片并保存，返回与/upload相同的结果"""
+    user_id = get_user_id(request)
+    if await run_io("stat", _load_session, user_id, upload_id) is None:
+        raise HTTPException(status_code=404, detail="上传不存在或已过期")
+    meta, error = await run_io("resumable_meta", _set_state, user_id, upload_id, "uploading", "finalizing")
+    if error:
+        raise HTTPException(status_code=404 if meta is None else 409, detail=error)
+
+    original_filename = meta["filename"]
+    part_path = _paths(user_id, upload_id)[0]
+    keep_session = False
+    try:
+        # 与/upload相同：按文件头识别真实格式，拒绝损坏的文件和像素数过多的图片
+        head = await run_io("read_header", _read_head, part_path, SNIFF_BYTES)
+        image_format = sniff_format(head)
+        if image_format is None:
+            logger.warning(f"文件内容不是支持的图片格式: {original_filename}")
+            raise HTTPException(status_code=400, detail=f"文件内容不是支持的图片格式: {original_filename}")
+        image_info, probe_error = probe_image(image_format, head)
+        if probe_error == PROBE_UNREADABLE and len(head) < meta["length"]:
+            data = await run_io("read", _read_head, part_path, meta["length"])
+            image_info, probe_error = probe_image(image_format, head, data)
+        if probe_error:
+            logger.warning(f"{probe_error}: {original_filename}")
+            raise HTTPException(status_code=400, detail=probe_error)
+
+        result, error = await save_upload(
+            request, user_id, original_filename, image_info, meta["length"],
+            lambda name: move_upload(part_path, name)
+        )
+        if error:
+            # 配额不足时临时文件还未移动，释放空间后可以再次完成
+            keep_session = error.get("code") == "quota_exceeded"
+            raise HTTPException(status_code=413 if keep_session else 400, detail=error["error"])
+    finally:
+        if keep_session:
+            await run_io("resumable_meta", _set_state, user_id, upload_id, "finalizing", "uploading")
+        else:
+            await run_io("delete", _remove_session, user_id, upload_id)
+
+    logger.info(f"断点续传上传完成: id={upload_id}, 文件={original_filename}")
+    return result
+
+@router.delete("/upload/resumable/{upload_id}", tags=["断点续传"], summary="取消断点续传上传")
+async def terminate_upload(upload_id: str, request: Request):
+    """删除上传及其临时文件"""
+    user_id = get_user_id(request)
+    if await run_io("stat", _load_session, user_id, upload_id) is None:
+        raise HTTPException(status_code=404, detail="上传不存在或已过期")
+    error = await run_io("delete", _terminate, user_id, upload_id)
+    if error:
+        raise HTTPException(status_code=409, detail=error)
+    return Response(status_code=204, headers=_tus_headers())
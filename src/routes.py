@@ -1,6 +1,7 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, Query, File, UploadFile, Response
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, StreamingResponse
+from fastapi import APIRouter, HTTPException, Request, Query, File, UploadFile, Response
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from sqlalchemy.orm import Session
+from sqlalchemy import text
 from sqlalchemy.sql import func
 from datetime import datetime, timedelta
 import os
@@ -13,15 +14,24 @@ import logging
 import threading
 import concurrent.futures
 from pathlib import Path
-from typing import Optional, Dict, List, Union
+from typing import Awaitable, Callable, Optional, Dict, List, Tuple, Union
 from PIL import Image as PILImage
+from pydantic import BaseModel
 
-from src.database import get_db, Image, UploadLog, ShortLink
+from src.database import Image, UploadLog, ShortLink
+from src.data_access import run_db, get_image_meta, image_meta_cache, delete_owned_short_link
 from src.utils import (
-    allowed_file, optimize_image, offline_image_check, 
+    allowed_file, optimize_image, analyze_image, 
     add_watermark, check_disk_usage, ALLOWED_EXTENSIONS
 )
 from src.session import get_or_create_session, get_user_id
+from src.metrics import UPLOAD_STAGE_SECONDS
+from src.quota import reserve_quota, release_quota, get_quota_info
+from src.sniff import SNIFF_BYTES, PROBE_UNREADABLE, ImageInfo, sniff_format, probe_image, mime_type_for, image_file_response
+from src.phash import PHASH_ENABLED, PHASH_MAX_DISTANCE, to_signed, find_similar
+from src.storage import (
+    write_upload, find_upload, delete_upload, delete_path, schedule_delete_uploads, run_io
+)
 
 # 配置日志
 logger = logging.getLogger("picui")
@@ -30,7 +40,6 @@ logger = logging.getLogger("picui")
 router = APIRouter()
 
 # 全局变量
-UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
 MAX_SIZE = int(os.getenv("MAX_FILE_SIZE", 15 * 1024 * 1024))  # 默认15MB
 BASE_URL = os.getenv("BASE_URL", "http://localhost:8000")
 OFFLINE_CHECK_ENABLED = os.getenv("OFFLINE_CHECK_ENABLED", "false").lower() == "true"
@@ -50,9 +59,9 @@ RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", 60))  # 时间窗口（
 request_counters = {}
 request_counter_lock = threading.Lock()  # 添加线程锁确保计数器更新的原子性
 
-# 清理过期的请求计数记录
+# 清理过期的请求计数记录，由维护任务调度器在每个worker中定期执行
 def clean_old_request_data():
-    """清理过期的请求计数记录"""
+    """清理过期的请求计数记录，防止内存泄漏"""
     current_time = time.time()
     
     with request_counter_lock:
@@ -90,16 +99,6 @@ def check_rate_limit(ip, current_time):
         # 检查是否超过限制
         return request_counters[ip]["count"] <= RATE_LIMIT
 
-# 定期清理过期的请求计数器数据
-def schedule_request_counter_cleanup():
-    """定期清理过期的请求计数器数据，防止内存泄漏"""
-    clean_old_request_data()
-    # 每10分钟清理一次
-    threading.Timer(600, schedule_request_counter_cleanup).start()
-
-# 启动清理任务
-schedule_request_counter_cleanup()
-
 # 为图片生成短链接
 def generate_short_link(filename, expire_minutes=None, db=None, user_id=None):
     """
@@ -151,57 +150,309 @@ def generate_short_link(filename, expire_minutes=None, db=None, user_id=None):
     
     return code
 
+def _log_upload_failure(db: Session, original_filename: str, error_message: str, client_ip: str,
+                        user_agent: str, user_id: Optional[str] = None):
+    """记录上传失败日志，提交失败时不附加额外字段再试一次，仍然失败则放弃记录"""
+    db.add(UploadLog(
+        original_filename=original_filename,
+        status="failed",
+        error_message=error_message,
+        ip_address=client_ip,
+        user_agent=user_agent,
+        user_id=user_id  # 添加用户ID
+    ))
+    try:
+        db.commit()
+    except Exception as db_error:
+        db.rollback()
+        logger.error(f"记录上传失败日志时出错: {str(db_error)}")
+        try:
+            # 尝试不附加额外字段再次提交
+            db.add(UploadLog(
+                original_filename=original_filename,
+                status="failed",
+                error_message=error_message[:200],  # 限制错误消息长度
+                ip_address=client_ip,
+                user_id=user_id
+            ))
+            db.commit()
+        except Exception:
+            # 如果仍然失败，放弃记录日志，但不影响主流程
+            logger.error("无法记录上传失败日志，继续处理")
+            db.rollback()
+
+async def log_upload_failure(original_filename: str, error_message: str, client_ip: str, user_agent: str,
+                             user_id: Optional[str] = None):
+    """在数据库线程池中记录上传失败日志，记录失败不影响调用方"""
+    try:
+        await run_db(_log_upload_failure, original_filename, error_message, client_ip, user_agent, user_id)
+    except Exception as e:
+        logger.error(f"无法记录上传失败日志: {str(e)}")
+
 # 异步处理图片优化和检测
-async def process_image(file_location: str, original_filename: str, client_ip: str, user_agent: str, db: Session) -> bool:
+async def process_image(file_location: str, original_filename: str, client_ip: str,
+                        user_agent: str) -> Tuple[bool, Optional[int]]:
     """
-    异步处理上传的图片：优化尺寸和内容检测
+    异步处理上传的图片：优化尺寸、内容检测和计算感知哈希
     
-    返回True表示处理成功，False表示失败
+    返回 (是否处理成功, 感知哈希)，未启用感知哈希或无法解码时哈希为None
     """
     loop = asyncio.get_event_loop()
     
     try:
         # 在线程池中执行图片优化（CPU密集型操作）
-        result = await loop.run_in_executor(thread_pool, optimize_image, file_location)
+        with UPLOAD_STAGE_SECONDS.labels("optimize").time():
+            result = await loop.run_in_executor(thread_pool, optimize_image, file_location)
         if result:
             logger.debug(f"✓ 图片已优化: {os.path.basename(file_location)} {result}")
         
-        # 如果启用了离线检测，在线程池中执行检测
-        if OFFLINE_CHECK_ENABLED:
-            logger.debug(f"执行图片内容检测: {os.path.basename(file_location)}")
-            is_safe = await loop.run_in_executor(
+        if not OFFLINE_CHECK_ENABLED and not PHASH_ENABLED:
+            return True, None
+        
+        # 内容检测和感知哈希共用一次解码和缩放，在线程池中执行
+        logger.debug(f"执行图片内容检测: {os.path.basename(file_location)}")
+        threshold = SKIN_THRESHOLD if OFFLINE_CHECK_ENABLED else None
+        with UPLOAD_STAGE_SECONDS.labels("check").time():
+            is_safe, phash = await loop.run_in_executor(
                 thread_pool, 
-                lambda: offline_image_check(file_location, SKIN_THRESHOLD)
+                lambda: analyze_image(file_location, threshold)
             )
+        
+        if not is_safe:
+            # 删除不安全的图片
+            await delete_path(file_location)
             
-            if not is_safe:
-                # 删除不安全的图片
-                os.remove(file_location)
-                
-                # 记录失败日志
-                log_entry = UploadLog(
-                    original_filename=original_filename,
-                    status="failed",
-                    error_message="图片内容不符合规范，已被拒绝（离线检测）",
-                    ip_address=client_ip,
-                    user_agent=user_agent
-                )
-                db.add(log_entry)
-                db.commit()
-                
-                logger.warning(f"图片内容不符合规范，已被拒绝: {os.path.basename(file_location)}")
-                return False
+            # 记录失败日志
+            await log_upload_failure(original_filename, "图片内容不符合规范，已被拒绝（离线检测）",
+                                     client_ip, user_agent)
+            
+            logger.warning(f"图片内容不符合规范，已被拒绝: {os.path.basename(file_location)}")
+            return False, None
         
-        return True
+        return True, phash if PHASH_ENABLED else None
     except Exception as e:
         logger.error(f"图片处理失败: {str(e)}")
-        return False
+        return False, None
+
+def _read_image_header(file_location: str):
+    """读取图片宽高和格式，只解析文件头"""
+    with PILImage.open(file_location) as img_obj:
+        return img_obj.width, img_obj.height, img_obj.format
+
+async def read_processed_header(file_location: str, image_info: ImageInfo) -> Tuple[Optional[int], Optional[int], str]:
+    """
+    优化可能缩小图片并按扩展名改变格式，重新读取处理后的图片头，返回 (宽, 高, MIME类型)
+
+    PIL无法解析的格式（如SVG）使用上传时识别的尺寸和类型
+    """
+    try:
+        width, height, processed_format = await run_io("read_header", _read_image_header, file_location)
+    except Exception as e:
+        logger.debug(f"无法读取处理后的图片头，使用上传时识别的尺寸: {str(e)}")
+        return image_info.width, image_info.height, image_info.mime_type
+    mime_type = mime_type_for(processed_format) or image_info.mime_type
+    logger.debug(f"设置图片尺寸: {width}x{height}, 类型: {mime_type}")
+    return width, height, mime_type
+
+def _insert_image_record(db: Session, fields: dict):
+    """写入图片记录，表结构缺少字段时退回只使用基本字段的插入"""
+    db.add(Image(**fields))
+    try:
+        db.commit()
+    except Exception as db_error:
+        # 如果提交失败，可能是表结构问题
+        db.rollback()
+        logger.warning(f"提交图片记录失败: {str(db_error)}")
+        if "no such column" not in str(db_error):
+            # 其他数据库错误，重新抛出
+            raise
+        # 表结构不匹配的特定错误，尝试不包含可能缺失的字段
+        logger.warning(f"数据库表结构不匹配，尝试使用最小字段集")
+        sql = text("INSERT INTO images (filename, original_filename, user_id) VALUES (:filename, :orig_filename, :user_id)")
+        db.execute(sql, {"filename": fields["filename"], "orig_filename": fields["original_filename"],
+                         "user_id": fields["user_id"]})
+        db.commit()
+        logger.info(f"使用最小字段集插入图片记录成功")
+
+def _log_upload_success(db: Session, original_filename: str, filename: str, file_size_kb: float,
+                        client_ip: str, user_agent: str, user_id: Optional[str]):
+    """记录上传成功日志，失败时只记录错误，不影响上传结果"""
+    db.add(UploadLog(
+        original_filename=original_filename,
+        saved_filename=filename,
+        status="success",
+        file_size=file_size_kb,
+        ip_address=client_ip,
+        user_agent=user_agent,
+        user_id=user_id  # 添加用户ID
+    ))
+    try:
+        db.commit()
+    except Exception as db_error:
+        # 如果提交失败，可能是表结构问题
+        db.rollback()
+        logger.warning(f"记录上传日志时出错: {str(db_error)}")
+        if "no such column" not in str(db_error):
+            return
+        # 尝试使用最小字段集
+        try:
+            sql = text("INSERT INTO upload_logs (original_filename, status, ip_address, user_id) VALUES (:orig_filename, :status, :ip, :user_id)")
+            db.execute(sql, {
+                "orig_filename": original_filename, 
+                "status": "success", 
+                "ip": client_ip, 
+                "user_id": user_id
+            })
+            db.commit()
+            logger.info(f"使用最小字段集记录上传日志成功")
+        except Exception as minimal_error:
+            db.rollback()
+            logger.error(f"使用最小字段集记录上传日志失败: {str(minimal_error)}")
+
+def _save_upload_records(db: Session, fields: dict, client_ip: str, user_agent: str) -> Optional[str]:
+    """
+    保存上传图片的数据库记录：图片记录、上传成功日志和永久短链接，返回短链接编码
+
+    只有图片记录写入失败时抛出异常；日志和短链接失败不影响上传完成，短链接失败时返回None
+    """
+    _insert_image_record(db, fields)
+    filename, user_id = fields["filename"], fields["user_id"]
+    _log_upload_success(db, fields["original_filename"], filename, fields["file_size"],
+                        client_ip, user_agent, user_id)
+    
+    # 自动生成短链接 (永久有效)
+    try:
+        logger.info(f"为上传图片自动生成短链接: {filename}")
+        # 确认刚刚插入的图片记录存在
+        if db.query(Image.id).filter(Image.filename == filename).first():
+            return generate_short_link(filename=filename, expire_minutes=None, db=db, user_id=user_id)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"自动生成短链接失败: {str(e)}", exc_info=True)
+        # 继续处理，短链接生成失败不影响上传完成
+    return None
+
+# 上传、断点续传和批量导入共用的保存流程
+async def save_upload(
+    request: Optional[Request],
+    user_id: Optional[str],
+    original_filename: str,
+    image_info: ImageInfo,
+    upload_bytes: int,
+    write: Callable[[str], Awaitable[Tuple[str, int]]]
+) -> Tuple[Optional[dict], Optional[dict]]:
+    """
+    检查配额、写入文件、优化和检测、保存记录并生成短链接
+    
+    write(filename)把图片内容保存到上传目录，返回 (文件路径, 写入的字节数)。
+    数据库操作都在数据库线程池中执行。返回 (上传结果, 错误)，两者只有一个不为None
+    """
+    # 写入文件之前检查存储配额，并为本次上传预留额度
+    quota_error = await run_db(reserve_quota, user_id, upload_bytes)
+    if quota_error:
+        logger.warning(f"{quota_error}: user_id={user_id}, 文件={original_filename}")
+        return None, {"file": original_filename, "error": quota_error, "code": "quota_exceeded"}
+    
+    # 生成唯一文件名，保留原始扩展名
+    file_extension = os.path.splitext(original_filename)[1].lower()
+    filename = f"{uuid.uuid4().hex}{file_extension}"
+    file_location = None
+    client_ip = request.client.host if request else "unknown"
+    user_agent = request.headers.get("user-agent", "unknown") if request else "unknown"
+    
+    try:
+        # 限制并发上传数
+        async with upload_semaphore:
+            # 在IO线程池中写入文件
+            with UPLOAD_STAGE_SECONDS.labels("write").time():
+                file_location, written = await write(filename)
+            
+            # 异步处理图片（优化尺寸和内容检测）
+            processed, phash = await process_image(file_location, original_filename, client_ip, user_agent)
+            if not processed:
+                return None, {"file": original_filename, "error": "图片处理失败"}
+            # 优化可能改变文件大小，按处理后的实际大小记录，存储配额以此计算
+            file_size_kb = await run_io("stat", os.path.getsize, file_location) / 1024
+            
+            width, height, mime_type = await read_processed_header(file_location, image_info)
+            
+            fields = {
+                "filename": filename,
+                "original_filename": original_filename,
+                "user_id": user_id,
+                "file_size": file_size_kb,
+                "upload_ip": client_ip,
+                "mime_type": mime_type,
+                "width": width,
+                "height": height,
+                "phash": to_signed(phash) if phash is not None else None,
+            }
+            
+            # 保存图片记录、上传日志和短链接
+            try:
+                with UPLOAD_STAGE_SECONDS.labels("db").time():
+                    code = await run_db(_save_upload_records, fields, client_ip, user_agent)
+            except Exception as e:
+                logger.error(f"保存图片记录到数据库时出错: {str(e)}")
+                # 如果文件已创建但处理失败，删除文件
+                try:
+                    await delete_path(file_location)
+                except OSError:
+                    pass
+                await log_upload_failure(original_filename, str(e), client_ip, user_agent, user_id)
+                return None, {"file": original_filename, "error": str(e)}
+            
+            # 生成访问URL
+            if request:
+                base_url = f"{request.url.scheme}://{request.url.netloc}"
+            else:
+                # 如果没有request对象且BASE_URL为空，使用合理的默认值
+                base_url = BASE_URL or "http://localhost:8000"
+            access_url = f"{base_url}/images/{filename}"
+            
+            # 创建HTML和Markdown代码
+            html_code = f'<img src="{access_url}" alt="{original_filename}" />'
+            markdown_code = f'![{original_filename}]({access_url})'
+            
+            # 添加到结果列表
+            logger.debug(f"✓ 文件上传成功: {filename} ({file_size_kb:.1f} KB)")
+            result = {
+                "url": access_url,
+                "filename": filename,
+                "original_filename": original_filename,
+                "size": file_size_kb,
+                "mime_type": mime_type,
+                "html_code": html_code,
+                "markdown_code": markdown_code
+            }
+            
+            # 如果生成了短链接，添加到结果中
+            if code:
+                result["short_url"] = f"{base_url}/s/{code}"
+                logger.info(f"自动生成短链接成功: {result['short_url']}")
+            
+            return result, None
+            
+    except Exception as e:
+        logger.error(f"文件上传处理异常: {str(e)}")
+        # 如果文件已创建但处理失败，删除文件
+        if file_location:
+            try:
+                await delete_path(file_location)
+            except OSError:
+                pass
+        
+        # 记录上传失败日志
+        await log_upload_failure(original_filename, str(e), client_ip, user_agent, user_id)
+        return None, {"file": original_filename, "error": str(e)}
+    finally:
+        # 图片记录已提交并计入用量计数，释放预留的额度
+        await release_quota(user_id, upload_bytes)
 
 # 上传图片路由
 @router.post("/upload", tags=["图片"], summary="上传图片", description="上传图片文件并返回访问URL")
 async def upload_image(
     file: Union[UploadFile, List[UploadFile]] = File(..., description="要上传的图片文件"), 
-    db: Session = Depends(get_db), 
     request: Request = None,
     response: Response = None
 ):
@@ -217,10 +468,6 @@ async def upload_image(
     errors = []
     
     for single_file in files:
-        # 获取客户端IP和User-Agent
-        client_ip = request.client.host if request else "unknown"
-        user_agent = request.headers.get("user-agent", "unknown")
-        
         # 检查文件类型是否符合要求
         original_filename = single_file.filename
         if not allowed_file(original_filename):
@@ -229,297 +476,46 @@ async def upload_image(
             errors.append({"file": original_filename, "error": error_message})
             continue
         
+        # 先读取文件头识别真实格式，不是图片时不再读取剩余内容
+        head = await single_file.read(SNIFF_BYTES)
+        image_format = sniff_format(head)
+        if image_format is None:
+            error_message = f"文件内容不是支持的图片格式: {original_filename}"
+            logger.warning(f"{error_message}")
+            errors.append({"file": original_filename, "error": error_message, "code": "invalid_image"})
+            continue
+        
+        # 先只用文件头检查宽高和像素数，像素数过多时不再读取剩余内容
+        image_info, probe_error = probe_image(image_format, head)
+        if probe_error and probe_error != PROBE_UNREADABLE:
+            logger.warning(f"{probe_error}: {original_filename}")
+            errors.append({"file": original_filename, "error": probe_error, "code": "invalid_image"})
+            continue
+        
         # 检查文件大小
-        file_size = await single_file.read(MAX_SIZE + 1)  # 读取比最大限制多1字节，用于检测是否超过限制
+        file_size = head + await single_file.read(MAX_SIZE + 1 - len(head))  # 读取比最大限制多1字节，用于检测是否超过限制
         if len(file_size) > MAX_SIZE:
             error_message = f"文件大小超过限制 ({len(file_size) / 1024 / 1024:.1f}MB > {MAX_SIZE / 1024 / 1024:.1f}MB)"
             logger.warning(f"{error_message}: {original_filename}")
             errors.append({"file": original_filename, "error": error_message})
             continue
         
-        # 重置文件指针
-        await single_file.seek(0)
-        
-        # 生成唯一文件名，保留原始扩展名
-        file_extension = os.path.splitext(original_filename)[1].lower()
-        filename = f"{uuid.uuid4().hex}{file_extension}"
-        file_location = os.path.join(UPLOAD_DIR, filename)
+        # 文件头较大（如JPEG中的大段EXIF）时用完整数据再解析一次，拒绝损坏的文件
+        if probe_error and len(file_size) > len(head):
+            image_info, probe_error = probe_image(image_format, head, file_size)
+        if probe_error:
+            logger.warning(f"{probe_error}: {original_filename}")
+            errors.append({"file": original_filename, "error": probe_error, "code": "invalid_image"})
+            continue
         
-        try:
-            # 限制并发上传数
-            async with upload_semaphore:
-                # 确保目录存在
-                os.makedirs(UPLOAD_DIR, exist_ok=True)
-                
-                # 写入文件
-                with open(file_location, "wb+") as file_object:
-                    file_object.write(file_size)
-                
-                # 获取文件大小
-                file_size_kb = os.path.getsize(file_location) / 1024
-                
-                # 异步处理图片（优化尺寸和内容检测）
-                if not await process_image(file_location, original_filename, client_ip, user_agent, db):
-                    errors.append({"file": original_filename, "error": "图片处理失败"})
-                    continue
-                
-                # 保存图片记录到数据库
-                try:
-                    # 创建Image对象，但不包括可能缺失的字段
-                    img = Image(
-                        filename=filename,
-                        original_filename=original_filename,
-                        user_id=user_id  # 添加用户ID
-                    )
-                    
-                    # 尝试设置可能缺失的字段
-                    try:
-                        img.file_size = file_size_kb
-                    except Exception:
-                        logger.warning(f"无法设置file_size字段，数据库可能不支持该字段")
-                    
-                    try:
-                        img.upload_ip = client_ip
-                    except Exception:
-                        logger.warning(f"无法设置upload_ip字段，数据库可能不支持该字段")
-                    
-                    try:
-                        img.mime_type = "image/jpeg"
-                    except Exception:
-                        logger.warning(f"无法设置mime_type字段，数据库可能不支持该字段")
-                    
-                    # 尝试设置宽高信息
-                    try:
-                        # 使用PIL获取图片尺寸
-                        with PILImage.open(file_location) as img_obj:
-                            img.width = img_obj.width
-                            img.height = img_obj.height
-                            logger.debug(f"设置图片尺寸: {img_obj.width}x{img_obj.height}")
-                    except Exception as e:
-                        logger.debug(f"无法设置图片尺寸，跳过: {str(e)}")
-                    
-                    db.add(img)
-                    try:
-                        db.commit()
-                    except Exception as db_error:
-                        # 如果提交失败，可能是表结构问题
-                        db.rollback()
-                        logger.warning(f"提交图片记录失败: {str(db_error)}")
-                        
-                        # 尝试使用最小字段集再次插入
-                        if "no such column" in str(db_error):
-                            # 表结构不匹配的特定错误，尝试不包含可能缺失的字段
-                            logger.warning(f"数据库表结构不匹配，尝试使用最小字段集")
-                            try:
-                                # 执行原始SQL插入，只使用基本字段
-                                from sqlalchemy import text
-                                sql = text("INSERT INTO images (filename, original_filename, user_id) VALUES (:filename, :orig_filename, :user_id)")
-                                db.execute(sql, {"filename": filename, "orig_filename": original_filename, "user_id": user_id})
-                                db.commit()
-                                logger.info(f"使用最小字段集插入图片记录成功")
-                            except Exception as minimal_error:
-                                logger.error(f"使用最小字段集插入图片记录失败: {str(minimal_error)}")
-                                # 如果仍然失败，抛出异常
-                                raise
-                        else:
-                            # 其他数据库错误，重新抛出
-                            raise
-                
-                except Exception as e:
-                    logger.error(f"保存图片记录到数据库时出错: {str(e)}")
-                    # 如果文件已创建但处理失败，删除文件
-                    if os.path.exists(file_location):
-                        try:
-                            os.remove(file_location)
-                        except:
-                            pass
-                    
-                    # 记录错误
-                    errors.append({"file": original_filename, "error": str(e)})
-                    
-                    # 记录上传失败日志
-                    log_entry = UploadLog(
-                        original_filename=original_filename,
-                        status="failed",
-                        error_message=str(e),
-                        ip_address=client_ip,
-                        user_agent=user_agent,
-                        user_id=user_id  # 添加用户ID
-                    )
-                    db.add(log_entry)
-                    try:
-                        db.commit()
-                    except Exception as db_error:
-                        db.rollback()
-                        logger.error(f"记录上传失败日志时出错: {str(db_error)}")
-                        try:
-                            # 尝试不附加额外字段再次提交
-                            db.add(UploadLog(
-                                original_filename=original_filename,
-                                status="failed",
-                                error_message=str(e)[:200],  # 限制错误消息长度
-                                ip_address=client_ip,
-                                user_id=user_id
-                            ))
-                            db.commit()
-                        except Exception:
-                            # 如果仍然失败，放弃记录日志，但不影响主流程
-                            logger.error("无法记录上传失败日志，继续处理")
-                            db.rollback()
-                
-                # 记录上传成功日志
-                log_entry = UploadLog(
-                    original_filename=original_filename,
-                    status="success",
-                    ip_address=client_ip,
-                    user_agent=user_agent,
-                    user_id=user_id  # 添加用户ID
-                )
-                
-                # 尝试设置可能缺失的字段
-                try:
-                    log_entry.saved_filename = filename
-                except Exception:
-                    logger.warning(f"无法设置saved_filename字段，数据库可能不支持该字段")
-                
-                try:
-                    log_entry.file_size = file_size_kb
-                except Exception:
-                    logger.warning(f"无法设置file_size字段，数据库可能不支持该字段")
-                
-                db.add(log_entry)
-                try:
-                    db.commit()
-                except Exception as db_error:
-                    # 如果提交失败，可能是表结构问题
-                    db.rollback()
-                    logger.warning(f"记录上传日志时出错: {str(db_error)}")
-                    
-                    # 尝试使用最小字段集
-                    if "no such column" in str(db_error):
-                        try:
-                            # 执行原始SQL插入，只使用基本字段
-                            from sqlalchemy import text
-                            sql = text("INSERT INTO upload_logs (original_filename, status, ip_address, user_id) VALUES (:orig_filename, :status, :ip, :user_id)")
-                            db.execute(sql, {
-                                "orig_filename": original_filename, 
-                                "status": "success", 
-                                "ip": client_ip, 
-                                "user_id": user_id
-                            })
-                            db.commit()
-                            logger.info(f"使用最小字段集记录上传日志成功")
-                        except Exception as minimal_error:
-                            logger.error(f"使用最小字段集记录上传日志失败: {str(minimal_error)}")
-                            # 记录错误但不抛出异常，继续处理
-                    else:
-                        # 其他错误记录但不抛出
-                        logger.error(f"记录上传日志时出错: {str(db_error)}")
-                
-                # 生成访问URL
-                if request:
-                    base_url = f"{request.url.scheme}://{request.url.netloc}"
-                    access_url = f"{base_url}/images/{filename}"
-                else:
-                    # 如果没有request对象且BASE_URL为空，使用合理的默认值
-                    if not BASE_URL:
-                        base_url = "http://localhost:8000"
-                    else:
-                        base_url = BASE_URL
-                    access_url = f"{base_url}/images/{filename}"
-                
-                # 自动生成短链接 (永久有效)
-                short_url = None
-                try:
-                    logger.info(f"为上传图片自动生成短链接: {filename}")
-                    # 查询刚刚插入的图片ID
-                    image = db.query(Image).filter(Image.filename == filename).first()
-                    if image:
-                        # 生成短链接 (永久有效)
-                        code = generate_short_link(
-                            filename=filename,
-                            expire_minutes=None,  # 永久有效
-                            db=db,
-                            user_id=user_id
-                        )
-                        # 生成完整的短链接URL
-                        if request:
-                            base_url = f"{request.url.scheme}://{request.url.netloc}"
-                        else:
-                            # 如果没有request对象且BASE_URL为空，使用合理的默认值
-                            if not BASE_URL:
-                                base_url = "http://localhost:8000"
-                            else:
-                                base_url = BASE_URL
-                        
-                        short_url = f"{base_url}/s/{code}"
-                        logger.info(f"自动生成短链接成功: {short_url}")
-                except Exception as e:
-                    logger.error(f"自动生成短链接失败: {str(e)}", exc_info=True)
-                    # 继续处理，短链接生成失败不影响上传完成
-                
-                # 创建HTML和Markdown代码
-                html_code = f'<img src="{access_url}" alt="{original_filename}" />'
-                markdown_code = f'![{original_filename}]({access_url})'
-                
-                # 添加到结果列表
-                logger.debug(f"✓ 文件上传成功: {filename} ({file_size_kb:.1f} KB)")
-                result = {
-                    "url": access_url,
-                    "filename": filename,
-                    "original_filename": original_filename,
-                    "size": file_size_kb,
-                    "html_code": html_code,
-                    "markdown_code": markdown_code
-                }
-                
-                # 如果生成了短链接，添加到结果中
-                if short_url:
-                    result["short_url"] = short_url
-                
-                results.append(result)
-                
-        except Exception as e:
-            logger.error(f"文件上传处理异常: {str(e)}")
-            # 如果文件已创建但处理失败，删除文件
-            if os.path.exists(file_location):
-                try:
-                    os.remove(file_location)
-                except:
-                    pass
-            
-            # 记录错误
-            errors.append({"file": original_filename, "error": str(e)})
-            
-            # 记录上传失败日志
-            log_entry = UploadLog(
-                original_filename=original_filename,
-                status="failed",
-                error_message=str(e),
-                ip_address=client_ip,
-                user_agent=user_agent,
-                user_id=user_id  # 添加用户ID
-            )
-            db.add(log_entry)
-            try:
-                db.commit()
-            except Exception as db_error:
-                db.rollback()
-                logger.error(f"记录上传失败日志时出错: {str(db_error)}")
-                try:
-                    # 尝试不附加额外字段再次提交
-                    db.add(UploadLog(
-                        original_filename=original_filename,
-                        status="failed",
-                        error_message=str(e)[:200],  # 限制错误消息长度
-                        ip_address=client_ip,
-                        user_id=user_id
-                    ))
-                    db.commit()
-                except Exception:
-                    # 如果仍然失败，放弃记录日志，但不影响主流程
-                    logger.error("无法记录上传失败日志，继续处理")
-                    db.rollback()
+        result, error = await save_upload(
+            request, user_id, original_filename, image_info, len(file_size),
+            lambda name: write_upload(name, file_size)
+        )
+        if error:
+            errors.append(error)
+        else:
+            results.append(result)
     
     # 返回结果
     if is_multiple:
@@ -527,57 +523,187 @@ async def upload_image(
     else:
         # 单文件上传
         if errors:
-            raise HTTPException(status_code=400, detail=errors[0]["error"])
+            status_code = 413 if errors[0].get("code") == "quota_exceeded" else 400
+            raise HTTPException(status_code=status_code, detail=errors[0]["error"])
         return results[0]
 
+# 存储配额查询
+@router.get("/quota", tags=["图片"], summary="查询存储配额", description="返回当前用户已用的存储空间、图片数量及上限")
+async def get_quota(request: Request):
+    user_id = get_user_id(request)
+    return await run_db(get_quota_info, user_id)
+
 # 图片删除接口
+def _find_image_owner(db: Session, filename: str):
+    """查询图片是否存在及其上传者，返回 (是否存在, user_id)"""
+    row = db.query(Image.user_id).filter(Image.filename == filename).first()
+    if not row:
+        return False, None
+    return True, row[0]
+
+def _delete_image_records(db: Session, filename: str):
+    """删除图片记录及其相关短链接"""
+    db.query(ShortLink).filter(ShortLink.target_file == filename).delete()
+    db.query(Image).filter(Image.filename == filename).delete()
+    db.commit()
+
 @router.delete("/img/{filename}", tags=["图片"], summary="删除图片", description="删除已上传的图片")
 async def delete_image(
     filename: str,
-    db: Session = Depends(get_db),
     request: Request = None
 ):
     # 获取用户ID
     user_id = get_user_id(request)
     
     # 检查图片是否存在
-    image = db.query(Image).filter(Image.filename == filename).first()
-    if not image:
+    exists, owner_id = await run_db(_find_image_owner, filename)
+    if not exists:
         raise HTTPException(status_code=404, detail="图片不存在")
     
     # 检查是否是上传者本人
-    if user_id and image.user_id != user_id:
+    if user_id and owner_id != user_id:
         raise HTTPException(status_code=403, detail="您无权删除其他用户上传的图片")
     
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    
     # 删除图片文件和数据库记录
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        
-        # 删除相关短链接
-        db.query(ShortLink).filter(ShortLink.target_file == filename).delete()
+        await delete_upload(filename)
         
-        # 删除图片记录
-        db.delete(image)
-        db.commit()
+        # 删除相关短链接和图片记录
+        await run_db(_delete_image_records, filename)
+        image_meta_cache.invalidate(filename)
         
         return {"success": True, "message": "图片已成功删除"}
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"删除图片时出错: {str(e)}")
 
+# 批量删除图片接口
+BATCH_DELETE_MAX = int(os.getenv("BATCH_DELETE_MAX", 1000))  # 每次请求最多删除的图片数量
+# SQLite单条语句的参数数量有限，IN查询按批拆分
+_IN_CHUNK_SIZE = 500
+
+class BatchDeleteRequest(BaseModel):
+    """批量删除请求，指定文件名列表或按条件删除当前用户的图片"""
+    filenames: Optional[List[str]] = None
+    uploaded_before: Optional[datetime] = None  # 按条件删除时，只删除该时间之前上传的图片
+    all: bool = False  # 为True且未指定filenames时，按条件删除当前用户的图片
+
+def _chunks(items: List[str], size: int = _IN_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _delete_images_batch(db: Session, filenames: Optional[List[str]], user_id: Optional[str],
+                         uploaded_before: Optional[datetime], limit: int):
+    """
+    批量删除图片记录及其相关短链接，返回 (每个文件的结果, 已删除的文件名)
+
+    所有权在一次查询中检查，删除在同一个事务中完成。指定文件名时结果按请求中的顺序返回，
+    重复的文件名只删除一次，之后的重复项返回失败
+    """
+    results = {}
+    if filenames is not None:
+        unique = list(dict.fromkeys(filenames))
+        owners = {}
+        for chunk in _chunks(unique):
+            owners.update(db.query(Image.filename, Image.user_id).filter(Image.filename.in_(chunk)).all())
+        deletable = []
+        for filename in unique:
+            if filename not in owners:
+                results[filename] = {"filename": filename, "success": False, "error": "图片不存在"}
+            elif user_id and owners[filename] != user_id:
+                results[filename] = {"filename": filename, "success": False, "error": "您无权删除其他用户上传的图片"}
+            else:
+                deletable.append(filename)
+    else:
+        query = db.query(Image.filename).filter(Image.user_id == user_id)
+        if uploaded_before:
+            query = query.filter(Image.upload_time < uploaded_before)
+        deletable = [row[0] for row in query.order_by(Image.id).limit(limit).all()]
+
+    for chunk in _chunks(deletable):
+        db.query(ShortLink).filter(ShortLink.target_file.in_(chunk)).delete(synchronize_session=False)
+        db.query(Image).filter(Image.filename.in_(chunk)).delete(synchronize_session=False)
+    db.commit()
+
+    for filename in deletable:
+        results[filename] = {"filename": filename, "success": True}
+    if filenames is None:
+        return list(results.values()), deletable
+
+    ordered, seen = [], set()
+    for filename in filenames:
+        if filename in seen:
+            ordered.append({"filename": filename, "success": False, "error": "重复的文件名"})
+        else:
+            seen.add(filename)
+            ordered.append(results[filename])
+    return ordered, deletable
+
+@router.post("/img/batch-delete", tags=["图片"], summary="批量删除图片", description="一次删除多张图片，返回每张图片的删除结果")
+async def batch_delete_images(
+    payload: BatchDeleteRequest,
+    request: Request = None
+):
+    # 获取用户ID
+    user_id = get_user_id(request)
+
+    if payload.filenames is not None:
+        # 结果按请求中的顺序返回，重复的文件名在删除时合并
+        filenames = payload.filenames
+        if not filenames:
+            raise HTTPException(status_code=400, detail="文件名列表不能为空")
+        if len(filenames) > BATCH_DELETE_MAX:
+            raise HTTPException(status_code=400, detail=f"每次最多删除 {BATCH_DELETE_MAX} 张图片")
+    elif payload.all or payload.uploaded_before:
+        # 按条件删除只作用于当前用户自己的图片
+        if not user_id:
+            raise HTTPException(status_code=401, detail="用户未登录")
+        filenames = None
+    else:
+        raise HTTPException(status_code=400, detail="请指定要删除的文件名列表或删除条件")
+
+    try:
+        results, deleted = await run_db(
+            _delete_images_batch, filenames, user_id, payload.uploaded_before, BATCH_DELETE_MAX
+        )
+    except Exception as e:
+        logger.error(f"批量删除图片时出错: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"批量删除图片时出错: {str(e)}")
+
+    if deleted:
+        image_meta_cache.invalidate(*deleted)
+        # 数据库记录已删除，文件在后台删除，不等待完成
+        schedule_delete_uploads(deleted)
+        logger.info(f"批量删除了 {len(deleted)} 张图片, user_id={user_id}")
+
+    return {
+        "success": len(deleted) > 0,
+        "deleted": len(deleted),
+        "failed": len(results) - len(deleted),
+        "results": results
+    }
+
+def _find_short_link(db: Session, code: str) -> Optional[ShortLink]:
+    """查询短链接，返回与会话分离的对象"""
+    return db.query(ShortLink).filter(ShortLink.code == code).first()
+
+def _increase_short_link_access(db: Session, code: str):
+    """原子地增加短链接访问计数，避免多进程并发访问时丢失计数"""
+    db.query(ShortLink).filter(ShortLink.code == code).update(
+        {ShortLink.access_count: func.coalesce(ShortLink.access_count, 0) + 1},
+        synchronize_session=False
+    )
+    db.commit()
+
 # 短链接重定向
 @router.get("/s/{code}", tags=["短链接"], summary="访问短链接", description="通过短链接代码访问图片")
-async def access_short_link(code: str, request: Request = None, db: Session = Depends(get_db)):
+async def access_short_link(code: str, request: Request = None):
     """通过短链接访问图片"""
     # 记录访问信息
     logger.info(f"短链接访问: code={code}")
     
     try:
         # 查询短链接
-        short_link = db.query(ShortLink).filter(ShortLink.code == code).first()
+        short_link = await run_db(_find_short_link, code)
         if not short_link:
             logger.warning(f"短链接不存在: code={code}")
             raise HTTPException(status_code=404, detail="短链接不存在")
@@ -587,30 +713,30 @@ async def access_short_link(code: str, request: Request = None, db: Session = De
             logger.warning(f"短链接已过期: code={code}, expire_at={short_link.expire_at}")
             raise HTTPException(status_code=410, detail="短链接已过期")
         
+        # 已禁用的短链接等待后台清理删除
+        if short_link.is_enabled is False:
+            logger.warning(f"短链接已禁用: code={code}")
+            raise HTTPException(status_code=410, detail="短链接已禁用")
+        
         # 检查目标文件是否存在
-        file_path = os.path.join(UPLOAD_DIR, short_link.target_file)
-        if not os.path.exists(file_path):
+        file_path = await find_upload(short_link.target_file)
+        if not file_path:
             logger.error(f"短链接指向的文件不存在: code={code}, file={short_link.target_file}, path={file_path}")
             raise HTTPException(status_code=404, detail="图片文件不存在或已被删除")
         
         try:
             # 增加访问计数
-            short_link.increase_access_count()
-            db.commit()
+            await run_db(_increase_short_link_access, code)
             
             # 获取图片信息，用于生成正确的MIME类型
-            img_info = db.query(Image).filter(Image.filename == short_link.target_file).first()
+            img_meta = await get_image_meta(short_link.target_file)
             
             # 重定向到原始图片 - 采用两种方式尝试
             # 1. 优先使用文件响应直接返回图片，避免重定向
-            if img_info:
-                logger.info(f"短链接直接访问图片: code={code}, file={short_link.target_file}, mime={img_info.mime_type}")
-                return FileResponse(
-                    file_path, 
-                    media_type=img_info.mime_type, 
-                    filename=img_info.original_filename, 
-                    content_disposition_type="inline"
-                )
+            if img_meta:
+                mime_type, original_filename = img_meta
+                logger.info(f"短链接直接访问图片: code={code}, file={short_link.target_file}, mime={mime_type}")
+                return image_file_response(file_path, mime_type, original_filename)
             
             # 2. 如果没有找到图片信息，使用重定向
             if request:
@@ -625,7 +751,6 @@ async def access_short_link(code: str, request: Request = None, db: Session = De
             return RedirectResponse(url=redirect_url)
             
         except Exception as e:
-            db.rollback()
             logger.error(f"短链接访问失败: code={code}, error={str(e)}", exc_info=True)
             raise HTTPException(status_code=500, detail=f"访问短链接时发生错误: {str(e)}")
     except HTTPException:
@@ -637,23 +762,47 @@ async def access_short_link(code: str, request: Request = None, db: Session = De
 
 # 图片查看路由
 @router.get("/images/{filename}", tags=["图片"], summary="查看图片", description="访问上传的图片")
-async def view_image(filename: str, db: Session = Depends(get_db)):
+async def view_image(filename: str):
     # 检查图片是否存在
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    if not os.path.exists(file_path):
+    file_path = await find_upload(filename)
+    if not file_path:
         raise HTTPException(status_code=404, detail="图片不存在")
     
     # 获取图片MIME类型
-    img_info = db.query(Image).filter(Image.filename == filename).first()
-    content_type = img_info.mime_type if img_info else "image/jpeg"
-    
-    # 返回图片文件，设置内容处理方式为inline以便在浏览器中查看而不是下载
-    return FileResponse(
-        file_path, 
-        media_type=content_type,
-        filename=img_info.original_filename if img_info else filename,
-        content_disposition_type="inline"  # 添加此参数确保在浏览器中预览
-    )
+    img_meta = await get_image_meta(filename)
+    content_type, original_filename = img_meta if img_meta else ("image/jpeg", filename)
+    
+    # 返回图片文件，以inline方式在浏览器中预览；SVG作为附件返回并禁止执行脚本
+    return image_file_response(file_path, content_type, original_filename)
+
+# 相似图片查找
+@router.get("/images/{filename}/similar", tags=["图片"], summary="查找相似图片",
+            description="按感知哈希的汉明距离查找当前用户上传的相似图片（重新编码、缩放后的副本）")
+async def get_similar_images(
+    filename: str,
+    distance: int = Query(6, ge=0, le=PHASH_MAX_DISTANCE, description="允许的最大汉明距离（0-64位中不同的位数）"),
+    limit: int = Query(20, ge=1, le=200, description="最多返回的图片数量"),
+    request: Request = None
+):
+    user_id = get_user_id(request)
+    exists, owner_id = await run_db(_find_image_owner, filename)
+    if not exists:
+        raise HTTPException(status_code=404, detail="图片不存在")
+    if user_id and owner_id != user_id:
+        raise HTTPException(status_code=403, detail="您无权查看其他用户上传的图片")
+    
+    result = await run_db(find_similar, filename, owner_id, distance, limit)
+    if result is None:
+        raise HTTPException(status_code=404, detail="图片不存在")
+    base_url = f"{request.url.scheme}://{request.url.netloc}" if request else BASE_URL
+    for item in result["results"]:
+        item["url"] = f"{base_url}/images/{item['filename']}"
+    return result
+
+# 兼容旧版本的 /uploads/{filename} 地址，文件可能位于分级目录或平铺目录
+@router.get("/uploads/{filename}", include_in_schema=False)
+async def view_upload(filename: str):
+    return await view_image(filename)
 
 # 获取带水印的图片 - 使用线程池处理CPU密集型操作
 @router.get("/images/{filename}/watermark", tags=["图片"], summary="获取带水印的图片", description="获取添加水印后的图片")
@@ -662,12 +811,11 @@ async def get_watermarked_image(
     text: str = "PicUI图床", 
     position: str = Query("bottom-right", description="水印位置，可选：center, bottom-right, bottom-left, top-right, top-left"),
     opacity: float = Query(0.5, ge=0.1, le=1.0, description="水印不透明度，范围0.1-1.0"),
-    download: bool = Query(False, description="是否作为附件下载"),
-    db: Session = Depends(get_db)
+    download: bool = Query(False, description="是否作为附件下载")
 ):
     # 检查图片是否存在
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    if not os.path.exists(file_path):
+    file_path = await find_upload(filename)
+    if not file_path:
         raise HTTPException(status_code=404, detail="图片不存在")
     
     # 检查位置参数是否有效
@@ -676,7 +824,7 @@ async def get_watermarked_image(
         position = "bottom-right"
     
     # 获取图片元数据
-    img_info = db.query(Image).filter(Image.filename == filename).first()
+    img_meta = await get_image_meta(filename)
     
     try:
         # 在线程池中运行水印添加（CPU密集型任务）
@@ -701,10 +849,10 @@ async def get_watermarked_image(
         img_bytes.seek(0)
         
         # 设置内容类型 - 确保使用正确的MIME类型
-        media_type = img_info.mime_type if img_info else "image/jpeg"
+        media_type = img_meta[0] if img_meta else "image/jpeg"
         
         # 生成文件名 - 用于下载时的文件名
-        original_name = img_info.original_filename if img_info else filename
+        original_name = img_meta[1] if img_meta else filename
         filename_base = os.path.splitext(original_name)[0]
         ext = os.path.splitext(filename)[1] if "." in filename else ".jpg"
         download_filename = f"watermark_{filename_base}{ext}"
@@ -738,13 +886,38 @@ async def get_watermarked_image(
         raise HTTPException(status_code=500, detail=f"处理水印图片时出错: {str(e)}")
 
 # 创建临时外链
+def _create_temp_link(db: Session, image_id: int, user_id: Optional[str], expire_minutes: int):
+    """
+    为图片创建临时短链接，返回 (错误状态码, 图片文件名, 短链接编码)
+
+    图片不存在时状态码为404，不是当前用户的图片时为403
+    """
+    image = db.query(Image.filename, Image.user_id).filter(Image.id == image_id).first()
+    if not image:
+        logger.warning(f"创建临时外链失败: 图片不存在, ID={image_id}")
+        return 404, None, None
+    
+    logger.debug(f"找到图片: filename={image.filename}, user_id={image.user_id}")
+    
+    # 检查权限 - 只能为自己的图片创建外链
+    if user_id and image.user_id != user_id:
+        logger.warning(f"权限不足: 用户({user_id})尝试为其他用户({image.user_id})的图片创建外链")
+        return 403, image.filename, None
+    
+    code = generate_short_link(
+        filename=image.filename,
+        expire_minutes=expire_minutes,
+        db=db,
+        user_id=user_id
+    )
+    return None, image.filename, code
+
 @router.post("/create-temp-link/{image_id}", tags=["短链接"], summary="创建临时外链", description="为图片创建带有有效期的临时外链")
 async def create_temp_link(
     image_id: int,
     expire_minutes: int = Query(..., description="链接有效时间（分钟）", ge=1, le=10080),  # 最长7天
     request: Request = None,
-    response: Response = None,
-    db: Session = Depends(get_db)
+    response: Response = None
 ):
     logger.info(f"接收到创建临时外链请求: 图片ID={image_id}, 有效时间={expire_minutes}分钟")
     
@@ -753,40 +926,23 @@ async def create_temp_link(
         _, user_id = get_or_create_session(request, response)
         logger.debug(f"用户会话信息: user_id={user_id}")
         
-        # 查询图片
-        image = db.query(Image).filter(Image.id == image_id).first()
-        if not image:
-            logger.warning(f"创建临时外链失败: 图片不存在, ID={image_id}")
-            raise HTTPException(status_code=404, detail="图片不存在")
-        
-        logger.debug(f"找到图片: filename={image.filename}, user_id={image.user_id}")
-        
-        # 检查权限 - 只能为自己的图片创建外链
-        if user_id and image.user_id != user_id:
-            logger.warning(f"权限不足: 用户({user_id})尝试为其他用户({image.user_id})的图片创建外链")
-            raise HTTPException(status_code=403, detail="您无权为其他用户的图片创建外链")
-        
-        # 创建临时短链接
+        # 查询图片并创建临时短链接
         try:
-            code = generate_short_link(
-                filename=image.filename,
-                expire_minutes=expire_minutes,
-                db=db,
-                user_id=user_id
-            )
+            status_code, filename, code = await run_db(_create_temp_link, image_id, user_id, expire_minutes)
         except Exception as e:
             logger.error(f"创建短链接失败: {str(e)}", exc_info=True)
             raise HTTPException(status_code=500, detail="创建短链接时发生错误")
+        if status_code == 404:
+            raise HTTPException(status_code=404, detail="图片不存在")
+        if status_code == 403:
+            raise HTTPException(status_code=403, detail="您无权为其他用户的图片创建外链")
         
         # 生成完整URL - 优先使用请求的原始主机
         if request:
             base_url = f"{request.url.scheme}://{request.url.netloc}"
         else:
             # 如果没有request对象且BASE_URL为空，使用合理的默认值
-            if not BASE_URL:
-                base_url = "http://localhost:8000"
-            else:
-                base_url = BASE_URL
+            base_url = BASE_URL or "http://localhost:8000"
         
         short_url = f"{base_url}/s/{code}"
         logger.info(f"临时外链创建成功: code={code}, url={short_url}")
@@ -798,7 +954,7 @@ async def create_temp_link(
             "short_url": short_url,
             "code": code,
             "expire_at": expire_at.isoformat(),
-            "original_url": f"{base_url}/images/{image.filename}"
+            "original_url": f"{base_url}/images/{filename}"
         }
     except HTTPException:
         # 传递HTTP异常
@@ -811,8 +967,7 @@ async def create_temp_link(
 @router.delete("/admin/short-links/{code}", tags=["短链接"], summary="删除短链接", description="删除指定的短链接")
 async def api_delete_short_link(
     code: str,
-    request: Request = None,
-    db: Session = Depends(get_db)
+    request: Request = None
 ):
     """删除指定的短链接"""
     logger.info(f"[API] 接收到删除短链接请求: code={code}")
@@ -823,22 +978,13 @@ async def api_delete_short_link(
             logger.warning("[API] 删除短链接失败: 用户未登录")
             raise HTTPException(status_code=401, detail="用户未登录")
         
-        # 查询短链接
-        short_link = db.query(ShortLink).filter(ShortLink.code == code).first()
-        if not short_link:
+        # 查询、检查权限并删除短链接
+        status_code = await run_db(delete_owned_short_link, code, user_id)
+        if status_code == 404:
             logger.warning(f"[API] 删除短链接失败: 短链接不存在, code={code}")
             raise HTTPException(status_code=404, detail="短链接不存在")
-        
-        # 检查权限（验证是否是该用户创建的短链接）
-        # 查找关联的图片
-        image = db.query(Image).filter(Image.filename == short_link.target_file).first()
-        if image and image.user_id != user_id:
-            logger.warning(f"[API] 用户({user_id})尝试删除其他用户({image.user_id})的短链接: {code}")
+        if status_code == 403:
             raise HTTPException(status_code=403, detail="无权删除其他用户的短链接")
-        
-        # 删除短链接
-        db.delete(short_link)
-        db.commit()
         logger.info(f"[API] 短链接已删除: code={code}, user_id={user_id}")
         
         return {"success": True, "message": "短链接已成功删除"}
@@ -847,5 +993,4 @@ async def api_delete_short_link(
         raise
     except Exception as e:
         logger.error(f"[API] 删除短链接时出错: {str(e)}", exc_info=True)
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"删除短链接时出错: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,176 @@
+"""
+后台维护任务调度
+
+在事件循环中按固定间隔运行维护任务，替代在每个worker中各自循环的threading.Timer。
+多个worker之间通过文件锁选出一个leader，只有leader运行leader_only任务（磁盘检查、
+计数器校准等对共享数据的操作）；清理进程内存数据的任务（请求频率计数、会话）每个worker都要运行。
+leader退出后锁由操作系统释放，其他worker会在SCHEDULER_LEADER_RETRY秒内接替。
+
+同步任务在专用线程池中执行，不会阻塞事件循环；超时的同步任务无法被中断，
+在它结束之前该任务的后续执行会被跳过。
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import random
+import time
+from typing import Callable, Dict, List, Optional
+
+from src.database import get_sqlite_path
+from src.metrics import (
+    SCHEDULER_LEADER, SCHEDULER_JOB_RUNS, SCHEDULER_JOB_LAST_RUN, SCHEDULER_JOB_DURATION
+)
+from src.utils import FileLock
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_LOCK_FILE = os.getenv("SCHEDULER_LOCK_FILE", "")
+SCHEDULER_LEADER_RETRY = float(os.getenv("SCHEDULER_LEADER_RETRY", 30))  # 非leader尝试获取锁的间隔(秒)
+SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", 0.1))  # 间隔的随机浮动比例，避免任务同时触发
+SCHEDULER_JOB_TIMEOUT = float(os.getenv("SCHEDULER_JOB_TIMEOUT", 600))  # 任务默认超时时间(秒)
+
+def _lock_path() -> str:
+    return SCHEDULER_LOCK_FILE or f"{get_sqlite_path()}.scheduler.lock"
+
+class Job:
+    """一个周期性任务"""
+
+    def __init__(self, name: str, func: Callable, interval: float, timeout: Optional[float] = None,
+                 leader_only: bool = True, run_at_start: bool = False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout if timeout is not None else SCHEDULER_JOB_TIMEOUT
+        self.leader_only = leader_only
+        self.run_at_start = run_at_start
+        self.last_run: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.last_result: Optional[str] = None
+        # 超时后仍在线程中运行的同步任务
+        self._pending: Optional[asyncio.Future] = None
+
+class Scheduler:
+    def __init__(self, lock_path: Optional[str] = None):
+        self.lock_path = lock_path
+        self.jobs: Dict[str, Job] = {}
+        self._lock: Optional[FileLock] = None
+        self._tasks: List[asyncio.Task] = []
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lock is not None and self._lock.locked
+
+    def add_job(self, name: str, func: Callable, interval: float, timeout: Optional[float] = None,
+                leader_only: bool = True, run_at_start: bool = False):
+        """
+        注册周期性任务，interval不大于0时不注册
+
+        func可以是同步函数或协程函数；run_at_start为True时启动后立即运行一次，否则等待一个间隔
+        """
+        if interval <= 0:
+            logger.info(f"维护任务已禁用: {name}")
+            return
+        self.jobs[name] = Job(name, func, interval, timeout, leader_only, run_at_start)
+
+    def _try_become_leader(self) -> bool:
+        if self.is_leader:
+            return True
+        if self._lock is None:
+            self._lock = FileLock(self.lock_path or _lock_path())
+        try:
+            acquired = self._lock.acquire(blocking=False)
+        except OSError as e:
+            logger.warning(f"获取调度锁失败: {str(e)}")
+            return False
+        if acquired:
+            SCHEDULER_LEADER.set(1)
+            logger.info(f"当前worker成为维护任务leader: pid={os.getpid()}")
+        return acquired
+
+    async def _leader_loop(self):
+        while not self._try_become_leader():
+            await asyncio.sleep(SCHEDULER_LEADER_RETRY)
+
+    def _next_delay(self, job: Job) -> float:
+        jitter = job.interval * SCHEDULER_JITTER
+        return max(0.0, job.interval + random.uniform(-jitter, jitter))
+
+    async def run_job(self, job: Job) -> str:
+        """执行一次任务，返回结果：ok、error、timeout、skipped"""
+        if job._pending is not None and not job._pending.done():
+            logger.warning(f"维护任务上次执行尚未结束，跳过本次: {job.name}")
+            SCHEDULER_JOB_RUNS.labels(job.name, "skipped").inc()
+            return "skipped"
+
+        started = time.perf_counter()
+        if asyncio.iscoroutinefunction(job.func):
+            future = asyncio.ensure_future(job.func())
+        else:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, job.func)
+        try:
+            # shield使超时只停止等待，同步任务的线程无法中断，由_pending跟踪其结束
+            await asyncio.wait_for(asyncio.shield(future), timeout=job.timeout)
+            result = "ok"
+        except asyncio.TimeoutError:
+            if asyncio.iscoroutinefunction(job.func):
+                future.cancel()
+            else:
+                job._pending = future
+            logger.error(f"维护任务超时: {job.name} ({job.timeout:g}s)")
+            result = "timeout"
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            logger.error(f"维护任务执行失败: {job.name}, {str(e)}")
+            result = "error"
+
+        duration = time.perf_counter() - started
+        job.last_run = time.time()
+        job.last_duration = duration
+        job.last_result = result
+        SCHEDULER_JOB_RUNS.labels(job.name, result).inc()
+        SCHEDULER_JOB_LAST_RUN.labels(job.name).set(job.last_run)
+        SCHEDULER_JOB_DURATION.labels(job.name).set(duration)
+        return result
+
+    async def _job_loop(self, job: Job):
+        # 首次执行前也加入随机延迟，避免多个worker重启后同时执行
+        delay = random.uniform(0, min(5.0, job.interval * SCHEDULER_JITTER)) if job.run_at_start else self._next_delay(job)
+        while True:
+            await asyncio.sleep(delay)
+            delay = self._next_delay(job)
+            if job.leader_only and not self.is_leader:
+                continue
+            await self.run_job(job)
+
+    def start(self):
+        """在当前事件循环中启动leader选举和所有任务"""
+        if self._tasks:
+            return
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(4, len(self.jobs))),
+            thread_name_prefix="picui_scheduler"
+        )
+        self._tasks.append(asyncio.ensure_future(self._leader_loop()))
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.ensure_future(self._job_loop(job)))
+
+    async def stop(self):
+        """取消所有任务并释放leader锁，不等待仍在线程中运行的同步任务"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self.is_leader:
+            self._lock.release()
+            SCHEDULER_LEADER.set(0)
+
+scheduler = Scheduler()
@@ -0,0 +1,153 @@
+"""
+上传图片的文件头识别
+
+allowed_file只检查扩展名。上传时先读取文件开头的SNIFF_BYTES字节，按magic bytes识别真实格式，
+不是支持的图片时不再读取剩余内容，也不会写入磁盘；再用PIL只解析文件头取得宽高，
+拒绝无法解析的损坏文件和像素数超过MAX_IMAGE_PIXELS的图片（解码时会占用大量内存）。
+识别出的格式用于记录真实的MIME类型，访问图片时返回正确的Content-Type。
+
+PIL无法解析的格式（SVG、未安装插件时的HEIC/AVIF）只按magic bytes识别，宽高为空。
+SVG中可以嵌入脚本，访问时通过image_file_response作为附件返回，并用CSP沙箱禁止执行脚本。
+"""
+import io
+import logging
+import os
+import warnings
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from fastapi.responses import FileResponse
+from PIL import Image as PILImage
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+SNIFF_BYTES = int(os.getenv("SNIFF_BYTES", 64 * 1024))  # 识别格式时读取的文件头字节数
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 89478485))  # 允许上传的最大像素数（宽x高），0表示不限制
+
+# PIL格式名 -> MIME类型
+FORMAT_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "GIF": "image/gif",
+    "WEBP": "image/webp",
+    "BMP": "image/bmp",
+    "TIFF": "image/tiff",
+    "ICO": "image/x-icon",
+    "SVG": "image/svg+xml",
+    "HEIF": "image/heif",
+    "HEIC": "image/heic",
+    "AVIF": "image/avif",
+}
+
+# 可以包含脚本的格式，在浏览器中直接打开时脚本会以本站身份执行
+_SCRIPTABLE_MIME_TYPES = {"image/svg+xml"}
+
+# 只用文件头无法解析时的错误信息，文件头较大时需要用完整数据再解析一次
+PROBE_UNREADABLE = "图片文件已损坏或无法识别"
+
+# 只能按magic bytes识别的格式，PIL解析失败时不视为损坏
+_UNPROBED_FORMATS = {"SVG", "HEIF", "HEIC", "AVIF"}
+
+# ISO BMFF的ftyp品牌 -> 格式
+_FTYP_BRANDS = {
+    b"heic": "HEIC", b"heix": "HEIC", b"hevc": "HEIC", b"hevx": "HEIC",
+    b"heim": "HEIC", b"heis": "HEIC", b"mif1": "HEIF", b"msf1": "HEIF",
+    b"avif": "AVIF", b"avis": "AVIF",
+}
+
+class ImageInfo(NamedTuple):
+    format: str
+    mime_type: str
+    width: Optional[int]
+    height: Optional[int]
+
+def mime_type_for(format: Optional[str]) -> Optional[str]:
+    """PIL格式名对应的MIME类型，未知格式返回None"""
+    return FORMAT_MIME_TYPES.get((format or "").upper())
+
+def _looks_like_svg(head: bytes) -> bool:
+    text = head[:4096].decode("utf-8", errors="ignore").lstrip("\ufeff \t\r\n").lower()
+    return text.startswith(("<?xml", "<svg", "<!--", "<!doctype svg")) and "<svg" in text
+
+def sniff_format(head: bytes) -> Optional[str]:
+    """按文件开头的magic bytes识别图片格式，返回PIL格式名，不是支持的图片时返回None"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "GIF"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "WEBP"
+    if head.startswith(b"BM"):
+        return "BMP"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "TIFF"
+    if head.startswith(b"\x00\x00\x01\x00"):
+        return "ICO"
+    if head[4:8] == b"ftyp":
+        return _FTYP_BRANDS.get(head[8:12])
+    if _looks_like_svg(head):
+        return "SVG"
+    return None
+
+def _probe_size(data: bytes) -> Tuple[int, int]:
+    with warnings.catch_warnings():
+        # 超过PIL默认像素上限时的警告由MAX_IMAGE_PIXELS检查代替
+        warnings.simplefilter("ignore", PILImage.DecompressionBombWarning)
+        with PILImage.open(io.BytesIO(data)) as img:
+            return img.size
+
+def probe_image(format: str, head: bytes, data: Optional[bytes] = None) -> Tuple[Optional[ImageInfo], Optional[str]]:
+    """
+    只解析文件头取得宽高并检查像素数，返回 (图片信息, 错误信息)，两者只有一个不为None
+
+    先只用head解析，文件头较大（如JPEG中的大段EXIF）时再使用完整数据data
+    """
+    info = ImageInfo(format, FORMAT_MIME_TYPES[format], None, None)
+    size, error = None, None
+    for candidate in (head, data):
+        if candidate is None:
+            continue
+        try:
+            size = _probe_size(candidate)
+            break
+        except PILImage.DecompressionBombError:
+            return None, "图片像素数过多"
+        except Exception as e:
+            error = e
+    if size is None:
+        if format in _UNPROBED_FORMATS:
+            return info, None
+        logger.debug(f"解析图片文件头失败: format={format}, {str(error)}")
+        return None, PROBE_UNREADABLE
+
+    width, height = size
+    if MAX_IMAGE_PIXELS > 0 and width * height > MAX_IMAGE_PIXELS:
+        return None, f"图片像素数过多 ({width}x{height} > {MAX_IMAGE_PIXELS} 像素)"
+    return info._replace(width=width, height=height), None
+
+
+def image_response_headers(mime_type: Optional[str]) -> Tuple[str, Dict[str, str]]:
+    """
+    访问图片时的 (Content-Disposition类型, 额外响应头)
+
+    所有图片都禁止浏览器猜测类型；SVG等可以包含脚本的格式作为附件下载，
+    并通过CSP沙箱禁止脚本执行，避免存储型XSS
+    """
+    headers = {"X-Content-Type-Options": "nosniff"}
+    if (mime_type or "").split(";")[0].strip().lower() in _SCRIPTABLE_MIME_TYPES:
+        headers["Content-Security-Policy"] = "sandbox"
+        return "attachment", headers
+    return "inline", headers
+
+def image_file_response(path: str, mime_type: str, filename: str) -> FileResponse:
+    """返回上传的图片文件，按格式设置安全相关的响应头"""
+    disposition, headers = image_response_headers(mime_type)
+    return FileResponse(
+        path,
+        media_type=mime_type,
+        filename=filename,
+        headers=headers,
+        content_disposition_type=disposition
+    )
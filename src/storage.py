@@ -0,0 +1,341 @@
+"""
+上传文件的存储布局
+
+新上传的文件按文件名前4个字符分两级子目录保存（如 ab/cd/abcd....jpg），
+避免单个目录中文件过多导致查找和备份变慢。旧版本的平铺文件在迁移完成前仍可读取，
+所有路由都应通过 resolve_upload_path 查找文件，而不是直接拼接 UPLOAD_DIR。
+
+路由中的文件操作使用本模块的异步函数（write_upload、find_upload、delete_upload等），
+它们在专用的IO线程池中执行，慢速磁盘或网络存储不会阻塞事件循环，
+每类操作的耗时记录在 io_stats 中。
+
+迁移已有文件：
+    python -m src.storage migrate [--batch-size 1000] [--sleep 0.05]
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar
+
+from src.metrics import STORAGE_IO_SECONDS
+
+# 配置日志
+logger = logging.getLogger("picui")
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+# 新文件的存储布局：sharded（分级子目录）或 flat（全部放在UPLOAD_DIR下）
+STORAGE_LAYOUT = os.getenv("STORAGE_LAYOUT", "sharded").lower()
+# 分级目录的层数，每层使用文件名的2个字符
+SHARD_DEPTH = 2
+
+# 已创建过的分级目录，避免每次上传都调用makedirs
+_known_dirs = set()
+
+# 文件IO专用线程池，与图片处理线程池分开，避免CPU密集任务排队时文件操作也被拖慢
+STORAGE_IO_THREADS = int(os.getenv("STORAGE_IO_THREADS", 8))
+# 写入后的fsync策略：none（由操作系统决定何时落盘）、file（fsync文件）、
+# full（fsync文件及其所在目录，保证断电后目录项也已持久化）
+FSYNC_POLICY = os.getenv("FSYNC_POLICY", "none").lower()
+# 单次文件操作超过该耗时(毫秒)时记录警告
+STORAGE_SLOW_OP_MS = float(os.getenv("STORAGE_SLOW_OP_MS", 500))
+
+io_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=STORAGE_IO_THREADS,
+    thread_name_prefix="picui_io"
+)
+
+T = TypeVar("T")
+
+class IOStats:
+    """按操作类型统计文件操作的次数、耗时、排队时间和失败次数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Dict[str, list] = {}
+
+    def record(self, op: str, seconds: float, wait_seconds: float = 0.0, error: bool = False):
+        with self._lock:
+            entry = self._data.setdefault(op, [0, 0.0, 0.0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            entry[3] += wait_seconds
+            entry[4] += int(error)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """返回各操作的统计信息，耗时单位为毫秒"""
+        with self._lock:
+            return {
+                op: {
+                    "count": count,
+                    "total_ms": round(total * 1000, 3),
+                    "avg_ms": round(total * 1000 / count, 3) if count else 0.0,
+                    "max_ms": round(max_seconds * 1000, 3),
+                    "avg_wait_ms": round(wait * 1000 / count, 3) if count else 0.0,
+                    "errors": errors,
+                }
+                for op, (count, total, max_seconds, wait, errors) in self._data.items()
+            }
+
+io_stats = IOStats()
+
+def is_valid_filename(filename: str) -> bool:
+    """文件名只能是单个路径组件，防止访问上传目录之外的文件"""
+    return bool(filename) and filename not in (".", "..") and os.path.basename(filename) == filename \
+        and "/" not in filename and "\\" not in filename
+
+def _can_shard(filename: str) -> bool:
+    # 文件名必须长于分级前缀，且不以点开头（隐藏文件和临时文件保持平铺）
+    return len(filename) > SHARD_DEPTH * 2 and not filename.startswith(".")
+
+def flat_path(filename: str) -> str:
+    """旧版本平铺布局下的文件路径"""
+    return os.path.join(UPLOAD_DIR, filename)
+
+def shard_path(filename: str) -> str:
+    """分级布局下的文件路径，无法分级的文件名返回平铺路径"""
+    if not _can_shard(filename):
+        return flat_path(filename)
+    parts = [filename[i * 2:i * 2 + 2].lower() for i in range(SHARD_DEPTH)]
+    return os.path.join(UPLOAD_DIR, *parts, filename)
+
+def resolve_upload_path(filename: str) -> Optional[str]:
+    """
+    查找已上传文件的实际路径，文件不存在时返回None
+
+    依次检查分级路径和平铺路径；迁移工具移动文件的瞬间两处都可能找不到，
+    因此最后再检查一次分级路径
+    """
+    if not is_valid_filename(filename):
+        return None
+    sharded = shard_path(filename)
+    if os.path.isfile(sharded):
+        return sharded
+    flat = flat_path(filename)
+    if flat != sharded:
+        if os.path.isfile(flat):
+            return flat
+        if os.path.isfile(sharded):
+            return sharded
+    return None
+
+def new_upload_path(filename: str) -> str:
+    """新上传文件的保存路径，按STORAGE_LAYOUT选择布局并确保目录存在"""
+    path = shard_path(filename) if STORAGE_LAYOUT == "sharded" else flat_path(filename)
+    directory = os.path.dirname(path)
+    if directory not in _known_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _known_dirs.add(directory)
+    return path
+
+def remove_upload(filename: str) -> bool:
+    """删除文件在两种布局下的副本，返回是否删除了文件"""
+    if not is_valid_filename(filename):
+        return False
+    removed = False
+    for path in {shard_path(filename), flat_path(filename)}:
+        removed = _remove_path(path) or removed
+    return removed
+
+def _fsync_dir(directory: str):
+    """fsync目录，使新建、删除或重命名的目录项持久化（Windows不支持打开目录）"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _write_file(path: str, data: bytes) -> int:
+    with open(path, "wb") as f:
+        f.write(data)
+        if FSYNC_POLICY in ("file", "full"):
+            f.flush()
+            os.fsync(f.fileno())
+    if FSYNC_POLICY == "full":
+        _fsync_dir(os.path.dirname(path))
+    return len(data)
+
+def _remove_path(path: str) -> bool:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    if FSYNC_POLICY == "full":
+        _fsync_dir(os.path.dirname(path))
+    return True
+
+async def run_io(op: str, fn: Callable[..., T], *args) -> T:
+    """
+    在IO线程池中执行文件操作，并按op记录耗时
+
+    耗时只统计在线程中执行的时间，排队等待线程的时间单独记录
+    """
+    submitted = time.perf_counter()
+
+    def _call():
+        started = time.perf_counter()
+        error = False
+        try:
+            return fn(*args)
+        except Exception:
+            error = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            io_stats.record(op, elapsed, started - submitted, error)
+            STORAGE_IO_SECONDS.labels(op).observe(elapsed)
+            if elapsed * 1000 > STORAGE_SLOW_OP_MS:
+                logger.warning(f"文件操作耗时过长: {op} {elapsed * 1000:.0f}ms")
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, _call)
+
+async def write_upload(filename: str, data: bytes) -> Tuple[str, int]:
+    """保存新上传的文件，返回 (文件路径, 写入的字节数)"""
+    def _write():
+        path = new_upload_path(filename)
+        return path, _write_file(path, data)
+    return await run_io("write", _write)
+
+async def move_upload(source: str, filename: str) -> Tuple[str, int]:
+    """把已写好的文件（如断点续传的临时文件）移动到上传目录，返回 (文件路径, 文件字节数)"""
+    def _move():
+        path = new_upload_path(filename)
+        # 同一文件系统内为原子的rename，否则复制后删除
+        shutil.move(source, path)
+        if FSYNC_POLICY == "full":
+            _fsync_dir(os.path.dirname(path))
+        return path, os.path.getsize(path)
+    return await run_io("move", _move)
+
+async def find_upload(filename: str) -> Optional[str]:
+    """异步查找已上传文件的路径，不存在时返回None"""
+    return await run_io("stat", resolve_upload_path, filename)
+
+async def delete_upload(filename: str) -> bool:
+    """异步删除已上传的文件，返回是否删除了文件"""
+    return await run_io("delete", remove_upload, filename)
+
+async def delete_path(path: str) -> bool:
+    """异步删除指定路径的文件，用于清理处理失败的上传文件"""
+    return await run_io("delete", _remove_path, path)
+
+def schedule_delete_uploads(filenames: Iterable[str]) -> concurrent.futures.Future:
+    """在IO线程池中后台删除多个文件，不等待完成"""
+    filenames = list(filenames)
+
+    def _delete_all():
+        started = time.perf_counter()
+        for filename in filenames:
+            try:
+                remove_upload(filename)
+            except OSError as e:
+                logger.error(f"删除图片文件失败: {filename}, {str(e)}")
+        io_stats.record("delete_batch", time.perf_counter() - started)
+
+    return io_executor.submit(_delete_all)
+
+def iter_flat_files() -> Iterator[str]:
+    """遍历上传目录中仍处于平铺布局、可以迁移的文件名，遍历期间不应移动文件"""
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and _can_shard(entry.name):
+                yield entry.name
+
+def list_flat_files(limit: int, exclude: Set[str]) -> List[str]:
+    """列出最多limit个不在exclude中的平铺文件名，返回前目录迭代器已关闭"""
+    names = []
+    files = iter_flat_files()
+    try:
+        for name in files:
+            if name not in exclude:
+                names.append(name)
+                if len(names) >= limit:
+                    break
+    finally:
+        files.close()
+    return names
+
+def _migrate_file(name: str) -> str:
+    """把一个平铺文件移动到分级目录，返回 moved、exists（分级目录已有同名文件）或 gone（文件已不在）"""
+    target = shard_path(name)
+    directory = os.path.dirname(target)
+    if directory not in _known_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _known_dirs.add(directory)
+    if os.path.exists(target):
+        return "exists"
+    try:
+        os.rename(flat_path(name), target)
+    except FileNotFoundError:
+        # 文件在列出之后已被其他进程迁移或删除
+        return "gone"
+    return "moved"
+
+def migrate_to_sharded(batch_size: int = 1000, sleep: float = 0.05, dry_run: bool = False) -> int:
+    """
+    把平铺布局的文件移动到分级目录，返回移动的文件数量
+
+    每批先列出最多batch_size个文件名并关闭目录迭代器，再逐个移动，
+    不会在遍历目录的同时修改它。每次rename都是同一文件系统内的原子操作，服务无需停机；
+    每批之间暂停sleep秒以限制IO压力。中断后再次执行会继续移动剩余的平铺文件
+    """
+    started = time.time()
+    if dry_run:
+        count = sum(1 for _ in iter_flat_files())
+        logger.info(f"存储布局迁移: 需要迁移 {count} 个文件")
+        return count
+
+    moved = 0
+    gone = 0
+    # 分级目录中已有同名文件的平铺文件，之后的批次不再列出
+    skipped = set()
+    while True:
+        names = list_flat_files(batch_size, skipped)
+        if not names:
+            break
+        for name in names:
+            status = _migrate_file(name)
+            if status == "moved":
+                moved += 1
+            elif status == "exists":
+                # 例如上次迁移中断，保留已迁移的版本
+                logger.warning(f"分级目录中已存在同名文件，跳过: {name}")
+                skipped.add(name)
+            else:
+                gone += 1
+        logger.info(f"已迁移 {moved} 个文件 ({moved / max(time.time() - started, 0.001):.0f} 个/秒)")
+        if sleep > 0:
+            time.sleep(sleep)
+    logger.info(f"存储布局迁移完成: 已迁移 {moved} 个文件，跳过 {len(skipped)} 个，"
+                f"{gone} 个已被迁移或删除，用时 {time.time() - started:.1f}s")
+    return moved
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PicUI上传目录存储布局工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser("migrate", help="把平铺布局的文件移动到分级目录")
+    migrate.add_argument("--batch-size", type=int, default=1000, help="每批移动的文件数量")
+    migrate.add_argument("--sleep", type=float, default=0.05, help="每批之间暂停的秒数")
+    migrate.add_argument("--dry-run", action="store_true", help="只统计需要迁移的文件数量")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
+    if args.command == "migrate":
+        if not os.path.isdir(UPLOAD_DIR):
+            logger.error(f"上传目录不存在: {UPLOAD_DIR}")
+            return 1
+        migrate_to_sharded(args.batch_size, args.sleep, args.dry_run)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
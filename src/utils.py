@@ -13,11 +13,20 @@ import uuid
 import requests
 import json
 import threading
-from typing import Set, Optional
+import concurrent.futures
+from typing import Set, List, Optional, Tuple
 from PIL import Image as PILImage
 
+from src.phash import dhash
+
 logger = logging.getLogger("picui")
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 # 允许的图片格式
 ALLOWED_EXTENSIONS = {
     "jpg", "jpeg", "png", "gif", "webp", 
@@ -258,6 +267,87 @@ def add_watermark(img_path: str, text: str, position: str = "center",
         except:
             return None
 
+# 内容检测和感知哈希使用的缩略图尺寸，所有图片缩放到相同尺寸，批量检测时可以堆叠为一个数组
+SCAN_SIZE = (100, 100)
+
+def load_scan_image(file_path: str) -> Optional[PILImage.Image]:
+    """
+    以降低的分辨率解码图片并缩放为SCAN_SIZE的RGB图像，无法解码时（如SVG）返回None
+    
+    JPEG通过draft在解码时直接缩小到1/2~1/8，大图不需要完整解码到内存
+    """
+    try:
+        with PILImage.open(file_path) as img:
+            img.draft("RGB", (SCAN_SIZE[0] * 2, SCAN_SIZE[1] * 2))
+            # 调色板和二值图像只能按最近邻缩放，先缩小到较小的中间尺寸再转换，避免转换整张大图
+            if img.mode in ("1", "P", "PA"):
+                if img.width > SCAN_SIZE[0] * 4 or img.height > SCAN_SIZE[1] * 4:
+                    img = img.resize((SCAN_SIZE[0] * 4, SCAN_SIZE[1] * 4), PILImage.NEAREST)
+                img = img.convert("RGBA")
+            return img.resize(SCAN_SIZE, PILImage.BILINEAR, reducing_gap=2.0).convert("RGB")
+    except Exception as e:
+        logger.debug(f"无法解码图片，跳过检测: {file_path}, {str(e)}")
+        return None
+
+def skin_ratios(batch: np.ndarray) -> np.ndarray:
+    """
+    一次计算一批图片的肤色像素占比
+    
+    batch为 (图片数, 高, 宽, 3) 的uint8数组。转换为int16后再做减法，
+    避免uint8的r - g在r < g时回绕成大正数；灰度图像R=G=B，占比为0
+    """
+    rgb = batch.astype(np.int16)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    
+    # 简单的肤色检测 (不是非常精确，但足够做基本过滤)
+    # 基于RGB颜色空间的肤色范围
+    skin_mask = (r > 95) & (g > 40) & (b > 20) & \
+                ((rgb.max(axis=-1) - rgb.min(axis=-1)) > 15) & \
+                (np.abs(r - g) > 15) & (r > g) & (r > b)
+    
+    return skin_mask.mean(axis=(1, 2), dtype=np.float32)
+
+def scan_images(file_paths: List[str], executor: Optional[concurrent.futures.Executor] = None
+                ) -> List[Tuple[Optional[float], Optional[int]]]:
+    """
+    批量检测图片，返回每张图片的 (肤色占比, 64位差值哈希)，无法解码的图片两者都为None
+    
+    解码在executor中并行执行（PIL解码时释放GIL），肤色占比对整批图片一次计算
+    """
+    if executor is not None:
+        thumbs = list(executor.map(load_scan_image, file_paths))
+    else:
+        thumbs = [load_scan_image(path) for path in file_paths]
+    
+    decoded = [thumb for thumb in thumbs if thumb is not None]
+    ratios = iter(skin_ratios(np.stack([np.asarray(thumb) for thumb in decoded])).tolist() if decoded else [])
+    results = []
+    for thumb in thumbs:
+        if thumb is None:
+            results.append((None, None))
+        else:
+            results.append((next(ratios), dhash(thumb)))
+    return results
+
+def analyze_image(file_path: str, skin_threshold: Optional[float] = None) -> Tuple[bool, Optional[int]]:
+    """
+    解码并缩小图片一次，完成肤色检测和感知哈希计算
+    
+    返回 (是否安全, 64位差值哈希)。skin_threshold为None时不做内容检测；
+    无法解码的文件哈希为None且视为安全
+    """
+    try:
+        skin_ratio, phash = scan_images([file_path])[0]
+    except Exception as e:
+        logger.error(f"离线图片检测出错: {str(e)}")
+        return True, None  # 出错时默认通过
+    
+    # 如果肤色像素比例超过阈值，可能是不适当内容
+    if skin_threshold is not None and skin_ratio is not None and skin_ratio > skin_threshold:
+        logger.warning(f"离线检测: 图片 {file_path} 可能包含不适当内容 (肤色比例: {skin_ratio:.2f})")
+        return False, phash
+    return True, phash
+
 # 简单的离线图片内容检测
 def offline_image_check(file_path: str, skin_threshold: float = 0.5) -> bool:
     """
@@ -266,41 +356,7 @@ def offline_image_check(file_path: str, skin_threshold: float = 0.5) -> bool:
 
     注意: 这是一个非常基础的检测方法，不能替代专业的内容审核服务
     """
-    try:
-        # 打开图片
-        img = PILImage.open(file_path)
-        
-        # 缩放以提高性能
-        img = img.resize((100, int(100 * img.height / img.width)))
-        
-        # 转换为numpy数组
-        img_array = np.array(img)
-        
-        # 检查是否为RGB图像
-        if len(img_array.shape) < 3 or img_array.shape[2] < 3:
-            return True  # 不是彩色图像，可能是黑白或灰度图，视为安全
-        
-        # 提取R, G, B通道
-        r, g, b = img_array[:,:,0], img_array[:,:,1], img_array[:,:,2]
-        
-        # 简单的肤色检测 (不是非常精确，但足够做基本过滤)
-        # 基于RGB颜色空间的肤色范围
-        skin_mask = (r > 95) & (g > 40) & (b > 20) & \
-                    ((np.maximum(r, np.maximum(g, b)) - np.minimum(r, np.minimum(g, b))) > 15) & \
-                    (np.abs(r - g) > 15) & (r > g) & (r > b)
-        
-        # 计算肤色像素占比
-        skin_ratio = np.sum(skin_mask) / skin_mask.size
-        
-        # 如果肤色像素比例超过阈值，可能是不适当内容
-        if skin_ratio > skin_threshold:
-            logger.warning(f"离线检测: 图片 {file_path} 可能包含不适当内容 (肤色比例: {skin_ratio:.2f})")
-            return False
-            
-        return True
-    except Exception as e:
-        logger.error(f"离线图片检测出错: {str(e)}")
-        return True  # 出错时默认通过
+    return analyze_image(file_path, skin_threshold)[0]
 
 # 检查磁盘空间使用情况
 def check_disk_usage(path=None, threshold=80.0):
@@ -357,4 +413,77 @@ def check_disk_usage(path=None, threshold=80.0):
         return used_percent
     except Exception as e:
         logger.error(f"检查磁盘空间出错: {str(e)}")
-        return None 
\ No newline at end of file
+        return None 
+
+# 跨进程文件锁
+class FileLock:
+    """
+    基于文件的跨进程互斥锁，用于多个worker进程之间的协调
+    
+    Unix上使用fcntl.flock，Windows上使用msvcrt.locking。
+    进程退出时操作系统会自动释放锁，不会留下死锁。
+    shared为True时获取共享锁，多个共享锁可以同时持有，与互斥锁互斥；
+    Windows不支持共享锁，退化为互斥锁
+    """
+    def __init__(self, path: str, shared: bool = False):
+        self.path = path
+        self.shared = shared
+        self._file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """获取锁，非阻塞模式下锁已被占用时返回False"""
+        if self._file is not None:
+            return True
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        f = open(self.path, "a+")
+        try:
+            if fcntl is not None:
+                flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+                if not blocking:
+                    flags |= fcntl.LOCK_NB
+                fcntl.flock(f.fileno(), flags)
+            else:
+                f.seek(0)
+                mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), mode, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK在约10秒后仍未获取到锁会抛出异常，阻塞模式下继续等待
+                        if not blocking:
+                            raise
+        except (BlockingIOError, PermissionError, OSError):
+            f.close()
+            if blocking:
+                raise
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        """释放锁"""
+        if self._file is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+            self._file = None
+
+    @property
+    def locked(self) -> bool:
+        """当前进程是否持有锁"""
+        return self._file is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
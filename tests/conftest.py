@@ -0,0 +1,31 @@
+"""
+测试在临时目录中运行
+
+数据库、上传目录、会话文件和日志都使用相对路径，导入src之前切换到临时目录，
+模板和静态资源通过符号链接指向仓库中的目录，测试不会修改仓库中的文件。
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix="picui-test-")
+
+for _name in ("templates", "static"):
+    os.symlink(os.path.join(ROOT, _name), os.path.join(WORK_DIR, _name))
+os.chdir(WORK_DIR)
+sys.path.insert(0, ROOT)
+
+@pytest.fixture(scope="session")
+def app():
+    from src.app import app
+    return app
+
+@pytest.fixture
+def client(app):
+    """每个测试使用新的客户端，会话Cookie不在测试之间共享"""
+    from fastapi.testclient import TestClient
+    with TestClient(app) as c:
+        yield c
@@ -0,0 +1,145 @@
+"""流式读取ZIP和tar归档"""
+import asyncio
+import gzip
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from src.archive import MAX_METADATA_SIZE, ArchiveError, ByteStream, detect_format, iter_entries
+
+def _read(raw: bytes, format: str, want=lambda name: True, max_size: int = 1000, chunk: int = 7):
+    """按很小的块发送归档，返回 [(名称, 内容, 错误)]"""
+    async def chunks():
+        for start in range(0, len(raw), chunk):
+            yield raw[start:start + chunk]
+
+    async def collect():
+        return [tuple(entry) async for entry in iter_entries(ByteStream(chunks()), format, want, max_size)]
+
+    return asyncio.run(collect())
+
+class _Unseekable(io.RawIOBase):
+    """不支持seek的输出，zipfile会为条目写入数据描述符"""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+def _zip(entries, compression=zipfile.ZIP_DEFLATED, seekable=True) -> bytes:
+    out = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(out, "w", compression) as z:
+        for name, data in entries:
+            if name.endswith("/"):
+                z.mkdir(name) if hasattr(z, "mkdir") else z.writestr(name, b"")
+            elif seekable:
+                z.writestr(name, data)
+            else:
+                with z.open(name, "w") as f:
+                    f.write(data)
+    return (out if seekable else out.buffer).getvalue()
+
+def _tar(entries, format=tarfile.PAX_FORMAT, mode="w") -> bytes:
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode=mode, format=format) as t:
+        for name, data in entries:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                t.addfile(info)
+            else:
+                info.size = len(data)
+                t.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+def test_zip_entries(compression):
+    raw = _zip([("a/", b""), ("a/1.png", b"one" * 50), ("a/2.txt", b"two"), ("照片.png", b"three")], compression)
+    assert detect_format(raw[:512]) == "zip"
+    entries = _read(raw, "zip", want=lambda name: name.endswith(".png"))
+    assert entries == [
+        ("a/1.png", b"one" * 50, None),
+        ("a/2.txt", None, None),
+        ("照片.png", b"three", None),
+    ]
+
+def test_zip_data_descriptor():
+    raw = _zip([("1.png", b"x" * 300), ("2.png", b"y" * 10)], seekable=False)
+    assert _read(raw, "zip") == [("1.png", b"x" * 300, None), ("2.png", b"y" * 10, None)]
+    # 不需要的条目同样能找到结束位置
+    assert _read(raw, "zip", want=lambda name: name == "2.png") == [("1.png", None, None), ("2.png", b"y" * 10, None)]
+
+@pytest.mark.parametrize("seekable", [True, False])
+def test_zip_oversized_entry(seekable):
+    raw = _zip([("big.png", b"x" * 2000), ("small.png", b"ok")], seekable=seekable)
+    assert _read(raw, "zip") == [("big.png", None, "文件大小超过限制"), ("small.png", b"ok", None)]
+
+def test_zip_stored_oversized_entry():
+    raw = _zip([("big.png", b"x" * 2000), ("small.png", b"ok")], zipfile.ZIP_STORED)
+    assert _read(raw, "zip") == [("big.png", None, "文件大小超过限制"), ("small.png", b"ok", None)]
+
+def test_zip_crc_mismatch():
+    raw = bytearray(_zip([("1.png", b"abcdef")], zipfile.ZIP_STORED))
+    raw[raw.index(b"abcdef")] ^= 0xFF
+    assert _read(bytes(raw), "zip") == [("1.png", None, "CRC校验失败，文件已损坏")]
+
+def test_zip_corrupt_header():
+    with pytest.raises(ArchiveError, match="ZIP文件头无效"):
+        _read(b"PK\x03\x04" + b"\x00" * 40, "zip")
+    # 条目之后既不是下一个条目也不是中央目录
+    raw = _zip([("1.png", b"ok")], zipfile.ZIP_STORED)
+    with pytest.raises(ArchiveError, match="ZIP文件头无效"):
+        _read(raw[:raw.index(b"PK\x01\x02")] + b"garbage!", "zip")
+
+def test_zip_truncated():
+    raw = _zip([("1.png", b"x" * 500)], zipfile.ZIP_STORED)
+    with pytest.raises(ArchiveError, match="不完整"):
+        _read(raw[:100], "zip")
+
+@pytest.mark.parametrize("format", [tarfile.USTAR_FORMAT, tarfile.GNU_FORMAT, tarfile.PAX_FORMAT])
+def test_tar_entries(format):
+    raw = _tar([("a", None), ("a/1.png", b"one"), ("a/2.txt", b"two")], format=format)
+    assert detect_format(raw[:512]) == "tar"
+    assert _read(raw, "tar", want=lambda name: name.endswith(".png")) == [
+        ("a/1.png", b"one", None),
+        ("a/2.txt", None, None),
+    ]
+
+def test_tar_gz():
+    raw = _tar([("1.png", b"one"), ("2.png", b"two")], mode="w:gz")
+    assert detect_format(raw[:512]) == "tar.gz"
+    assert _read(raw, "tar.gz") == [("1.png", b"one", None), ("2.png", b"two", None)]
+    # 多个gzip成员依次解压
+    raw = gzip.compress(_tar([("1.png", b"one")])[:1024]) + gzip.compress(b"\x00" * 1024)
+    assert _read(raw, "tar.gz") == [("1.png", b"one", None)]
+
+def test_tar_long_names():
+    long_name = "相册/" + "x" * 150 + ".png"
+    assert _read(_tar([(long_name, b"pax")], format=tarfile.PAX_FORMAT), "tar") == [(long_name, b"pax", None)]
+    assert _read(_tar([(long_name, b"gnu")], format=tarfile.GNU_FORMAT), "tar") == [(long_name, b"gnu", None)]
+
+def test_tar_oversized_metadata():
+    raw = _tar([("x" * (MAX_METADATA_SIZE + 100) + ".png", b"pax")], format=tarfile.PAX_FORMAT)
+    with pytest.raises(ArchiveError, match="扩展头部过大"):
+        _read(raw, "tar")
+
+def test_tar_oversized_entry():
+    raw = _tar([("big.png", b"x" * 2000), ("small.png", b"ok")])
+    assert _read(raw, "tar") == [("big.png", None, "文件大小超过限制"), ("small.png", b"ok", None)]
+
+def test_tar_corrupt():
+    raw = bytearray(_tar([("1.png", b"one")]))
+    raw[0] ^= 0xFF
+    with pytest.raises(ArchiveError, match="校验和"):
+        _read(bytes(raw), "tar")
+    with pytest.raises(ArchiveError, match="不完整"):
+        _read(_tar([("1.png", b"x" * 2000)], format=tarfile.USTAR_FORMAT)[:1000], "tar", max_size=5000)
+
+def test_unknown_format():
+    assert detect_format(b"hello world") is None
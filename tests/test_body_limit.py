@@ -0,0 +1,73 @@
+"""请求体大小和multipart部分数量限制"""
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+import src.body_limit as body_limit
+from src.body_limit import BodyLimitMiddleware, body_limit_for
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(body_limit, "MAX_REQUEST_BODY", 100)
+    monkeypatch.setattr(body_limit, "MULTIPART_MAX_PARTS", 3)
+    monkeypatch.setattr(body_limit, "BODY_LIMITS", [
+        ("/upload", 1000),
+        ("/upload/resumable", 200),
+        ("/upload/import", 0),
+    ])
+
+@pytest.fixture
+def client(limits):
+    app = FastAPI()
+
+    @app.post("/{path:path}")
+    async def echo(request: Request):
+        if request.headers.get("content-type", "").startswith("multipart/"):
+            form = await request.form()
+            return {"parts": len(form)}
+        return {"size": len(await request.body())}
+
+    app.add_middleware(BodyLimitMiddleware)
+    return TestClient(app)
+
+def _chunks(total: int, size: int = 64):
+    for start in range(0, total, size):
+        yield b"x" * min(size, total - start)
+
+def test_longest_prefix_match(limits):
+    assert body_limit_for("/other") == 100
+    assert body_limit_for("/upload") == 1000
+    assert body_limit_for("/upload/resumable") == 200
+    assert body_limit_for("/upload/resumable/abc") == 200
+    assert body_limit_for("/upload/import") == 0
+    # 只按路径段匹配，/uploads不属于/upload
+    assert body_limit_for("/uploads") == 100
+    assert body_limit_for("/upload/resumablex") == 1000
+
+def test_content_length_over_limit(client):
+    r = client.post("/other", content=b"x" * 101)
+    assert r.status_code == 413
+    assert r.headers["connection"] == "close"
+
+    r = client.post("/upload/resumable/abc", content=b"x" * 201)
+    assert r.status_code == 413
+    assert client.post("/upload", content=b"x" * 201).json() == {"size": 201}
+
+def test_chunked_body_over_limit(client):
+    r = client.post("/upload/resumable/abc", content=_chunks(300))
+    assert "content-length" not in r.request.headers
+    assert r.status_code == 413
+
+    assert client.post("/upload/resumable/abc", content=_chunks(200)).json() == {"size": 200}
+
+def test_unlimited_path(client):
+    assert client.post("/upload/import", content=_chunks(5000)).json() == {"size": 5000}
+
+def test_too_many_parts(client):
+    files = {f"f{i}": (f"{i}.png", b"1") for i in range(3)}
+    assert client.post("/upload", files=files).json() == {"parts": 3}
+
+    files["f3"] = ("3.png", b"1")
+    r = client.post("/upload", files=files)
+    assert r.status_code == 413
+    assert "过多" in r.json()["detail"]
@@ -0,0 +1,99 @@
+"""批量导入归档接口的NDJSON输出"""
+import io
+import json
+import tarfile
+import zipfile
+
+from PIL import Image as PILImage
+
+def _png(color: str, size=(40, 30), format: str = "PNG") -> bytes:
+    buf = io.BytesIO()
+    PILImage.new("RGB", size, color).save(buf, format)
+    return buf.getvalue()
+
+def _import(client, raw: bytes, content_type: str = "application/zip"):
+    r = client.post("/upload/import", content=raw, headers={"Content-Type": content_type})
+    lines = [json.loads(line) for line in r.text.splitlines() if line.strip()]
+    return r, lines
+
+def _delete_imported(client, lines):
+    for line in lines:
+        if line["type"] == "file":
+            client.delete(f"/img/{line['filename']}")
+
+def test_import_zip(client):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("album/1.png", _png("red"))
+        z.writestr("album/2.jpg", _png("blue", format="JPEG"))
+        z.writestr("album/readme.txt", b"hi")
+        z.writestr("__MACOSX/album/._1.png", b"junk")
+        z.writestr("fake.png", b"not an image")
+    r, lines = _import(client, buf.getvalue())
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+
+    files = [line for line in lines if line["type"] == "file"]
+    assert sorted(line["name"] for line in files) == ["album/1.png", "album/2.jpg"]
+    assert {line["name"]: line["mime_type"] for line in files} == {"album/1.png": "image/png", "album/2.jpg": "image/jpeg"}
+    skipped = {line["name"]: line["reason"] for line in lines if line["type"] == "skipped"}
+    assert skipped == {"album/readme.txt": "不支持的文件类型", "__MACOSX/album/._1.png": "隐藏文件"}
+    errors = [line for line in lines if line["type"] == "error"]
+    assert [(line["name"], line["code"]) for line in errors] == [("fake.png", "invalid_image")]
+
+    summary = lines[-1]
+    assert summary["type"] == "summary" and "error" not in summary
+    assert (summary["entries"], summary["imported"], summary["failed"], summary["skipped"]) == (5, 2, 1, 2)
+    for line in files:
+        assert client.get(f"/images/{line['filename']}").status_code == 200
+        assert client.get(f"/s/{line['short_code']}").status_code == 200
+    _delete_imported(client, lines)
+
+def test_import_tar_gz(client):
+    buf = io.BytesIO()
+    long_name = "相册/" + "长" * 80 + ".png"
+    with tarfile.open(fileobj=buf, mode="w:gz", format=tarfile.PAX_FORMAT) as t:
+        for name, data in ((long_name, _png("green")), ("big.png", b"\x89PNG" + b"\x00" * 64)):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            t.addfile(info, io.BytesIO(data))
+    r, lines = _import(client, buf.getvalue(), "application/gzip")
+    assert r.status_code == 200
+    files = [line for line in lines if line["type"] == "file"]
+    assert [(line["name"], line["original_filename"]) for line in files] == [(long_name, "长" * 80 + ".png")]
+    assert [line["name"] for line in lines if line["type"] == "error"] == ["big.png"]
+    assert lines[-1]["imported"] == 1 and lines[-1]["failed"] == 1
+    _delete_imported(client, lines)
+
+def test_import_oversized_entry(client, monkeypatch):
+    import src.bulk_import as bulk_import
+    monkeypatch.setattr(bulk_import, "MAX_SIZE", 1000)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("big.png", _png("white", (300, 300)) + b"\x00" * 2000)
+    r, lines = _import(client, buf.getvalue())
+    assert [(line["type"], line.get("error")) for line in lines[:-1]] == [("error", "文件大小超过限制")]
+    assert lines[-1]["failed"] == 1 and lines[-1]["imported"] == 0
+
+def test_import_corrupt_zip(client):
+    r, lines = _import(client, b"PK\x03\x04" + b"\x00" * 100)
+    assert r.status_code == 200
+    # 无法解析的头部不作为条目返回，只有汇总中的归档错误
+    assert len(lines) == 1
+    assert lines[0]["type"] == "summary" and lines[0]["error"] == "ZIP文件头无效"
+    assert lines[0]["entries"] == 0
+
+def test_import_truncated_tar(client):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w", format=tarfile.USTAR_FORMAT) as t:
+        data = _png("black", (200, 200))
+        info = tarfile.TarInfo("1.png")
+        info.size = len(data)
+        t.addfile(info, io.BytesIO(data))
+    r, lines = _import(client, buf.getvalue()[:700], "application/x-tar")
+    assert lines[-1]["type"] == "summary" and "不完整" in lines[-1]["error"]
+    assert lines[-1]["imported"] == 0
+
+def test_import_not_an_archive(client):
+    r = client.post("/upload/import", content=b"hello world", headers={"Content-Type": "application/zip"})
+    assert r.status_code == 400
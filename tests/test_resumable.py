@@ -0,0 +1,127 @@
+"""断点续传上传的协议流程"""
+import base64
+import io
+import os
+import time
+
+import pytest
+from PIL import Image as PILImage
+
+import src.resumable as resumable
+
+_PATCH_HEADERS = {"Content-Type": "application/offset+octet-stream"}
+
+def _png() -> bytes:
+    buf = io.BytesIO()
+    PILImage.new("RGB", (120, 80), "green").save(buf, "PNG")
+    return buf.getvalue()
+
+def _create(client, data: bytes, filename: str = "续传.png"):
+    metadata = "filename " + base64.b64encode(filename.encode()).decode()
+    r = client.post("/upload/resumable", headers={"Upload-Length": str(len(data)), "Upload-Metadata": metadata})
+    assert r.status_code == 201, r.text
+    return r
+
+def _patch(client, location: str, data: bytes, offset: int):
+    return client.patch(location, content=data, headers={**_PATCH_HEADERS, "Upload-Offset": str(offset)})
+
+def _session(client, upload_id: str):
+    """测试客户端会话对应的 (用户ID, 上传ID)"""
+    user_id = next(d for d in os.listdir(resumable.RESUMABLE_DIR)
+                   if os.path.exists(resumable._paths(d, upload_id)[1]))
+    return user_id, upload_id
+
+@pytest.fixture
+def data():
+    return _png()
+
+def test_create_returns_request_host(client, data):
+    r = _create(client, data)
+    upload_id = r.json()["id"]
+    assert r.headers["location"] == f"http://testserver/upload/resumable/{upload_id}"
+    assert r.json()["location"] == r.headers["location"]
+    assert r.headers["upload-offset"] == "0"
+
+def test_out_of_order_upload_and_finalize(client, data):
+    location = f"/upload/resumable/{_create(client, data).json()['id']}"
+    size = len(data) // 3 + 1
+    chunks = [(offset, data[offset:offset + size]) for offset in range(0, len(data), size)]
+
+    # 先传最后一块，连续的偏移量仍为0
+    r = _patch(client, location, chunks[-1][1], chunks[-1][0])
+    assert r.status_code == 204 and r.headers["upload-offset"] == "0"
+    r = client.post(location + "/finalize")
+    assert r.status_code == 409 and "尚未完成" in r.json()["detail"]
+
+    for offset, chunk in chunks[:-1]:
+        assert _patch(client, location, chunk, offset).status_code == 204
+    assert client.head(location).headers["upload-offset"] == str(len(data))
+    assert client.get(location).json()["received"] == [[0, len(data)]]
+
+    # 超出文件大小的块
+    assert _patch(client, location, b"x" * 10, len(data) - 5).status_code == 400
+
+    r = client.post(location + "/finalize")
+    assert r.status_code == 200, r.text
+    result = r.json()
+    assert result["mime_type"] == "image/png"
+    assert client.get(f"/images/{result['filename']}").content == data
+    assert client.head(location).status_code == 404
+    assert _patch(client, location, data[:10], 0).status_code == 404
+    client.delete(f"/img/{result['filename']}")
+
+def test_finalize_waits_for_chunk_in_progress(client, data):
+    r = _create(client, data)
+    location = f"/upload/resumable/{r.json()['id']}"
+    user_id, upload_id = _session(client, r.json()["id"])
+    assert _patch(client, location, data, 0).status_code == 204
+
+    # 模拟正在写入的PATCH：持有共享锁和打开的临时文件
+    lock, fd = resumable._open_chunk(user_id, upload_id)
+    assert fd is not None
+    try:
+        r = client.post(location + "/finalize")
+        assert r.status_code == 409 and "正在上传" in r.json()["detail"]
+    finally:
+        os.close(fd)
+        lock.release()
+
+    # 进入完成状态后开始的PATCH不能再打开临时文件
+    meta, error = resumable._set_state(user_id, upload_id, "uploading", "finalizing")
+    assert error is None
+    assert resumable._open_chunk(user_id, upload_id) == (None, None)
+    r = _patch(client, location, data[:10], 0)
+    assert r.status_code == 409
+    assert client.delete(location).status_code == 409
+
+    resumable._set_state(user_id, upload_id, "finalizing", "uploading")
+    r = client.post(location + "/finalize")
+    assert r.status_code == 200, r.text
+    client.delete(f"/img/{r.json()['filename']}")
+
+def test_terminate_removes_files(client, data):
+    r = _create(client, data)
+    location = f"/upload/resumable/{r.json()['id']}"
+    user_id, upload_id = _session(client, r.json()["id"])
+    assert _patch(client, location, data[:100], 0).status_code == 204
+
+    assert client.delete(location).status_code == 204
+    assert client.head(location).status_code == 404
+    for path in (*resumable._paths(user_id, upload_id), resumable._upload_lock(user_id, upload_id).path):
+        assert not os.path.exists(path)
+
+def test_expired_uploads_are_cleaned(client, data):
+    r = _create(client, data)
+    location = f"/upload/resumable/{r.json()['id']}"
+    user_id, upload_id = _session(client, r.json()["id"])
+    assert _patch(client, location, data[:100], 0).status_code == 204
+
+    meta_path = resumable._paths(user_id, upload_id)[1]
+    meta = resumable._read_meta(meta_path)
+    meta["expires"] = time.time() - 1
+    resumable._write_meta(meta_path, meta)
+    assert client.head(location).status_code == 404
+
+    assert resumable.clean_expired_uploads() >= 1
+    for path in (*resumable._paths(user_id, upload_id), resumable._upload_lock(user_id, upload_id).path):
+        assert not os.path.exists(path)
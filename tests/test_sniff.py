@@ -0,0 +1,59 @@
+"""图片格式识别和访问图片时的响应头"""
+import io
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from PIL import Image as PILImage
+
+from src.sniff import PROBE_UNREADABLE, image_file_response, probe_image, sniff_format
+
+SVG = b'<?xml version="1.0"?><svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'
+
+def _png(size=(4, 3)) -> bytes:
+    buf = io.BytesIO()
+    PILImage.new("RGB", size).save(buf, "PNG")
+    return buf.getvalue()
+
+def _client(path: str, mime_type: str, filename: str) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/image")
+    async def image():
+        return image_file_response(path, mime_type, filename)
+
+    return TestClient(app)
+
+def test_svg_served_as_sandboxed_attachment(tmp_path):
+    path = tmp_path / "x.svg"
+    path.write_bytes(SVG)
+    assert sniff_format(SVG) == "SVG"
+
+    r = _client(str(path), "image/svg+xml", "x.svg").get("/image")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("image/svg+xml")
+    assert r.headers["content-disposition"].startswith("attachment")
+    assert r.headers["content-security-policy"] == "sandbox"
+    assert r.headers["x-content-type-options"] == "nosniff"
+
+def test_raster_image_served_inline(tmp_path):
+    path = tmp_path / "x.png"
+    path.write_bytes(_png())
+
+    r = _client(str(path), "image/png", "x.png").get("/image")
+    assert r.status_code == 200
+    assert r.headers["content-disposition"].startswith("inline")
+    assert r.headers["x-content-type-options"] == "nosniff"
+    assert "content-security-policy" not in r.headers
+
+def test_probe_image_from_head(monkeypatch):
+    data = _png((40, 30))
+    info, error = probe_image("PNG", data[:64])
+    assert error is None and (info.width, info.height) == (40, 30)
+
+    monkeypatch.setattr("src.sniff.MAX_IMAGE_PIXELS", 100)
+    info, error = probe_image("PNG", data[:64])
+    assert info is None and error != PROBE_UNREADABLE
+
+def test_probe_image_corrupt():
+    info, error = probe_image("PNG", b"\x89PNG\r\n\x1a\n" + b"\x00" * 32)
+    assert info is None and error == PROBE_UNREADABLE